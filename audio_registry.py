@@ -0,0 +1,148 @@
+"""
+Shared, preloaded audio stimuli for the whole session.
+
+AudioRegistry decodes each stimulus once into a float32 NumPy buffer when it
+is registered. It hands out ready-to-play Sound objects built from those
+buffers. A Sound is created once per (stimulus, duration) and reused by every
+block that asks for it, so block setup does no file I/O or decoding.
+stereo() mixes two registered stimuli into the left and right channels of a
+single buffer, so a bilateral sound starts with one call.
+At most `capacity` Sound objects are kept alive. The least recently used one
+is stopped and dropped when a new one would exceed that. release() and
+clear() free buffers explicitly, so memory stays flat over long sessions.
+"""
+import wave
+from collections import OrderedDict
+
+import numpy as np
+
+# Full scale of the integer PCM sample widths the wave module can return
+_PCM_SCALE = {1: 128.0, 2: 32768.0, 4: 2147483648.0}
+_PCM_DTYPE = {1: np.uint8, 2: '<i2', 4: '<i4'}
+
+
+def decode_wav(path):
+    """Read a PCM WAV file into (float32 samples in [-1, 1], sample rate).
+
+    Mono files give a 1-D array, multichannel files an (n, channels) array.
+    """
+    with wave.open(path, 'rb') as wav:
+        width = wav.getsampwidth()
+        channels = wav.getnchannels()
+        sample_rate = wav.getframerate()
+        raw = wav.readframes(wav.getnframes())
+    if width not in _PCM_DTYPE:
+        raise ValueError(f"{path}: unsupported {8 * width}-bit samples")
+    samples = np.frombuffer(raw, dtype=_PCM_DTYPE[width]).astype(np.float32)
+    if width == 1:
+        samples -= 128.0  # 8-bit WAV is unsigned
+    samples /= _PCM_SCALE[width]
+    if channels > 1:
+        samples = samples.reshape(-1, channels)
+    return samples, sample_rate
+
+
+class AudioRegistry:
+    """Decoded audio buffers and the shared Sound objects built from them.
+
+    Parameters:
+    -----------
+    sound_module : module
+        psychopy.sound (or the virtual backend's stand-in)
+    capacity : int
+        Largest number of Sound objects kept alive at once
+    volume : float
+        Volume applied to every Sound created
+    """
+
+    def __init__(self, sound_module, capacity=8, volume=1.0):
+        self.sound = sound_module
+        self.capacity = capacity
+        self.volume = volume
+        self._buffers = {}            # name -> (samples, sample_rate)
+        self._sounds = OrderedDict()  # (name, secs) -> Sound, least recently used first
+
+    def add(self, name, samples, sample_rate):
+        """Register an already decoded buffer under name, replacing any previous one."""
+        self.release(name)
+        self._buffers[name] = (np.ascontiguousarray(samples, dtype=np.float32), sample_rate)
+
+    def load(self, name, path):
+        """Decode the WAV file at path once and register it under name."""
+        samples, sample_rate = decode_wav(path)
+        self.add(name, samples, sample_rate)
+        print(f"Loaded {name}: {len(samples) / sample_rate * 1000:.0f}ms at {sample_rate}Hz from {path}")
+
+    def buffer(self, name, secs=None):
+        """The registered samples, cut to secs if given (a view, not a copy)."""
+        samples, sample_rate = self._buffers[name]
+        if secs is not None:
+            samples = samples[:int(round(secs * sample_rate))]
+        return samples, sample_rate
+
+    def get(self, name, secs=None):
+        """Return the shared Sound for name, trimmed to secs, creating it on first use."""
+        key = (name, secs)
+        if key in self._sounds:
+            self._sounds.move_to_end(key)
+            return self._sounds[key]
+
+        samples, sample_rate = self.buffer(name, secs)
+        return self._create(key, samples, sample_rate)
+
+    def stereo(self, left=None, right=None, secs=None, lateralize=True):
+        """Return the shared Sound playing stimulus left in the left channel and right in the right.
+
+        Either side may be None for silence. Each stimulus is reduced to mono
+        and written into its channel of one interleaved (n, 2) buffer. With
+        lateralize=False both stimuli are mixed into both channels instead
+        (scaled down only if the mix would clip).
+        """
+        key = ('stereo', left, right, secs, lateralize)
+        if key in self._sounds:
+            self._sounds.move_to_end(key)
+            return self._sounds[key]
+
+        sources = {}
+        for channel, name in enumerate((left, right)):
+            if name is not None:
+                samples, sample_rate = self.buffer(name, secs)
+                sources[channel] = samples if samples.ndim == 1 else samples.mean(axis=1)
+        rates = {self._buffers[name][1] for name in (left, right) if name is not None}
+        if len(rates) != 1:
+            raise ValueError(f"Cannot mix {left} and {right}: need one sample rate, got {sorted(rates)}")
+        sample_rate = rates.pop()
+
+        mix = np.zeros((max(len(source) for source in sources.values()), 2), dtype=np.float32)
+        for channel, source in sources.items():
+            if lateralize:
+                mix[:len(source), channel] = source
+            else:
+                mix[:len(source)] += source[:, None]
+        peak = np.abs(mix).max()
+        if peak > 1.0:
+            mix /= peak
+        return self._create(key, mix, sample_rate)
+
+    def _create(self, key, samples, sample_rate):
+        stim = self.sound.Sound(value=samples, sampleRate=sample_rate, secs=len(samples) / sample_rate)
+        stim.setVolume(self.volume)
+        self._sounds[key] = stim
+        while len(self._sounds) > self.capacity:
+            _, evicted = self._sounds.popitem(last=False)
+            evicted.stop()
+        return stim
+
+    def release(self, name):
+        """Stop and drop every Sound built from name, and its buffer."""
+        for key in [key for key in self._sounds if name in key[:3]]:
+            self._sounds.pop(key).stop()
+        self._buffers.pop(name, None)
+
+    def clear(self):
+        """Release everything; call at the end of the session."""
+        for name in list(self._buffers):
+            self.release(name)
+
+    def __contains__(self, name):
+        return name in self._buffers
@@ -0,0 +1,273 @@
+"""
+SQLite catalog of every data and demographic file in a data directory.
+
+Participant ID, age, gender, site, the offline tag and the timestamp are
+parsed from each file name once and stored in the `files` table, together
+with the file's mtime and size. update() rescans the directory in a single
+os.scandir pass and only parses files that are new or whose mtime or size
+changed. Removed files are dropped. Trials go into the indexed `trials`
+table and every block gets a row in `blocks`, so questions such as "all
+SJ_Mod blocks from site X with age < 6" are a single indexed query:
+
+    python catalog.py data/ --experiment sj_mod --site vandy --max-age 6
+    python catalog.py data/ --sql "SELECT site, COUNT(*) FROM files GROUP BY site"
+
+The catalog lives in msi_catalog.sqlite inside the indexed directory.
+"""
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+import time
+
+from session_table import load_trials
+from trial_writer import JOURNAL_SUFFIX
+
+CATALOG_FILE = 'msi_catalog.sqlite'
+OFFLINE_TAG = 'offline'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    kind TEXT NOT NULL,
+    participant_id TEXT,
+    age REAL,
+    gender TEXT,
+    site TEXT,
+    offline INTEGER NOT NULL,
+    timestamp TEXT,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    trials INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    block INTEGER NOT NULL,
+    experiment TEXT NOT NULL,
+    trials INTEGER NOT NULL,
+    PRIMARY KEY (file_id, block, experiment)
+);
+CREATE TABLE IF NOT EXISTS trials (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    participant_id TEXT,
+    block INTEGER,
+    trial INTEGER,
+    experiment TEXT,
+    trial_type TEXT,
+    soa REAL,
+    side TEXT,
+    response REAL,
+    rt REAL,
+    timestamp REAL,
+    max_frame_interval REAL,
+    dropped_frames INTEGER,
+    onset_error REAL,
+    audio_scheduled_time REAL,
+    audio_schedule_error REAL
+);
+CREATE INDEX IF NOT EXISTS files_site_age ON files (site, age);
+CREATE INDEX IF NOT EXISTS files_participant ON files (participant_id);
+CREATE INDEX IF NOT EXISTS blocks_experiment ON blocks (experiment);
+CREATE INDEX IF NOT EXISTS trials_file_block ON trials (file_id, block);
+CREATE INDEX IF NOT EXISTS trials_experiment ON trials (experiment, trial_type);
+CREATE INDEX IF NOT EXISTS trials_participant ON trials (participant_id);
+"""
+
+# trials table column -> data file column
+TRIAL_FIELDS = {
+    'participant_id': 'Participant_ID', 'block': 'Block_Number', 'trial': 'Trial_Number',
+    'experiment': 'Experiment', 'trial_type': 'Trial_Type', 'soa': 'SOA', 'side': 'Side',
+    'response': 'Response', 'rt': 'Reaction_Time', 'timestamp': 'Timestamp',
+    'max_frame_interval': 'Max_Frame_Interval', 'dropped_frames': 'Dropped_Frames',
+    'onset_error': 'Onset_Error', 'audio_scheduled_time': 'Audio_Scheduled_Time',
+    'audio_schedule_error': 'Audio_Schedule_Error',
+}
+
+
+def _age(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_file_name(name):
+    """File-name fields of a data or demographic file, or None for other files.
+
+    data_{id}_{age}_{gender}_{site}[_offline]_{YYYYMMDD}_{HHMMSS}.csv and
+    demographic_data_{id}[_offline]_{YYYYMMDD}.csv. The ID may itself
+    contain underscores; the other fields are taken from the right.
+    """
+    if not name.endswith('.csv'):
+        return None
+    if name.startswith('demographic_data_'):
+        parts = name[len('demographic_data_'):-len('.csv')].split('_')
+        stamp_parts = 1
+        kind = 'demographic'
+    elif name.startswith('data_'):
+        parts = name[len('data_'):-len('.csv')].split('_')
+        stamp_parts = 2
+        kind = 'data'
+    else:
+        return None
+    timestamp = '_'.join(parts[-stamp_parts:])
+    parts = parts[:-stamp_parts]
+    offline = bool(parts) and parts[-1] == OFFLINE_TAG
+    if offline:
+        parts = parts[:-1]
+    fields = {'kind': kind, 'offline': int(offline), 'timestamp': timestamp,
+              'age': None, 'gender': None, 'site': None}
+    if kind == 'data':
+        if len(parts) < 4:
+            return None
+        fields.update(participant_id='_'.join(parts[:-3]), age=_age(parts[-3]), gender=parts[-2], site=parts[-1])
+    else:
+        if not parts:
+            return None
+        fields['participant_id'] = '_'.join(parts)
+    return fields
+
+
+class Catalog:
+    """Incrementally updated SQLite index of one data directory.
+
+    Parameters:
+    -----------
+    directory : str
+        Directory holding the data_*.csv and demographic_data_*.csv files
+    path : str
+        Database file (default: CATALOG_FILE inside directory)
+    """
+
+    def __init__(self, directory='.', path=None):
+        self.directory = directory
+        self.path = path or os.path.join(directory, CATALOG_FILE)
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA foreign_keys=ON')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def update(self):
+        """Index new and changed files and forget removed ones. Returns (indexed, removed)."""
+        with os.scandir(self.directory) as entries:
+            stats = {entry.name: entry.stat() for entry in entries if entry.is_file()}
+        known = {row['name']: (row['mtime_ns'], row['size'])
+                 for row in self.db.execute('SELECT name, mtime_ns, size FROM files')}
+
+        indexed = 0
+        with self.db:
+            gone = [name for name in known if name not in stats]
+            self.db.executemany('DELETE FROM files WHERE name = ?', [(name,) for name in gone])
+            for name in sorted(stats):
+                fields = parse_file_name(name)
+                if fields is None or name + JOURNAL_SUFFIX in stats:
+                    continue  # Not a session file, or a block still to be recovered
+                stat = stats[name]
+                if known.get(name) == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                # A file that cannot be read leaves no partial rows and is retried next time
+                self.db.execute('SAVEPOINT index_file')
+                try:
+                    self._index_file(name, fields, stat)
+                    indexed += 1
+                except (OSError, csv.Error, UnicodeDecodeError, ValueError) as e:
+                    self.db.execute('ROLLBACK TO index_file')
+                    print(f"Skipping {name}: {e}")
+                self.db.execute('RELEASE index_file')
+        return indexed, len(gone)
+
+    def _index_file(self, name, fields, stat):
+        self.db.execute('DELETE FROM files WHERE name = ?', (name,))
+        file_id = self.db.execute(
+            'INSERT INTO files (name, kind, participant_id, age, gender, site, offline, timestamp, mtime_ns, size) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (name, fields['kind'], fields['participant_id'], fields['age'], fields['gender'], fields['site'],
+             fields['offline'], fields['timestamp'], stat.st_mtime_ns, stat.st_size)).lastrowid
+        if fields['kind'] != 'data':
+            return
+
+        table = load_trials(os.path.join(self.directory, name))
+        columns = [table[column].tolist() for column in TRIAL_FIELDS.values()]
+        experiment_column = list(TRIAL_FIELDS).index('experiment')
+        columns[experiment_column] = [value.strip().lower() for value in columns[experiment_column]]
+        self.db.executemany(
+            f"INSERT INTO trials (file_id, {', '.join(TRIAL_FIELDS)}) VALUES ({', '.join('?' * (len(TRIAL_FIELDS) + 1))})",
+            ((file_id,) + row for row in zip(*columns)))
+        blocks = {}
+        for block, exp in zip(table['Block_Number'].tolist(), columns[experiment_column]):
+            blocks[(block, exp)] = blocks.get((block, exp), 0) + 1
+        self.db.executemany('INSERT INTO blocks (file_id, block, experiment, trials) VALUES (?, ?, ?, ?)',
+                            [(file_id, block, exp, count) for (block, exp), count in blocks.items()])
+        self.db.execute('UPDATE files SET trials = ? WHERE id = ?', (len(table), file_id))
+
+    def query(self, sql, params=()):
+        """Run an SQL query; returns a list of sqlite3.Row."""
+        return self.db.execute(sql, params).fetchall()
+
+    def find_blocks(self, experiment=None, site=None, participant_id=None, min_age=None, max_age=None,
+                    offline=None):
+        """Blocks matching every given filter, with their file's metadata.
+
+        max_age is exclusive (age < max_age), min_age inclusive.
+        """
+        conditions, params = [], []
+        for clause, value in (('b.experiment = ?', experiment and experiment.lower()), ('f.site = ?', site),
+                              ('f.participant_id = ?', participant_id), ('f.age >= ?', min_age),
+                              ('f.age < ?', max_age), ('f.offline = ?', None if offline is None else int(offline))):
+            if value is not None:
+                conditions.append(clause)
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self.query(
+            'SELECT f.name, f.participant_id, f.age, f.gender, f.site, f.offline, f.timestamp, '
+            f'b.block, b.experiment, b.trials FROM blocks b JOIN files f ON f.id = b.file_id {where} '
+            'ORDER BY f.timestamp, b.block', params)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index session files in SQLite and query them")
+    parser.add_argument('directory', nargs='?', default='.', help="Data directory")
+    parser.add_argument('--experiment', help="Block experiment type, e.g. sj_mod")
+    parser.add_argument('--site', help="Site")
+    parser.add_argument('--participant', help="Participant ID")
+    parser.add_argument('--min-age', type=float, help="Lowest age (inclusive)")
+    parser.add_argument('--max-age', type=float, help="Highest age (exclusive)")
+    parser.add_argument('--sql', help="Run this SQL query instead of listing blocks")
+    parser.add_argument('--no-update', action='store_true', help="Query without rescanning the directory")
+    args = parser.parse_args()
+
+    with Catalog(args.directory) as catalog:
+        if not args.no_update:
+            start = time.perf_counter()
+            indexed, removed = catalog.update()
+            print(f"Indexed {indexed} files, removed {removed} in {time.perf_counter() - start:.2f}s")
+
+        start = time.perf_counter()
+        if args.sql:
+            rows = catalog.query(args.sql)
+        else:
+            rows = catalog.find_blocks(args.experiment, args.site, args.participant, args.min_age, args.max_age)
+        elapsed = time.perf_counter() - start
+        if rows:
+            writer = csv.writer(sys.stdout)
+            writer.writerow(rows[0].keys())
+            writer.writerows(tuple(row) for row in rows)
+        print(f"{len(rows)} rows in {elapsed * 1000:.1f}ms", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Per-machine cache of the measured display refresh rate.
+
+Measuring the refresh rate properly takes a couple of seconds of flipping,
+and the result only changes when the monitor, its mode or the machine does.
+calibrate_display() keys the measurement by host, screen, resolution and
+fullscreen mode and stores the refresh rate and the frame-interval spread in
+display_calibration.json. Later sessions only run a short verification pass.
+The full measurement is repeated only if that pass disagrees with the cache.
+"""
+import json
+import os
+import platform
+import time
+
+import numpy as np
+
+CALIBRATION_FILE = 'display_calibration.json'
+FULL_FRAMES = 120
+QUICK_FRAMES = 20
+WARMUP_FRAMES = 10
+# Quick-check median interval may differ from the cached one by this fraction
+TOLERANCE = 0.02
+# Intervals longer than this many median intervals are dropped frames, not refresh
+DROP_THRESHOLD = 1.5
+FALLBACK_RATE = 60.0
+
+
+def calibration_key(win, screen=0):
+    width, height = (int(v) for v in win.size)
+    mode = 'fullscr' if getattr(win, 'fullscr', False) else 'windowed'
+    return f"{platform.node()}|screen{screen}|{width}x{height}|{mode}"
+
+
+def measure_intervals(win, n_frames, warmup=WARMUP_FRAMES):
+    """Flip n_frames blank frames after warmup and return the intervals in seconds."""
+    for _ in range(warmup):
+        win.flip()
+    times = np.empty(n_frames + 1)
+    for i in range(n_frames + 1):
+        flip_time = win.flip()
+        # Some backends return None from flip(); fall back to the wall clock
+        times[i] = flip_time if flip_time is not None else time.perf_counter()
+    return np.diff(times)
+
+
+def _summarize(intervals):
+    """(refresh rate, interval SD, frames kept) with dropped frames excluded."""
+    median = np.median(intervals)
+    kept = intervals[intervals < median * DROP_THRESHOLD]
+    return 1.0 / kept.mean(), float(kept.std()), int(len(kept))
+
+
+def load_calibrations(path=CALIBRATION_FILE):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable display calibration file: {e}")
+        return {}
+
+
+def save_calibrations(calibrations, path=CALIBRATION_FILE):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(calibrations, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def calibrate_display(win, screen=0, path=CALIBRATION_FILE, force=False):
+    """Return the refresh rate of win's display in Hz, using the cache when it still holds.
+
+    A cached entry is accepted if the median interval of a short
+    verification pass is within TOLERANCE of it. Otherwise (or with force)
+    a full measurement is made and stored.
+    """
+    key = calibration_key(win, screen)
+    calibrations = load_calibrations(path)
+    cached = calibrations.get(key)
+
+    if cached and not force:
+        try:
+            quick_median = float(np.median(measure_intervals(win, QUICK_FRAMES)))
+            cached_interval = 1.0 / cached['refresh_rate']
+            if abs(quick_median - cached_interval) <= cached_interval * TOLERANCE:
+                print(f"Display calibration for {key} verified: {cached['refresh_rate']:.3f}Hz "
+                      f"(quick check {1.0 / quick_median:.3f}Hz)")
+                return cached['refresh_rate']
+            print(f"Display no longer matches its calibration ({1.0 / quick_median:.3f}Hz vs "
+                  f"{cached['refresh_rate']:.3f}Hz), recalibrating")
+        except Exception as e:
+            print(f"Display verification failed, recalibrating: {e}")
+
+    try:
+        refresh_rate, interval_sd, frames = _summarize(measure_intervals(win, FULL_FRAMES))
+    except Exception as e:
+        print(f"Display calibration failed, assuming {FALLBACK_RATE}Hz: {e}")
+        return FALLBACK_RATE
+    if not np.isfinite(refresh_rate) or refresh_rate <= 0:
+        print(f"Display calibration gave no usable rate, assuming {FALLBACK_RATE}Hz")
+        return FALLBACK_RATE
+
+    calibrations[key] = {
+        'refresh_rate': refresh_rate,
+        'interval_sd': interval_sd,
+        'frames': frames,
+        'measured': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    save_calibrations(calibrations, path)
+    print(f"Display calibrated for {key}: {refresh_rate:.3f}Hz, "
+          f"interval SD {interval_sd * 1000:.3f}ms over {frames} frames")
+    return refresh_rate
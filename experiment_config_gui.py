@@ -2,12 +2,66 @@ import sys
 import json
 from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QFileDialog, QMessageBox, 
                              QLabel, QLineEdit, QSpinBox, QComboBox, QGroupBox, QFormLayout, QCheckBox, QScrollArea, QDoubleSpinBox)
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal, pyqtSlot
 import os
 import subprocess
-import redcap
+from redcap_client import get_client
+from record_registry import RecordRegistry
+from id_leases import IdAllocator, LeaseError
 from typing import List
 import copy
 
+# Wait this long after the last keystroke in the API fields before looking up IDs
+REDCAP_LOOKUP_DELAY_MS = 600
+# Seconds before a record ID lookup gives up on the network
+REDCAP_LOOKUP_TIMEOUT = 15
+
+def fetch_record_ids(api_url, api_token) -> List[str]:
+    """Existing record IDs, sorted numerically; only records changed since the last lookup are exported."""
+    project = get_client(api_url, api_token, timeout=REDCAP_LOOKUP_TIMEOUT)
+    registry = RecordRegistry(api_url, api_token)
+    registry.refresh(project)
+    return registry.sorted_ids()
+
+def suggest_participant_id(existing_ids) -> str:
+    """Next ID of this station's lease, so stations running at the same time never suggest the same one.
+
+    May wait for the shared lease ledger, so it runs on the lookup thread.
+    """
+    try:
+        return IdAllocator().peek(existing_ids)
+    except LeaseError as e:
+        print(f"ID lease ledger unavailable ({e}); suggesting the ID after the highest one")
+        return highest_id_plus_one(existing_ids)
+
+def highest_id_plus_one(existing_ids) -> str:
+    numeric_ids = [int(id) for id in existing_ids if id.isdigit()]
+    return str(max(numeric_ids) + 1).zfill(3) if numeric_ids else "001"
+
+class RecordIdWorker(QObject):
+    """Runs record ID lookups, and picks the ID to suggest, on the lookup thread.
+
+    Requests are numbered; one that has been superseded by the time the
+    thread gets to it is dropped without touching the network.
+    """
+    finished = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+
+    def __init__(self):
+        super().__init__()
+        self.latest = 0  # Number of the newest request, set from the UI thread
+
+    @pyqtSlot(int, str, str)
+    def fetch(self, sequence, api_url, api_token):
+        if sequence != self.latest:
+            return
+        try:
+            record_ids = fetch_record_ids(api_url, api_token)
+        except Exception as e:
+            self.failed.emit(sequence, str(e))
+            return
+        self.finished.emit(sequence, (record_ids, suggest_participant_id(record_ids)))
+
 class BlockConfig(QGroupBox):
     def __init__(self, block_number):
         super().__init__(f"Block {block_number}")
@@ -87,31 +141,87 @@ class BlockConfig(QGroupBox):
         return config
 
 class ExperimentConfigApp(QWidget):
-    def update_participant_ids(self):
-        """Update participant ID combo box with existing records and next available ID."""
-        try:
-            existing_ids = self.fetch_redcap_records()
-            
-            # Clear current items
-            self.participant_id.clear()
-            
-            # Format existing IDs with leading zeros
-            formatted_ids = [str(int(id)).zfill(3) for id in existing_ids]
-            
-            # Add formatted existing IDs
-            self.participant_id.addItems(formatted_ids)
-            
-            # Calculate and add next available ID with leading zeros
-            if existing_ids:
-                next_id = str(int(max(existing_ids)) + 1).zfill(3)
-            else:
-                next_id = "001"
-                
-            self.participant_id.addItem(next_id)
-            self.participant_id.setCurrentText(next_id)
-            
-        except Exception as e:
-            QMessageBox.warning(self, "Error", f"Failed to update participant IDs: {str(e)}")
+    lookup_requested = pyqtSignal(int, str, str)
+
+    def update_participant_ids(self, show_errors=False):
+        """Look up the participant IDs in REDCap on the lookup thread.
+
+        Cached IDs for the same credentials are shown straight away while the
+        lookup runs. Results of a lookup that has since been superseded are
+        ignored.
+        """
+        self.lookup_timer.stop()
+        api_url, api_token = self.api_url.text().strip(), self.api_token.text().strip()
+        if not api_url or not api_token:
+            self.redcap_status.setText('')
+            return
+
+        self.lookup_key = (api_url, api_token)
+        self.lookup_show_errors = show_errors
+        if self.lookup_key not in self.record_id_cache:
+            # IDs saved by an earlier lookup or offline sync, shown until the refresh returns
+            registry = RecordRegistry(api_url, api_token)
+            if not registry.cold:
+                self.record_id_cache[self.lookup_key] = (registry.sorted_ids(), None)
+        if self.lookup_key in self.record_id_cache:
+            existing_ids, next_id = self.record_id_cache[self.lookup_key]
+            self.show_participant_ids(existing_ids, next_id)
+            self.redcap_status.setText(f"{len(existing_ids)} records (refreshing...)")
+        else:
+            self.redcap_status.setText("Loading participant IDs...")
+
+        self.lookup_sequence += 1
+        self.lookup_worker.latest = self.lookup_sequence
+        self.lookup_requested.emit(self.lookup_sequence, api_url, api_token)
+
+    def refresh_participant_ids(self):
+        self.update_participant_ids(show_errors=True)
+
+    def schedule_participant_id_update(self):
+        """Restart the debounce timer; the lookup runs once typing pauses."""
+        self.lookup_timer.start()
+
+    def on_record_ids(self, sequence, result):
+        if sequence != self.lookup_sequence:
+            return  # Credentials changed while this lookup was running
+        existing_ids, next_id = result
+        self.record_id_cache[self.lookup_key] = result
+        self.show_participant_ids(existing_ids, next_id)
+        self.redcap_status.setText(f"{len(existing_ids)} records")
+
+    def on_record_ids_failed(self, sequence, message):
+        if sequence != self.lookup_sequence:
+            return
+        cached = self.lookup_key in self.record_id_cache
+        self.redcap_status.setText("REDCap lookup failed" + (", showing cached IDs" if cached else ""))
+        if self.lookup_show_errors:
+            QMessageBox.warning(self, "REDCap Connection Error", f"Could not fetch records: {message}")
+
+    def show_participant_ids(self, existing_ids, next_id=None):
+        """Fill the participant ID combo box with existing records and next_id, the ID to suggest.
+
+        Without next_id (cached IDs shown while the lookup runs) the ID after
+        the highest one stands in until the lookup thread has picked one.
+        """
+        # An ID the user picked or typed survives a refresh; otherwise suggest the next one
+        current_id = self.participant_id.currentText()
+        
+        # Clear current items
+        self.participant_id.clear()
+        
+        # Format existing IDs with leading zeros
+        formatted_ids = [id.zfill(3) if id.isdigit() else id for id in existing_ids]
+        
+        # Add formatted existing IDs
+        self.participant_id.addItems(formatted_ids)
+        
+        if next_id is None:
+            next_id = highest_id_plus_one(existing_ids)
+        self.participant_id.addItem(next_id)
+        self.participant_id.setCurrentText(current_id if self.participant_id_chosen and current_id else next_id)
+
+    def mark_participant_id_chosen(self):
+        self.participant_id_chosen = True
     
     def __init__(self):
         super().__init__()
@@ -119,18 +229,43 @@ class ExperimentConfigApp(QWidget):
         self.last_saved_file = None
         self.original_config = None  # Store the original config for change detection
         self.has_unsaved_changes = False  # Track whether changes have been made
+
+        # Record ID lookups run on their own thread so the window never waits on REDCap
+        self.record_id_cache = {}  # (api_url, api_token) -> (record IDs, suggested ID or None)
+        self.lookup_sequence = 0
+        self.lookup_key = None
+        self.lookup_show_errors = False
+        self.participant_id_chosen = False
+        self.lookup_thread = QThread(self)
+        self.lookup_worker = RecordIdWorker()
+        self.lookup_worker.moveToThread(self.lookup_thread)
+        self.lookup_requested.connect(self.lookup_worker.fetch)
+        self.lookup_worker.finished.connect(self.on_record_ids)
+        self.lookup_worker.failed.connect(self.on_record_ids_failed)
+        self.lookup_thread.start()
+        self.lookup_timer = QTimer(self)
+        self.lookup_timer.setSingleShot(True)
+        self.lookup_timer.setInterval(REDCAP_LOOKUP_DELAY_MS)
+        self.lookup_timer.timeout.connect(self.update_participant_ids)
         
         self.initUI()
         self.load_default_config()
         self.load_api_credentials()
         
-        # Connect API credential changes to participant ID update
-        self.api_url.textChanged.connect(self.update_participant_ids)
-        self.api_token.textChanged.connect(self.update_participant_ids)
+        # Look up participant IDs once the API credentials stop changing
+        self.api_url.textChanged.connect(self.schedule_participant_id_update)
+        self.api_token.textChanged.connect(self.schedule_participant_id_update)
         
         # Connect change tracking to all input widgets
         self.connect_change_tracking()
 
+    def closeEvent(self, event):
+        # A lookup in flight ends within REDCAP_LOOKUP_TIMEOUT
+        self.lookup_timer.stop()
+        self.lookup_thread.quit()
+        self.lookup_thread.wait()
+        super().closeEvent(event)
+
     def initUI(self):
         self.setWindowTitle('Multi-Block Experiment Configuration')
         self.setGeometry(100, 100, 800, 800)
@@ -145,12 +280,16 @@ class ExperimentConfigApp(QWidget):
         self.participant_id = QComboBox()
         self.participant_id.setEditable(True)
         self.participant_id.setInsertPolicy(QComboBox.InsertPolicy.InsertAlphabetically)
+        self.participant_id.activated.connect(self.mark_participant_id_chosen)
+        self.participant_id.lineEdit().textEdited.connect(self.mark_participant_id_chosen)
         self.refresh_participant_id_button = QPushButton("Refresh IDs")
-        self.refresh_participant_id_button.clicked.connect(self.update_participant_ids)
+        self.refresh_participant_id_button.clicked.connect(self.refresh_participant_ids)
+        self.redcap_status = QLabel('')
     
         participant_id_layout = QHBoxLayout()
         participant_id_layout.addWidget(self.participant_id)
         participant_id_layout.addWidget(self.refresh_participant_id_button)
+        participant_id_layout.addWidget(self.redcap_status)
     
         # Other participant fields
         self.age = QSpinBox()
@@ -293,20 +432,6 @@ class ExperimentConfigApp(QWidget):
         else:
             self.status_label.setText("")
 
-    def fetch_redcap_records(self) -> List[str]:
-        """Fetch existing record IDs from REDCap and determine next available ID."""
-        try:
-            if not self.api_url.text() or not self.api_token.text():
-                return []
-            
-            project = redcap.Project(self.api_url.text(), self.api_token.text())
-            records = project.export_records(fields=['record_id'])
-            record_ids = [str(record['record_id']) for record in records]
-            return sorted(record_ids, key=lambda x: int(x) if x.isdigit() else float('inf'))
-        except Exception as e:
-            QMessageBox.warning(self, "REDCap Connection Error", f"Could not fetch records: {str(e)}")
-            return []
-    
     def load_default_config(self):
         default_file = 'default.json'
         if os.path.exists(default_file):
@@ -570,6 +695,17 @@ class ExperimentConfigApp(QWidget):
         msg.setStandardButtons(QMessageBox.Ok)
         msg.exec_()
 
+        # Claim the suggested ID, so this station's next session is offered a new one.
+        # Offline sessions get their REDCap ID from the offline sync instead.
+        if not self.offline_mode.isChecked():
+            # The lookup thread already leased the suggested ID, so claiming it only touches the station file
+            _, suggested_id = self.record_id_cache.get(self.lookup_key, ((), None))
+            try:
+                if suggested_id and self.participant_id.currentText() == suggested_id:
+                    IdAllocator().claim(suggested_id)
+            except LeaseError as e:
+                print(f"Could not record the participant ID in the lease ledger: {e}")
+
         # Start the experiment in a separate process
         subprocess.Popen([sys.executable, 'run_MSI_GUI_experiment.py', self.last_saved_file])
 
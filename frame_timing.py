@@ -0,0 +1,140 @@
+"""
+Session-wide record of flip timestamps.
+
+FrameTimingRecorder keeps every flip time in a preallocated NumPy ring buffer,
+tagged with the block, trial, phase and timeline frame it belongs to.
+record() only writes into the arrays, so it is safe inside the flip loop.
+Sounds scheduled for a predicted flip time are noted with record_audio() so
+the prediction can be checked against the flip that actually happened.
+Drop detection and the per-trial summary are vectorized and run after the
+trial. The full trace is saved once per session.
+"""
+import numpy as np
+
+PHASE_PRETRIAL = 0
+PHASE_STIMULUS = 1
+PHASE_RESPONSE = 2
+
+# A flip interval longer than this many frames counts as a drop
+DROP_THRESHOLD = 1.5
+
+
+class FrameTimingRecorder:
+    """Ring buffer of flip timestamps for a whole session.
+
+    Parameters:
+    -----------
+    frame_dur : float
+        Nominal frame duration in seconds
+    capacity : int
+        Number of flips kept before the oldest undrained ones are overwritten;
+        it only needs to hold one trial because the buffer is drained between
+        trials
+    """
+
+    def __init__(self, frame_dur, capacity=65536):
+        self.frame_dur = frame_dur
+        self.capacity = capacity
+        self._times = np.zeros(capacity, dtype=np.float64)
+        self._blocks = np.zeros(capacity, dtype=np.int16)
+        self._trials = np.zeros(capacity, dtype=np.int32)
+        self._phases = np.zeros(capacity, dtype=np.int8)
+        self._frames = np.zeros(capacity, dtype=np.int32)
+        self._count = 0
+        self._drained = 0
+        self._chunks = []
+        self.overwritten = 0
+        self.block = 0
+        self.trial = 0
+        self._audio = []  # (frame, scheduled start, predicted flip) for the current trial
+
+    def start_trial(self, block, trial):
+        """Tag following flips with block/trial; call between trials."""
+        self.drain()
+        self.block = block
+        self.trial = trial
+        self._audio = []
+
+    def record_audio(self, frame, scheduled_time, predicted_flip):
+        """Note a sound scheduled to start at scheduled_time (audio clock),
+        computed from the predicted time of frame's flip (flip clock)."""
+        self._audio.append((frame, scheduled_time, predicted_flip))
+
+    def record(self, flip_time, phase, frame=-1):
+        """Store one flip. No allocation or I/O; meant for the flip loop."""
+        i = self._count % self.capacity
+        self._times[i] = flip_time
+        self._blocks[i] = self.block
+        self._trials[i] = self.trial
+        self._phases[i] = phase
+        self._frames[i] = frame
+        self._count += 1
+
+    def _pending(self):
+        """Indices of records not yet drained, oldest first."""
+        start = max(self._drained, self._count - self.capacity)
+        return np.arange(start, self._count) % self.capacity
+
+    def drain(self):
+        """Move pending records out of the ring into the session trace."""
+        lost = max(0, self._count - self.capacity - self._drained)
+        self.overwritten += lost
+        idx = self._pending()
+        if len(idx):
+            self._chunks.append((self._times[idx], self._blocks[idx], self._trials[idx],
+                                 self._phases[idx], self._frames[idx]))
+        self._drained = self._count
+
+    def trial_summary(self, onset_frame):
+        """Timing summary of the current trial's stimulus phase.
+
+        Returns (max_interval, dropped_frames, onset_error) in seconds/frames.
+        onset_error is the onset flip time minus the time it was due, counted
+        from the first stimulus-phase flip.
+        """
+        idx = self._pending()
+        stimulus = idx[self._phases[idx] == PHASE_STIMULUS]
+        if len(stimulus) < 2:
+            return np.nan, 0, np.nan
+
+        times = self._times[stimulus]
+        frames = self._frames[stimulus]
+        intervals = np.diff(times)
+        late = intervals > self.frame_dur * DROP_THRESHOLD
+        dropped_frames = int(np.sum(np.round(intervals[late] / self.frame_dur) - 1))
+
+        onset = np.flatnonzero(frames == onset_frame)
+        onset_error = np.nan
+        if len(onset):
+            onset_error = float(times[onset[0]] - (times[0] + (onset_frame - frames[0]) * self.frame_dur))
+        return float(intervals.max()), dropped_frames, onset_error
+
+    def audio_summary(self):
+        """Scheduling of the current trial's first sound.
+
+        Returns (scheduled_time, schedule_error): its start time on the audio
+        clock and how much earlier than planned it started relative to its
+        flip (predicted minus actual flip time), in seconds. NaN when no sound
+        was scheduled.
+        """
+        if not self._audio:
+            return np.nan, np.nan
+        frame, scheduled_time, predicted_flip = self._audio[0]
+        idx = self._pending()
+        flips = idx[(self._phases[idx] == PHASE_STIMULUS) & (self._frames[idx] == frame)]
+        if not len(flips):
+            return float(scheduled_time), np.nan
+        return float(scheduled_time), float(predicted_flip - self._times[flips[0]])
+
+    def save(self, filename):
+        """Write the full session trace to a compressed .npz file."""
+        self.drain()
+        if self._chunks:
+            times, blocks, trials, phases, frames = (np.concatenate(column) for column in zip(*self._chunks))
+        else:
+            times, blocks, trials, phases, frames = (np.zeros(0, dtype=a.dtype) for a in
+                                                     (self._times, self._blocks, self._trials,
+                                                      self._phases, self._frames))
+        np.savez_compressed(filename, time=times, block=blocks, trial=trials, phase=phases,
+                            frame=frames, frame_dur=self.frame_dur, overwritten=self.overwritten)
+        return filename
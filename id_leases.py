@@ -0,0 +1,206 @@
+"""
+Collision-free participant IDs for several testing stations.
+
+Taking max(existing IDs) + 1 gives two stations working at the same time the
+same ID. Instead, every station leases a block of IDs (LEASE_SIZE by
+default) from a shared ledger file and hands them out locally, one per
+session, without touching the network. The ledger is only opened, under a
+lock file, when a station's block runs out, so a dozen stations take the
+lock once per LEASE_SIZE sessions each rather than once per session.
+
+Point every station at the same ledger on a shared drive:
+
+    MSI_ID_LEASE_FILE=//labserver/msi/id_leases.json
+
+Without it, id_leases.json in the working directory is used, which is
+enough for a single station. The station's own lease and the IDs it has
+issued are kept in station_ids.json. IDs that REDCap already has (passed as
+`taken`) are skipped, so IDs created outside the ledger are never reissued.
+
+    allocator = IdAllocator()
+    allocator.peek(known_ids)      # '041', the ID the next session will get
+    allocator.allocate(known_ids)  # '041', now used by this station
+
+peek may have to lease a block and so wait for the ledger lock; claim only
+marks an ID peek returned as used, without opening the ledger, for callers
+(like the configuration GUI) that must not block.
+
+Anything that stops the ledger or the station file from being used (a
+lock held too long, an unreadable or corrupt file) raises LeaseError.
+
+The offline sync also checks REDCap before attaching files, and moves a
+participant to a new ID if the record already has someone else's files (see
+offline_sync.find_collisions).
+"""
+import json
+import os
+import socket
+import time
+
+LEASE_FILE = 'id_leases.json'
+STATION_FILE = 'station_ids.json'
+LEASE_FILE_ENV = 'MSI_ID_LEASE_FILE'
+LEASE_SIZE = 20
+# Give up waiting for the ledger lock after this long
+LOCK_TIMEOUT = 10.0
+# A lock older than this was left by a crashed station
+LOCK_STALE_SECONDS = 60.0
+
+
+class LeaseError(Exception):
+    """The ledger or the station file could not be read or written."""
+
+
+def ledger_path():
+    return os.environ.get(LEASE_FILE_ENV) or LEASE_FILE
+
+
+class LeaseLedger:
+    """Shared file recording which block of IDs each station holds.
+
+    Parameters:
+    -----------
+    path : str
+        Ledger file, on a drive every station can reach
+    """
+
+    def __init__(self, path=None):
+        self.path = path or ledger_path()
+        self.lock_path = self.path + '.lock'
+
+    def _acquire_lock(self):
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, f"{socket.gethostname()} {os.getpid()}".encode())
+                os.close(fd)
+                return
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lock_path) > LOCK_STALE_SECONDS:
+                        os.remove(self.lock_path)
+                        continue
+                except OSError:
+                    continue  # Released meanwhile
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"ID lease ledger {self.path} is locked")
+                time.sleep(0.05)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {'next': 1, 'leases': []}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def leases(self):
+        return self._read()['leases']
+
+    def reserve(self, station, size=LEASE_SIZE, floor=0):
+        """Lease the next size IDs above floor to station. Returns (first, last)."""
+        try:
+            self._acquire_lock()
+            try:
+                data = self._read()
+                first = max(data['next'], floor + 1)
+                last = first + size - 1
+                data['next'] = last + 1
+                data['leases'].append({'station': station, 'first': first, 'last': last, 'time': time.time()})
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(data, f, indent=2)
+                os.replace(tmp_path, self.path)
+            finally:
+                os.remove(self.lock_path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise LeaseError(f"ID lease ledger {self.path} unavailable: {e}") from e
+        return first, last
+
+
+class IdAllocator:
+    """Hands out participant IDs from this station's leased blocks.
+
+    Parameters:
+    -----------
+    station : str
+        Station name recorded in the ledger (default: host name)
+    ledger : LeaseLedger
+        Shared ledger (default: LeaseLedger())
+    directory : str
+        Directory holding STATION_FILE
+    lease_size : int
+        IDs leased at a time
+    """
+
+    def __init__(self, station=None, ledger=None, directory='.', lease_size=LEASE_SIZE):
+        self.station = station or socket.gethostname()
+        self.ledger = ledger or LeaseLedger()
+        self.path = os.path.join(directory, STATION_FILE)
+        self.lease_size = lease_size
+        self.ranges = []  # [first, last] blocks not yet used up
+        self.issued = {}  # ID -> time issued
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+                # Blocks leased from another ledger mean nothing in this one
+                if data.get('ledger') == os.path.abspath(self.ledger.path):
+                    self.ranges = data['ranges']
+                self.issued = data.get('issued', {})
+            except (OSError, ValueError, KeyError, AttributeError) as e:
+                raise LeaseError(f"Station file {self.path} unreadable: {e}") from e
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'station': self.station, 'ledger': os.path.abspath(self.ledger.path),
+                           'ranges': self.ranges, 'issued': self.issued}, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            raise LeaseError(f"Station file {self.path} could not be written: {e}") from e
+
+    def _next(self, taken):
+        """First free ID of the held blocks, leasing a new block when they are used up."""
+        taken = {int(record_id) for record_id in taken if str(record_id).isdigit()}
+        taken.update(int(record_id) for record_id in self.issued)
+        while True:
+            for block in self.ranges:
+                while block[0] <= block[1] and block[0] in taken:
+                    block[0] += 1
+            self.ranges = [block for block in self.ranges if block[0] <= block[1]]
+            if self.ranges:
+                return self.ranges[0][0]
+            first, last = self.ledger.reserve(self.station, self.lease_size, max(taken, default=0))
+            print(f"Station {self.station} leased IDs {first}-{last}")
+            self.ranges.append([first, last])
+            self.save()
+
+    def peek(self, taken=()):
+        """The ID the next session will get, as a zero-padded string."""
+        return str(self._next(taken)).zfill(3)
+
+    def allocate(self, taken=()):
+        """Take the next ID for a session."""
+        record_id = str(self._next(taken)).zfill(3)
+        self.ranges[0][0] += 1
+        self.issued[record_id] = time.time()
+        self.save()
+        return record_id
+
+    def claim(self, record_id):
+        """Mark record_id, returned by an earlier peek, as used without opening the ledger.
+
+        Returns False if it is not in a block this station holds.
+        """
+        if not str(record_id).isdigit():
+            return False
+        number = int(record_id)
+        for block in self.ranges:
+            if block[0] <= number <= block[1]:
+                if number == block[0]:
+                    block[0] += 1
+                self.issued[str(number).zfill(3)] = time.time()
+                self.save()
+                return True
+        return False
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+Upload data collected in offline mode to REDCap.
+
+Offline sessions save data_*_offline_*.csv and demographic_data_*_offline_*.csv
+files under a temporary participant ID. This tool gives every offline
+participant the next free REDCap record ID, rewrites the ID column and file
+name, and attaches the files to the new records. A data file's typed table
+(.npy) and frame trace are renamed along with it:
+
+    python offline_sync.py [directory] [--dry-run]
+
+The directory is scanned once. All new records are created with a single
+batched import_records call. Each CSV is rewritten in one streaming csv pass
+into the in-memory upload buffer. A sync manifest records the ID given to each
+offline participant and every file already uploaded, so a run that is
+interrupted (or repeated) never allocates a second ID or uploads a file twice.
+New IDs come from this station's block in the ID lease ledger (id_leases.py),
+skipping any ID the local record registry (record_registry.py) knows REDCap
+already has. Before attaching files, the sync checks that no other session's
+files are on the assigned records and moves a participant to a fresh ID if
+they are.
+
+The experiment runner starts this in the background at launch, so a site that
+comes back online after weeks of fieldwork does not wait for it.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from id_leases import IdAllocator, LeaseError
+from record_registry import RecordRegistry
+from session_table import FORMATS, table_from_csv, table_path, write_table
+from trial_writer import JOURNAL_SUFFIX
+
+MANIFEST_FILE = 'offline_sync_manifest.json'
+LOCK_FILE = 'offline_sync.lock'
+LOG_FILE = 'offline_sync.log'
+# A sync that has not touched its lock for this long is considered dead
+LOCK_STALE_SECONDS = 300.0
+OFFLINE_TAG = '_offline'
+
+
+class OfflineFile:
+    """One offline data or demographic file and the names it will be uploaded under."""
+
+    def __init__(self, name):
+        self.name = name
+        self.is_data = name.startswith('data_')
+        self.field = 'python_data_file' if self.is_data else 'demographic_data_file'
+        prefix, stamp = name.split(OFFLINE_TAG, 1)
+        self.stamp = stamp.lstrip('_')  # Keep the full timestamp, date included
+        parts = prefix.split('_')
+        if self.is_data:
+            # data_ID_age_gender_site
+            self.offline_id = parts[1]
+            self.details = '_'.join(parts[2:])
+        else:
+            # demographic_data_ID
+            self.offline_id = parts[2]
+            self.details = ''
+
+    def new_name(self, record_id):
+        if self.is_data:
+            return f"data_{record_id}_{self.details}_{self.stamp}"
+        return f"demographic_data_{record_id}_{self.stamp}"
+
+
+def scan_offline_files(directory='.'):
+    """Single pass over directory. Returns {offline participant ID: [OfflineFile]}."""
+    participants = {}
+    with os.scandir(directory) as entries:
+        names = {entry.name for entry in entries if entry.is_file()}
+    for name in sorted(names):
+        if not name.endswith('.csv') or OFFLINE_TAG not in name:
+            continue
+        if not (name.startswith('data_') or name.startswith('demographic_data_')):
+            continue
+        if name + JOURNAL_SUFFIX in names:
+            print(f"Skipping {name}: it has an unrecovered journal")
+            continue
+        try:
+            offline_file = OfflineFile(name)
+        except (ValueError, IndexError):
+            print(f"Skipping {name}: unrecognised file name")
+            continue
+        participants.setdefault(offline_file.offline_id, []).append(offline_file)
+    return participants
+
+
+def rewrite_participant_id(path, record_id):
+    """Return the file's bytes with the first column of every data row set to record_id.
+
+    A single streaming csv pass into the upload buffer; quoted fields are
+    handled by the csv module.
+    """
+    buffer = io.StringIO(newline='')
+    writer = csv.writer(buffer)
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is not None:
+            writer.writerow(header)
+        for row in reader:
+            if row:
+                row[0] = record_id
+            writer.writerow(row)
+    return buffer.getvalue().encode('utf-8')
+
+
+class SyncManifest:
+    """Assigned record IDs and uploaded files, persisted after every change."""
+
+    def __init__(self, directory='.'):
+        self.path = os.path.join(directory, MANIFEST_FILE)
+        self.participants = {}  # offline ID -> record ID
+        self.uploaded = {}      # offline file name -> {'record_id', 'file_name', 'time'}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self.participants = data.get('participants', {})
+            self.uploaded = data.get('uploaded', {})
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'participants': self.participants, 'uploaded': self.uploaded}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def assign_record_ids(project, count, directory='.', reserved=(), dry_run=False):
+    """count new record IDs from this station's lease, skipping IDs REDCap or reserved already hold.
+
+    Falls back to the IDs after the highest known one if the lease ledger
+    cannot be reached. A dry run only previews the IDs.
+    """
+    registry = RecordRegistry(project.url, project.token, directory)
+    registry.refresh(project)
+    taken = registry.record_ids | set(reserved)
+    try:
+        allocator = IdAllocator(directory=directory)
+        record_ids = []
+        for _ in range(count):
+            record_id = allocator.peek(taken) if dry_run else allocator.allocate(taken)
+            taken.add(record_id)
+            record_ids.append(record_id)
+        return record_ids
+    except LeaseError as e:
+        print(f"ID lease ledger unavailable ({e}); using the IDs after the highest known one")
+        record_ids, candidate = [], registry.max_id
+        while len(record_ids) < count:
+            candidate += 1
+            record_id = str(candidate).zfill(3)
+            if record_id not in taken and str(candidate) not in taken:
+                record_ids.append(record_id)
+        return record_ids
+
+
+def find_collisions(project, manifest, pending):
+    """Offline participants whose assigned record already holds files another session uploaded.
+
+    A file on a record this sync has uploaded to before is its own; so is one
+    with exactly the name it would upload (an upload the manifest missed).
+    """
+    assigned = {manifest.participants[offline_id]: offline_id for offline_id in pending}
+    ours = {entry['record_id'] for entry in manifest.uploaded.values()}
+    rows = project.export_records(records=list(assigned),
+                                  fields=['record_id', 'python_data_file', 'demographic_data_file'])
+    collisions = set()
+    for row in rows:
+        offline_id = assigned.get(str(row['record_id']))
+        if offline_id is None or row.get('redcap_repeat_instrument'):
+            continue
+        for offline_file in pending[offline_id]:
+            existing = row.get(offline_file.field)
+            if existing and existing != offline_file.new_name(row['record_id']) and row['record_id'] not in ours:
+                collisions.add(offline_id)
+    return collisions
+
+
+def sync_offline_files(project, directory='.', dry_run=False):
+    """Upload every offline file in directory not yet synced. Returns the number uploaded."""
+    participants = scan_offline_files(directory)
+    manifest = SyncManifest(directory)
+    pending = {offline_id: [f for f in files if f.name not in manifest.uploaded]
+               for offline_id, files in participants.items()}
+    pending = {offline_id: files for offline_id, files in pending.items() if files}
+    if not pending:
+        print("No offline files to sync.")
+        return 0
+    print(f"Found {sum(len(files) for files in pending.values())} offline files "
+          f"from {len(pending)} participants.")
+
+    # Give new IDs to participants seen for the first time; IDs from an earlier
+    # interrupted run are reused. The manifest is saved before the records are
+    # created so a crash can never hand out a second ID.
+    unassigned = [offline_id for offline_id in pending if offline_id not in manifest.participants]
+    if unassigned:
+        record_ids = assign_record_ids(project, len(unassigned), directory, manifest.participants.values(), dry_run)
+        for offline_id, record_id in zip(unassigned, record_ids):
+            manifest.participants[offline_id] = record_id
+            print(f"Assigning ID {record_id} to offline participant {offline_id}")
+        if not dry_run:
+            manifest.save()
+
+    if dry_run:
+        print("Dry run: nothing uploaded.")
+        return 0
+
+    # Another station may have used the same ID meanwhile; never overwrite its files
+    collisions = find_collisions(project, manifest, pending)
+    for offline_id in sorted(collisions):
+        record_id = assign_record_ids(project, 1, directory, manifest.participants.values())[0]
+        print(f"Record {manifest.participants[offline_id]} already holds another session's files; "
+              f"moving offline participant {offline_id} to ID {record_id}")
+        manifest.participants[offline_id] = record_id
+    if collisions:
+        manifest.save()
+
+    # One batched call creates (or confirms) every record needed
+    project.import_records([{'record_id': manifest.participants[offline_id]} for offline_id in pending])
+    registry = RecordRegistry(project.url, project.token, directory)
+    registry.add(manifest.participants[offline_id] for offline_id in pending)
+    registry.save()
+
+    uploaded = 0
+    for offline_id, files in pending.items():
+        record_id = manifest.participants[offline_id]
+        for offline_file in files:
+            path = os.path.join(directory, offline_file.name)
+            new_name = offline_file.new_name(record_id)
+            try:
+                content = rewrite_participant_id(path, record_id)
+                project.import_file(
+                    record=record_id,
+                    field=offline_file.field,
+                    file_name=new_name,
+                    file_content=content
+                )
+            except Exception as e:
+                print(f"Error uploading {offline_file.name}: {e}")
+                continue
+
+            # Keep the renamed copy locally and retire the offline original
+            with open(os.path.join(directory, new_name), 'wb') as f:
+                f.write(content)
+            manifest.uploaded[offline_file.name] = {'record_id': record_id, 'file_name': new_name,
+                                                    'time': time.time()}
+            manifest.save()
+            os.remove(path)
+            if offline_file.is_data:
+                _rename_companions(directory, offline_file.name, new_name)
+            uploaded += 1
+            print(f"Uploaded {offline_file.name} as {new_name} to record {record_id}")
+            _touch_lock(directory)
+
+        # Once all of a participant's files are up, a later offline session
+        # reusing the same temporary ID gets a fresh record
+        if all(offline_file.name in manifest.uploaded for offline_file in files):
+            del manifest.participants[offline_id]
+            manifest.save()
+    return uploaded
+
+
+def _rename_companions(directory, old_name, new_name):
+    """Move a data file's typed table and frame trace along with it.
+
+    The table is written again from the renamed CSV, so its Participant_ID
+    column holds the record ID too.
+    """
+    old_path, new_path = os.path.join(directory, old_name), os.path.join(directory, new_name)
+    for fmt in FORMATS:
+        old_table = table_path(old_path, fmt)
+        if not os.path.exists(old_table):
+            continue
+        try:
+            write_table(table_from_csv(new_path), table_path(new_path, fmt))
+            os.remove(old_table)
+        except Exception as e:
+            print(f"Could not move {os.path.basename(old_table)} along with {old_name}: {e}")
+    old_trace = old_path.replace('data_', 'frame_trace_', 1).replace('.csv', '.npz')
+    new_trace = new_path.replace('data_', 'frame_trace_', 1).replace('.csv', '.npz')
+    if os.path.exists(old_trace):
+        try:
+            os.replace(old_trace, new_trace)
+        except OSError as e:
+            print(f"Could not move {os.path.basename(old_trace)} along with {old_name}: {e}")
+
+
+def _touch_lock(directory):
+    try:
+        os.utime(os.path.join(directory, LOCK_FILE))
+    except OSError:
+        pass
+
+
+def _acquire_lock(directory):
+    """Take the sync lock, replacing a stale one. Returns False if another sync holds it."""
+    lock_path = os.path.join(directory, LOCK_FILE)
+    try:
+        if time.time() - os.path.getmtime(lock_path) >= LOCK_STALE_SECONDS:
+            os.remove(lock_path)
+    except OSError:
+        pass
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.write(fd, _lock_owner().encode())
+    os.close(fd)
+    return True
+
+
+def _lock_owner():
+    return f"{socket.gethostname()} {os.getpid()}"
+
+
+def _release_lock(directory):
+    """Remove the sync lock, unless it went stale and another sync has taken it over."""
+    lock_path = os.path.join(directory, LOCK_FILE)
+    try:
+        with open(lock_path, 'r') as f:
+            if f.read().strip() != _lock_owner():
+                return
+        os.remove(lock_path)
+    except OSError:
+        pass
+
+
+def start_background_sync(api_url, api_token, directory='.'):
+    """Run the sync in a detached process so the caller does not wait on the network."""
+    env = dict(os.environ, MSI_REDCAP_URL=api_url, MSI_REDCAP_TOKEN=api_token)
+    kwargs = {}
+    if sys.platform == 'win32':
+        kwargs['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+    with open(os.path.join(directory, LOG_FILE), 'a') as log:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), os.path.abspath(directory)],
+                         env=env, stdout=log, stderr=subprocess.STDOUT, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload offline data files to REDCap")
+    parser.add_argument('directory', nargs='?', default='.', help="Directory holding the offline files")
+    parser.add_argument('--dry-run', action='store_true', help="Show the ID assignment without uploading")
+    args = parser.parse_args()
+
+    from redcap_outbox import _load_api_credentials
+    api_url, api_token = _load_api_credentials(os.path.join(args.directory, 'api_text.txt'))
+    if not api_url or not api_token:
+        print("API credentials not found. Cannot sync offline files.")
+        return 1
+
+    if not _acquire_lock(args.directory):
+        print("Another offline sync is already running.")
+        return 0
+    try:
+        from redcap_client import get_client
+        project = get_client(api_url, api_token)
+        uploaded = sync_offline_files(project, args.directory, args.dry_run)
+        print(f"Offline sync finished: {uploaded} files uploaded.")
+        print(project.metrics.summary())
+    except Exception as e:
+        print(f"Offline sync failed: {e}")
+        return 1
+    finally:
+        _release_lock(args.directory)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""
+Race-model inequality (Miller bound) analysis of SRT and SRT_Mod sessions.
+
+Under a race between separate auditory and visual processes, the redundant
+(audiovisual) RT distribution can never exceed the sum of the unisensory
+ones:
+
+    F_AV(t) <= F_A(t) + F_V(t)
+
+Every participant's SRT trials, and every SRT_Mod side (left, right,
+bilateral), form one condition. Sessions of the same participant are pooled.
+For each condition, the audiovisual quantiles and the quantiles of the
+bound F_A + F_V are computed on a shared probability grid. The gap
+bound - AV (ms, positive = violation) is computed for all participants and
+conditions at once, on padded arrays. The violation area is the
+integral of the positive gap over probability, which equals the area
+between the two CDFs where F_AV exceeds the bound.
+
+The group test at the chosen percentiles is a sign-flip permutation test
+across participants. Each permutation flips the signs of whole participants,
+and the maximum t over percentiles (tmax) controls the familywise error.
+Permutations are evaluated in batches, one matrix product per batch.
+Reading the data files is spread over a process pool:
+
+    python race_model.py data/ --permutations 10000 --workers 8
+"""
+import argparse
+import csv
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from session_data import find_session_files, load_session
+
+SRT_EXPERIMENTS = ('srt', 'srt_mod')
+MODALITIES = ('audio', 'visual', 'audiovisual')
+# Probability grid for the violation area: bin centres of 100 equal bins
+AREA_PROBS = (np.arange(100) + 0.5) / 100
+TEST_PERCENTILES = (5, 10, 15, 20, 25, 30)
+MIN_TRIALS = 5
+PERMUTATION_BATCH = 1000
+
+CURVE_FIELDS = ['participant', 'experiment', 'condition', 'audio_trials', 'visual_trials',
+                'audiovisual_trials', 'violation_area', 'max_violation', 'max_violation_percentile']
+TEST_FIELDS = ['experiment', 'condition', 'participants', 'percentile', 'mean_violation', 't', 'p_corrected']
+
+
+def srt_rts(table):
+    """{(participant, experiment, condition): {modality: [RT ms, ...]}} for one session table."""
+    keep = (np.isin(table['experiment'], SRT_EXPERIMENTS) & np.isfinite(table['rt'])
+            & (table['rt'] > 0))
+    rts = {}
+    for participant, experiment, trial_type, rt in zip(table['participant'][keep], table['experiment'][keep],
+                                                       table['trial_type'][keep], table['rt'][keep]):
+        modality, _, side = str(trial_type).partition('_')
+        if modality not in MODALITIES:
+            continue
+        key = (str(participant), str(experiment), side or 'central')
+        rts.setdefault(key, {}).setdefault(modality, []).append(rt * 1000.0)
+    return rts
+
+
+def _load_rts(path):
+    try:
+        return srt_rts(load_session(path))
+    except (OSError, csv.Error, UnicodeDecodeError) as e:
+        print(f"Skipping {path}: {e}")
+        return {}
+
+
+def collect_rts(paths, workers=None):
+    """Read every data file in paths on a process pool and pool the RTs per participant and condition."""
+    files = find_session_files(paths)
+    merged = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for session in pool.map(_load_rts, files, chunksize=16):
+            for key, modalities in session.items():
+                for modality, values in modalities.items():
+                    merged.setdefault(key, {}).setdefault(modality, []).extend(values)
+    return len(files), merged
+
+
+def pad_sorted(samples):
+    """Sort each sample into a row of a (B, N) array padded with inf; returns (array, counts)."""
+    counts = np.array([len(sample) for sample in samples], dtype=np.int64)
+    rows = np.full((len(samples), max(int(counts.max(initial=0)), 1)), np.inf)
+    for i, sample in enumerate(samples):
+        rows[i, :counts[i]] = np.sort(sample)
+    return rows, counts
+
+
+def _search_rows(rows, queries, side='right'):
+    """np.searchsorted of each row's queries (B, G) in that row of rows (B, N, ascending, finite)."""
+    base = min(rows.min(), queries.min())
+    span = max(rows.max(), queries.max()) - base + 1.0
+    offset = np.arange(len(rows))[:, None] * span
+    index = np.searchsorted((rows - base + offset).ravel(), (queries - base + offset).ravel(), side)
+    return index.reshape(queries.shape) - np.arange(len(rows))[:, None] * rows.shape[1]
+
+
+def ecdf(rows, counts, points):
+    """Empirical CDFs of inf-padded sorted rows, evaluated at points (B, G), all rows at once."""
+    finite = np.isfinite(points)
+    top = max(np.max(rows, initial=0, where=np.isfinite(rows)), np.max(points, initial=0, where=finite)) + 1.0
+    below = _search_rows(np.where(np.isfinite(rows), rows, top), np.where(finite, points, top))
+    return np.where(finite, np.minimum(below, counts[:, None]) / np.maximum(counts, 1)[:, None], np.nan)
+
+
+def quantiles(rows, counts, probs):
+    """Per-row quantiles at probs (linear interpolation, as np.quantile), (B, P)."""
+    position = probs[None, :] * np.maximum(counts - 1, 0)[:, None]
+    low = np.floor(position).astype(np.int64)
+    high = np.minimum(low + 1, np.maximum(counts - 1, 0)[:, None])
+    fraction = position - low
+    values = np.where(np.isfinite(rows), rows, 0.0)
+    result = (np.take_along_axis(values, low, axis=1) * (1 - fraction)
+              + np.take_along_axis(values, high, axis=1) * fraction)
+    return np.where(counts[:, None] > 0, result, np.nan)
+
+
+def bound_quantiles(audio, audio_n, visual, visual_n, probs):
+    """Quantiles of the race bound min(1, F_A + F_V): the first RT at which it reaches each prob."""
+    pooled = np.sort(np.concatenate([audio, visual], axis=1), axis=1)
+    bound = ecdf(audio, audio_n, pooled) + ecdf(visual, visual_n, pooled)
+    # The bound reaches 2 at the last real RT, so padded positions are never chosen
+    bound = np.where(np.isfinite(pooled), bound, 2.0)
+    # A bound equal to prob reaches it; the tolerance absorbs rounding in the row offsets
+    targets = np.broadcast_to(probs - 1e-9, (len(bound), len(probs)))
+    index = _search_rows(bound, targets, side='left')
+    return np.take_along_axis(pooled, np.minimum(index, pooled.shape[1] - 1), axis=1)
+
+
+def race_gaps(curves, probs):
+    """Bound minus audiovisual quantile (ms) at probs for every curve, (B, P).
+
+    curves is a list of {modality: RTs} dicts. Positive gaps are race-model
+    violations (audiovisual responses faster than any race allows).
+    """
+    padded = {modality: pad_sorted([curve[modality] for curve in curves]) for modality in MODALITIES}
+    audiovisual = quantiles(*padded['audiovisual'], probs)
+    bound = bound_quantiles(*padded['audio'], *padded['visual'], probs)
+    return bound - audiovisual
+
+
+def permutation_test(gaps, n_perm=10000, rng=None):
+    """One-sided sign-flip tmax permutation test of gaps (participants, percentiles) > 0.
+
+    Returns (t per percentile, familywise-corrected p per percentile).
+    """
+    rng = rng or np.random.default_rng()
+    participants = len(gaps)
+    sum_squares = (gaps ** 2).sum(axis=0)
+
+    def t_values(signs):
+        means = signs @ gaps / participants
+        variance = np.maximum((sum_squares - participants * means ** 2) / (participants - 1), 1e-12)
+        return means / np.sqrt(variance / participants)
+
+    t_observed = t_values(np.ones((1, participants)))[0]
+    exceed = np.zeros(len(t_observed))
+    for start in range(0, n_perm, PERMUTATION_BATCH):
+        signs = rng.choice((-1.0, 1.0), size=(min(PERMUTATION_BATCH, n_perm - start), participants))
+        t_max = t_values(signs).max(axis=1)
+        exceed += (t_max[:, None] >= t_observed[None, :]).sum(axis=0)
+    return t_observed, (exceed + 1) / (n_perm + 1)
+
+
+def analyse(rts, test_percentiles=TEST_PERCENTILES, n_perm=10000, min_trials=MIN_TRIALS, seed=None):
+    """Race-model results for the pooled RTs from collect_rts.
+
+    Returns (curve rows, test rows) as lists of dicts (CURVE_FIELDS,
+    TEST_FIELDS). Conditions with fewer than min_trials trials in any
+    modality are listed without results and left out of the tests.
+    """
+    keys = sorted(rts)
+    usable = [key for key in keys if all(len(rts[key].get(m, ())) >= min_trials for m in MODALITIES)]
+    test_probs = np.asarray(test_percentiles, dtype=np.float64) / 100
+    probs = np.concatenate([AREA_PROBS, test_probs])
+    gaps = race_gaps([rts[key] for key in usable], probs) if usable else np.empty((0, len(probs)))
+    area_gaps, test_gaps = gaps[:, :len(AREA_PROBS)], gaps[:, len(AREA_PROBS):]
+    results = dict(zip(usable, range(len(usable))))
+
+    curve_rows = []
+    for key in keys:
+        participant, experiment, condition = key
+        row = {'participant': participant, 'experiment': experiment, 'condition': condition}
+        row.update({f'{m}_trials': len(rts[key].get(m, ())) for m in MODALITIES})
+        if key in results:
+            gap = area_gaps[results[key]]
+            row.update({'violation_area': float(np.maximum(gap, 0).sum() / len(AREA_PROBS)),
+                        'max_violation': float(gap.max()),
+                        'max_violation_percentile': float(AREA_PROBS[gap.argmax()] * 100)})
+        curve_rows.append(row)
+
+    test_rows = []
+    rng = np.random.default_rng(seed)
+    for experiment, condition in sorted({key[1:] for key in usable}):
+        members = [results[key] for key in usable if key[1:] == (experiment, condition)]
+        if len(members) < 2:
+            continue
+        t_observed, p_corrected = permutation_test(test_gaps[members], n_perm, rng)
+        for i, percentile in enumerate(test_percentiles):
+            test_rows.append({'experiment': experiment, 'condition': condition, 'participants': len(members),
+                              'percentile': percentile, 'mean_violation': float(test_gaps[members, i].mean()),
+                              't': float(t_observed[i]), 'p_corrected': float(p_corrected[i])})
+    return curve_rows, test_rows
+
+
+def write_rows(rows, fields, output_path):
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Race-model inequality analysis of SRT and SRT_Mod sessions")
+    parser.add_argument('paths', nargs='+', help="Data files, directories or glob patterns")
+    parser.add_argument('--percentiles', type=float, nargs='+', default=list(TEST_PERCENTILES),
+                        help="Percentiles tested at group level")
+    parser.add_argument('--permutations', type=int, default=10000, help="Sign-flip permutations per test")
+    parser.add_argument('--min-trials', type=int, default=MIN_TRIALS, help="Fewest trials per modality")
+    parser.add_argument('--workers', type=int, default=None, help="Processes reading data files")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for the permutations")
+    parser.add_argument('--output', default='race_model.csv', help="Per-participant results CSV file")
+    parser.add_argument('--tests-output', default='race_model_tests.csv', help="Group test results CSV file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    sessions, rts = collect_rts(args.paths, args.workers)
+    if not rts:
+        print("No SRT trials found")
+        return 1
+    print(f"Loaded {len(rts)} participant conditions from {sessions} sessions in {time.perf_counter() - start:.1f}s")
+
+    curve_rows, test_rows = analyse(rts, args.percentiles, args.permutations, args.min_trials, args.seed)
+    write_rows(curve_rows, CURVE_FIELDS, args.output)
+    write_rows(test_rows, TEST_FIELDS, args.tests_output)
+    print(f"Wrote {len(curve_rows)} conditions to {args.output} and {len(test_rows)} tests to "
+          f"{args.tests_output} in {time.perf_counter() - start:.1f}s")
+    for row in test_rows:
+        print(f"  {row['experiment']} {row['condition']} {row['percentile']:g}%: "
+              f"violation {row['mean_violation']:.1f}ms, t={row['t']:.2f}, p={row['p_corrected']:.4f}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
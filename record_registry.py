@@ -0,0 +1,123 @@
+"""
+Locally persisted registry of the REDCap record IDs of a project.
+
+Finding the next free participant ID used to mean exporting every record on
+each launch. The registry keeps the known record IDs, their highest numeric
+value and the time of the last export in redcap_record_ids.json. A refresh
+only asks REDCap for records created or modified since then
+(dateRangeBegin), so it costs as much as the new records, not the project.
+A full export is made only when the cache is cold: no file yet, an
+unreadable one, or one written for different credentials.
+
+    registry = RecordRegistry(api_url, api_token)
+    registry.refresh(project)
+    registry.next_id()   # '042'
+
+The incremental window starts REFRESH_OVERLAP before the last export. The
+date range is compared against the server's clock and time zone, so the
+overlap covers any difference between the two clocks; records seen twice
+are simply merged. Deleted records stay in the registry, which keeps their
+IDs from being handed out again. Saving merges with the file on disk, so
+the configuration GUI and the offline sync can share one registry.
+"""
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+REGISTRY_FILE = 'redcap_record_ids.json'
+# Covers the largest offset between the local and the server clock
+REFRESH_OVERLAP = timedelta(days=1)
+
+
+def _id_key(record_id):
+    return (0, int(record_id), '') if record_id.isdigit() else (1, 0, record_id)
+
+
+class RecordRegistry:
+    """Known record IDs of one project, refreshed incrementally.
+
+    Parameters:
+    -----------
+    api_url : str
+        REDCap API URL
+    api_token : str
+        API token; only a hash of URL and token is stored, to tell projects apart
+    directory : str
+        Directory holding REGISTRY_FILE
+    """
+
+    def __init__(self, api_url, api_token, directory='.'):
+        self.path = os.path.join(directory, REGISTRY_FILE)
+        self.project = hashlib.sha256(f"{api_url}\n{api_token}".encode('utf-8')).hexdigest()[:16]
+        self.record_ids = set()
+        self.max_id = 0
+        self.exported = None  # Local time the last export started
+        data = self._read()
+        if data:
+            self.record_ids = set(data['record_ids'])
+            self.max_id = data['max_id']
+            self.exported = datetime.fromisoformat(data['exported'])
+
+    def _read(self):
+        """The saved registry of this project, or None."""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('project') == self.project:
+                datetime.fromisoformat(data['exported'])
+                return data
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    @property
+    def cold(self):
+        return self.exported is None
+
+    def add(self, record_ids):
+        """Record IDs known to exist, e.g. records just created."""
+        for record_id in record_ids:
+            record_id = str(record_id)
+            self.record_ids.add(record_id)
+            if record_id.isdigit():
+                self.max_id = max(self.max_id, int(record_id))
+
+    def refresh(self, project, full=False):
+        """Fetch records created or changed since the last export (all records when cold or full).
+
+        project is a redcap_client.RedcapClient. Returns the number of records
+        exported.
+        """
+        started = datetime.now().replace(microsecond=0)
+        begin = None if (full or self.cold) else self.exported - REFRESH_OVERLAP
+        start = time.perf_counter()
+        records = project.export_records(fields=['record_id'], date_range_begin=begin)
+        self.add(record['record_id'] for record in records)
+        self.exported = started
+        self.save()
+        print(f"{'Incremental' if begin else 'Full'} REDCap ID refresh: {len(records)} records in "
+              f"{(time.perf_counter() - start) * 1000:.0f}ms, highest ID {self.max_id}")
+        return len(records)
+
+    def next_id(self):
+        return str(self.max_id + 1).zfill(3)
+
+    def sorted_ids(self):
+        """Known IDs, numeric ones first in numeric order."""
+        return sorted(self.record_ids, key=_id_key)
+
+    def save(self):
+        if self.cold:
+            return  # Without a full export the IDs are incomplete; saving them would hide that
+        # Merge with whatever another process saved meanwhile
+        data = self._read()
+        if data:
+            self.add(data['record_ids'])
+            self.exported = max(self.exported, datetime.fromisoformat(data['exported']))
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'project': self.project, 'max_id': self.max_id, 'exported': self.exported.isoformat(),
+                       'record_ids': self.sorted_ids()}, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,225 @@
+"""
+Shared REDCap API client for the runner, the upload worker, the offline sync
+and the configuration GUI.
+
+RedcapClient speaks the REDCap API directly over one requests.Session per
+process, so every call reuses pooled keep-alive connections instead of
+opening a new TCP/TLS connection. Nothing is fetched on construction;
+project metadata is only requested the first time it is used and then kept.
+Only the API calls this suite makes are covered; method names follow the
+REDCap API, but the arguments are this module's own (date_range_begin,
+file_content), so a PyCap Project cannot be passed in its place.
+
+Every API call is timed and counted per request type in client.metrics, and
+the total shows up in the logs:
+
+    export_records: 3 calls, 0 errors, 412.0ms total, 187.2ms max, 1.2kB sent, 48.0kB received
+
+get_client() returns the one client per (url, token) of the process. Set
+MSI_REDCAP_STANDIN to the URL of a local stand-in server (see
+redcap_standin.py) to send every client there instead, for testing without a
+real project.
+"""
+import gzip
+import json
+import os
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT = 30.0
+POOL_SIZE = 4
+STANDIN_ENV = 'MSI_REDCAP_STANDIN'
+GZIP_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'}
+
+_session = None
+_clients = {}
+_session_lock = threading.Lock()
+_clients_lock = threading.Lock()
+
+
+class RedcapError(Exception):
+    """The REDCap API rejected a request.
+
+    Parameters:
+    -----------
+    message : str
+        Description of the failure
+    status : int
+        HTTP status of the reply (None if there was none)
+    body : str
+        Start of the reply body
+    """
+
+    def __init__(self, message, status=None, body=''):
+        super().__init__(message)
+        self.status = status
+        self.body = body
+
+
+def shared_session():
+    """The process-wide keep-alive session used by every client."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+class RequestMetrics:
+    """Call counts, errors, time and bytes per request type."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}  # name -> {'calls', 'errors', 'seconds', 'max_seconds', 'sent', 'received'}
+
+    def record(self, name, seconds, sent, received, error=False):
+        with self._lock:
+            entry = self.calls.setdefault(name, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                 'sent': 0, 'received': 0})
+            entry['calls'] += 1
+            entry['errors'] += int(error)
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['sent'] += sent
+            entry['received'] += received
+
+    def total(self):
+        with self._lock:
+            return (sum(entry['calls'] for entry in self.calls.values()),
+                    sum(entry['seconds'] for entry in self.calls.values()))
+
+    def summary(self):
+        with self._lock:
+            lines = [f"{name}: {e['calls']} calls, {e['errors']} errors, {e['seconds'] * 1000:.1f}ms total, "
+                     f"{e['max_seconds'] * 1000:.1f}ms max, {e['sent'] / 1000:.1f}kB sent, "
+                     f"{e['received'] / 1000:.1f}kB received"
+                     for name, e in sorted(self.calls.items())]
+        return '\n'.join(lines) if lines else "no REDCap calls"
+
+
+class RedcapClient:
+    """REDCap API calls over the shared keep-alive session.
+
+    Parameters:
+    -----------
+    url : str
+        API URL, e.g. https://redcap.example.org/api/
+    token : str
+        Project API token
+    timeout : float
+        Seconds before a request gives up
+    session : requests.Session
+        Session to use instead of the shared one
+    """
+
+    def __init__(self, url, token, timeout=DEFAULT_TIMEOUT, session=None):
+        self.url = os.environ.get(STANDIN_ENV) or url
+        self.token = token
+        self.timeout = timeout
+        self.session = session or shared_session()
+        self.metrics = RequestMetrics()
+        self._metadata = None
+        self.compression_rejected = False  # The server refused a gzip request body
+
+    def _call(self, name, payload, files=None, compress=False):
+        data = {'token': self.token, 'returnFormat': 'json'}
+        data.update(payload)
+        if compress and not files and not self.compression_rejected:
+            try:
+                return self._post(name, gzip.compress(urlencode(data).encode('utf-8')), headers=GZIP_HEADERS)
+            except RedcapError as e:
+                # A server that does not decode gzip bodies sees an empty form (no token, no
+                # content) and answers with some 4xx; the plain retry shows whether it was that
+                if e.status is None or not 400 <= e.status < 500:
+                    raise
+                self.compression_rejected = True
+                print(f"REDCap did not accept a compressed request, sending uncompressed from now on: {e}")
+        return self._post(name, data, files)
+
+    def _post(self, name, data, files=None, headers=None):
+        sent = len(data) if isinstance(data, bytes) else sum(len(str(value)) for value in data.values())
+        if files:
+            sent += sum(len(content) for _, content in files.values())
+        start = time.perf_counter()
+        try:
+            response = self.session.post(self.url, data=data, files=files, headers=headers, timeout=self.timeout)
+        except requests.RequestException:
+            self.metrics.record(name, time.perf_counter() - start, sent, 0, error=True)
+            raise
+        self.metrics.record(name, time.perf_counter() - start, sent, len(response.content),
+                            error=response.status_code >= 400)
+        if response.status_code >= 400:
+            raise RedcapError(f"{name} failed ({response.status_code}): {response.text[:500]}",
+                              response.status_code, response.text[:500])
+        return response.json() if response.content else None
+
+    @property
+    def metadata(self):
+        """Data dictionary, fetched on first use."""
+        if self._metadata is None:
+            self._metadata = self.export_metadata()
+        return self._metadata
+
+    @property
+    def def_field(self):
+        """Name of the record ID field."""
+        return self.metadata[0]['field_name']
+
+    @property
+    def field_names(self):
+        return [field['field_name'] for field in self.metadata]
+
+    def export_metadata(self):
+        return self._call('export_metadata', {'content': 'metadata', 'format': 'json'})
+
+    def export_project_info(self):
+        return self._call('export_project_info', {'content': 'project', 'format': 'json'})
+
+    def export_records(self, records=None, fields=None, date_range_begin=None, date_range_end=None,
+                       filter_logic=None):
+        """Records as a list of dicts. date_range_begin/end are datetimes or 'YYYY-MM-DD HH:MM:SS'
+        strings and limit the export to records created or modified in that range; filter_logic
+        is a REDCap logic expression rows must match."""
+        payload = {'content': 'record', 'format': 'json', 'type': 'flat'}
+        if filter_logic:
+            payload['filterLogic'] = filter_logic
+        for key, values in (('records', records), ('fields', fields)):
+            for i, value in enumerate(values or ()):
+                payload[f'{key}[{i}]'] = value
+        for key, value in (('dateRangeBegin', date_range_begin), ('dateRangeEnd', date_range_end)):
+            if value is not None:
+                payload[key] = value if isinstance(value, str) else value.strftime('%Y-%m-%d %H:%M:%S')
+        return self._call('export_records', payload)
+
+    def import_records(self, to_import, overwrite='normal', return_content='count', compress=False):
+        """Import a list of record dicts. With compress the request body is gzipped; a 4xx reply
+        to it makes this and every later request go out plain."""
+        payload = {'content': 'record', 'format': 'json', 'type': 'flat', 'overwriteBehavior': overwrite,
+                   'returnContent': return_content, 'data': json.dumps(to_import)}
+        return self._call('import_records', payload, compress=compress)
+
+    def import_file(self, record, field, file_name, file_content, event=None, repeat_instance=None):
+        payload = {'content': 'file', 'action': 'import', 'record': record, 'field': field}
+        if event is not None:
+            payload['event'] = event
+        if repeat_instance is not None:
+            payload['repeat_instance'] = repeat_instance
+        if isinstance(file_content, str):
+            file_content = file_content.encode('utf-8')
+        return self._call('import_file', payload, files={'file': (file_name, file_content)})
+
+
+def get_client(url, token, timeout=DEFAULT_TIMEOUT):
+    """The process's client for (url, token), created on first use."""
+    with _clients_lock:
+        client = _clients.get((url, token))
+        if client is None:
+            client = _clients[(url, token)] = RedcapClient(url, token, timeout)
+        return client
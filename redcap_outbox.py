@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+"""
+Persistent outbox for REDCap file uploads and the background worker that drains it.
+
+The runner only writes a small JSON job into the outbox directory and makes
+sure a worker process is running, so the experiment never waits on the
+network. The worker is a separate process (it does not share the runner's
+GIL). It uploads due jobs, retries failures with exponential backoff and
+exits when the outbox is empty. Jobs stay on disk until they succeed, so
+uploads survive crashes of either process and resume on the next launch. A
+job that still fails after MAX_ATTEMPTS tries (a wrong field name, a revoked
+token) is moved to the failed/ subdirectory, where --status lists it, and
+--retry-failed queues it again once the cause is fixed.
+
+An upload manifest in the outbox directory remembers the content hash and
+size of every file already sent, so unchanged files are never uploaded twice.
+Growing data files can also be sent as per-block segments (the bytes added
+since the last upload) to a file field on a repeating instrument; the
+manifest lists each segment's offset, length and hash so the full file can be
+rebuilt from the server-side attachments. Trial jobs send a data file's
+trials as repeating-instrument records instead (see redcap_trial_import.py).
+
+    python redcap_outbox.py [outbox_dir]            # drain the outbox now
+    python redcap_outbox.py [outbox_dir] --status   # show pending jobs
+    python redcap_outbox.py [outbox_dir] --manifest # show what was uploaded
+    python redcap_outbox.py [outbox_dir] --retry-failed
+"""
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+OUTBOX_DIR = 'redcap_outbox'
+LOCK_FILE = 'worker.lock'
+LOG_FILE = 'worker.log'
+MANIFEST_FILE = 'upload_manifest.json'
+# A worker that has not touched its lock for this long is considered dead
+LOCK_STALE_SECONDS = 30.0
+BACKOFF_BASE_SECONDS = 5.0
+BACKOFF_MAX_SECONDS = 600.0
+# A job that has failed this many times (about six hours of retries) is moved to FAILED_DIR
+MAX_ATTEMPTS = 15
+FAILED_DIR = 'failed'
+
+
+def backoff_delay(attempts):
+    """Seconds to wait before retrying a job that has failed attempts times."""
+    return min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** max(0, attempts - 1))
+
+
+class UploadOutbox:
+    """Directory of pending upload jobs, one JSON file per job."""
+
+    def __init__(self, directory=OUTBOX_DIR):
+        self.directory = os.path.abspath(directory)
+
+    def _job_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _write(self, job):
+        # Write-then-rename so a crash never leaves a half-written job
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self._job_path(job['id']) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f, indent=2)
+        os.replace(tmp_path, self._job_path(job['id']))
+
+    def jobs(self, directory=None):
+        """All pending jobs (or those in directory), oldest first."""
+        directory = directory or self.directory
+        jobs = []
+        if not os.path.isdir(directory):
+            return jobs
+        for name in os.listdir(directory):
+            if not name.endswith('.json') or name == MANIFEST_FILE:
+                continue
+            try:
+                with open(os.path.join(directory, name), 'r') as f:
+                    jobs.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # Removed or being replaced by the worker
+        return sorted(jobs, key=lambda job: job['created'])
+
+    def failed_jobs(self):
+        """Jobs given up on after MAX_ATTEMPTS failures."""
+        return self.jobs(os.path.join(self.directory, FAILED_DIR))
+
+    def retry_failed(self):
+        """Queue every failed job again with a fresh attempt count. Returns how many were queued."""
+        failed = self.failed_jobs()
+        for job in failed:
+            job.update(attempts=0, next_attempt=time.time())
+            self._write(job)
+            os.remove(os.path.join(self.directory, FAILED_DIR, f"{job['id']}.json"))
+        return len(failed)
+
+    def enqueue(self, file_path, record_id, field, segment_instrument=None):
+        """Queue file_path for upload to record_id/field. Returns the job id.
+
+        Without segment_instrument the whole file is uploaded (and skipped if
+        its content was already sent). A job still waiting for the same
+        record, field and file is reused, so repeated uploads of a growing
+        file collapse into one.
+
+        With segment_instrument, only the bytes appended since the previous
+        segment, up to the file's current size, are uploaded as a new
+        instance of that repeating instrument.
+        """
+        file_path = os.path.abspath(file_path)
+        if segment_instrument:
+            job = self._new_job(file_path, record_id, field)
+            job['mode'] = 'segment'
+            job['instrument'] = segment_instrument
+            job['end_offset'] = os.path.getsize(file_path)
+            self._write(job)
+            return job['id']
+
+        for job in self.jobs():
+            if (job.get('mode', 'full') == 'full' and
+                    (job['record_id'], job['field'], job['file_path']) == (record_id, field, file_path)):
+                job['next_attempt'] = min(job['next_attempt'], time.time())
+                self._write(job)
+                return job['id']
+
+        job = self._new_job(file_path, record_id, field)
+        self._write(job)
+        return job['id']
+
+    def enqueue_trials(self, file_path, record_id, instrument, chunk_size, compress=False):
+        """Queue the file's trials not yet sent for import as instances of instrument. Returns the job id.
+
+        A waiting job for the same record and file is reused; it sends every
+        unsent trial when it runs.
+        """
+        file_path = os.path.abspath(file_path)
+        for job in self.jobs():
+            if job.get('mode') == 'trials' and (job['record_id'], job['file_path']) == (record_id, file_path):
+                job['next_attempt'] = min(job['next_attempt'], time.time())
+                self._write(job)
+                return job['id']
+
+        job = self._new_job(file_path, record_id, instrument)
+        job.update(mode='trials', chunk_size=chunk_size, compress=compress)
+        self._write(job)
+        return job['id']
+
+    def _new_job(self, file_path, record_id, field):
+        return {
+            'id': f"{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}",
+            'file_path': file_path,
+            'file_name': os.path.basename(file_path),
+            'record_id': record_id,
+            'field': field,
+            'created': time.time(),
+            'attempts': 0,
+            'next_attempt': time.time(),
+            'last_error': None,
+            'mode': 'full',
+        }
+
+    def complete(self, job):
+        try:
+            os.remove(self._job_path(job['id']))
+        except FileNotFoundError:
+            pass
+
+    def fail(self, job, error):
+        """Record a failed attempt. Returns False if the job has now been given up on."""
+        job['attempts'] += 1
+        job['last_error'] = str(error)
+        job['next_attempt'] = time.time() + backoff_delay(job['attempts'])
+        self._write(job)
+        if job['attempts'] < MAX_ATTEMPTS:
+            return True
+        failed_dir = os.path.join(self.directory, FAILED_DIR)
+        os.makedirs(failed_dir, exist_ok=True)
+        os.replace(self._job_path(job['id']), os.path.join(failed_dir, f"{job['id']}.json"))
+        return False
+
+    def status(self):
+        """Summary of the outbox for display: counts and the latest error."""
+        jobs = self.jobs()
+        failing = [job for job in jobs if job['attempts']]
+        return {
+            'pending': len(jobs),
+            'retrying': len(failing),
+            'last_error': failing[-1]['last_error'] if failing else None,
+            'failed': len(self.failed_jobs()),
+            'worker_running': worker_alive(self.directory),
+        }
+
+
+class UploadManifest:
+    """Record of what has been uploaded, keyed by record, field and file.
+
+    Each entry holds the sha256 and size of the last full upload and the list
+    of segments sent so far (instance, offset, length, sha256, file_name,
+    series). next_instance starts after the record's existing segment
+    instances, from any session, and keeps counting up; a file rewritten from
+    the start begins a new series of segments while earlier ones stay listed,
+    so no instance on the server is ever overwritten. Only the worker writes
+    it, while holding the worker lock.
+    """
+
+    def __init__(self, directory=OUTBOX_DIR):
+        self.path = os.path.join(os.path.abspath(directory), MANIFEST_FILE)
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Could not read upload manifest, starting a new one: {e}")
+
+    @staticmethod
+    def key(job):
+        return f"{job['record_id']}|{job['field']}|{job['file_path']}"
+
+    def entry(self, job):
+        return self.entries.setdefault(self.key(job), {
+            'file_name': job['file_name'], 'record_id': job['record_id'], 'field': job['field'],
+            'sha256': None, 'size': 0, 'segments': [],
+        })
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def _read_range(file_path, offset=0, end=None):
+    """Read bytes [offset, end) of a file and return (content, sha256 hex)."""
+    with open(file_path, 'rb') as file_obj:
+        file_obj.seek(offset)
+        content = file_obj.read() if end is None else file_obj.read(max(0, end - offset))
+    return content, hashlib.sha256(content).hexdigest()
+
+
+def upload_job(project, job, manifest):
+    """Send the job's file (or its next segment, or its unsent trials) unless it is already on the server.
+
+    Returns a short description of what was done.
+    """
+    if job.get('mode') == 'trials':
+        from redcap_trial_import import CHECKPOINT_DIR, push_trials
+        checkpoint_dir = os.path.join(os.path.dirname(manifest.path), CHECKPOINT_DIR)
+        return push_trials(project, job['file_path'], job['record_id'], job['field'], job['chunk_size'],
+                           checkpoint_dir, job.get('compress', False))
+
+    entry = manifest.entry(job)
+    if job.get('mode', 'full') == 'segment':
+        return _upload_segment(project, job, manifest, entry)
+
+    content, digest = _read_range(job['file_path'])
+    if digest == entry['sha256']:
+        return "unchanged, skipped"
+
+    project.import_records([{'record_id': job['record_id']}])
+    project.import_file(
+        record=job['record_id'],
+        field=job['field'],
+        file_name=job['file_name'],
+        file_content=content
+    )
+    entry.update(sha256=digest, size=len(content), uploaded=time.time())
+    manifest.save()
+    return f"uploaded {len(content)} bytes"
+
+
+def _series_segments(entry, series=None):
+    """Segments of one series (default: the current one), in the order they were sent."""
+    if series is None:
+        series = entry.get('series', 0)
+    return [segment for segment in entry['segments'] if segment.get('series', 0) == series]
+
+
+def _first_segment_instance(project, job, manifest):
+    """Instance number after every segment already on job's record, whichever file sent it.
+
+    Each session writes a new data file and so gets a new manifest entry;
+    both the server and the manifest's other entries for the record and field
+    are checked so a second session never reuses the first one's instances.
+    """
+    rows = project.export_records(records=[job['record_id']], fields=[job['field']])
+    instances = [int(row['redcap_repeat_instance']) for row in rows
+                 if row.get('redcap_repeat_instrument') == job['instrument'] and row.get('redcap_repeat_instance')]
+    instances += [other['next_instance'] - 1 for other in manifest.entries.values()
+                  if (other['record_id'], other['field']) == (job['record_id'], job['field'])
+                  and other.get('next_instance')]
+    return max(instances, default=0) + 1
+
+
+def _upload_segment(project, job, manifest, entry):
+    segments = entry['segments']
+    if not entry.get('next_instance'):
+        # Fixed before anything is sent, so a retry writes the same instances
+        entry['next_instance'] = _first_segment_instance(project, job, manifest)
+        manifest.save()
+    current = _series_segments(entry)
+    offset = current[-1]['offset'] + current[-1]['length'] if current else 0
+    if os.path.getsize(job['file_path']) < offset:
+        # The file was rewritten since the last segment; start a new series
+        # after the instances already on the server
+        print(f"{job['file_name']} shrank since its last segment, starting a new series of segments")
+        entry['series'] = entry.get('series', 0) + 1
+        offset = 0
+    if job['end_offset'] <= offset:
+        return "already covered by an earlier segment, skipped"
+
+    content, digest = _read_range(job['file_path'], offset, job['end_offset'])
+    instance = entry['next_instance']
+    root, ext = os.path.splitext(job['file_name'])
+    segment_name = f"{root}_seg{instance:03d}_{offset:010d}{ext}"
+
+    project.import_records([{'record_id': job['record_id'],
+                             'redcap_repeat_instrument': job['instrument'],
+                             'redcap_repeat_instance': instance}])
+    project.import_file(
+        record=job['record_id'],
+        field=job['field'],
+        file_name=segment_name,
+        file_content=content,
+        repeat_instance=instance
+    )
+    segments.append({'instance': instance, 'offset': offset, 'length': len(content),
+                     'sha256': digest, 'file_name': segment_name, 'series': entry.get('series', 0)})
+    entry['next_instance'] = instance + 1
+    manifest.save()
+    return f"uploaded segment {instance} ({len(content)} bytes from offset {offset})"
+
+
+def rebuild_from_segments(entry, segment_dir, output_path, series=None):
+    """Reassemble a file from downloaded segment attachments.
+
+    entry is the file's manifest entry; segment files are looked up by name
+    in segment_dir and checked against their recorded hashes. Only the
+    segments of series (default: the latest) are used.
+    """
+    with open(output_path, 'wb') as out:
+        for segment in sorted(_series_segments(entry, series), key=lambda seg: seg['offset']):
+            if out.tell() != segment['offset']:
+                raise ValueError(f"Gap before segment {segment['instance']} at offset {segment['offset']}")
+            content, digest = _read_range(os.path.join(segment_dir, segment['file_name']))
+            if digest != segment['sha256']:
+                raise ValueError(f"Segment {segment['file_name']} does not match its manifest hash")
+            out.write(content)
+    return output_path
+
+
+def worker_alive(directory=OUTBOX_DIR):
+    lock_path = os.path.join(directory, LOCK_FILE)
+    try:
+        return time.time() - os.path.getmtime(lock_path) < LOCK_STALE_SECONDS
+    except OSError:
+        return False
+
+
+def _acquire_lock(directory):
+    """Take the worker lock, replacing a stale one. Returns False if another worker holds it."""
+    lock_path = os.path.join(directory, LOCK_FILE)
+    if os.path.exists(lock_path) and not worker_alive(directory):
+        os.remove(lock_path)
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+    return True
+
+
+def _heartbeat(lock_path, stop):
+    """Touch the lock until stop is set, so a long upload never makes a live worker look stale."""
+    while not stop.wait(LOCK_STALE_SECONDS / 3):
+        try:
+            os.utime(lock_path)
+        except OSError:
+            pass
+
+
+def _release_lock(lock_path):
+    """Remove the lock, unless another worker has taken it over."""
+    try:
+        with open(lock_path, 'r') as f:
+            if f.read().strip() != str(os.getpid()):
+                return
+        os.remove(lock_path)
+    except OSError:
+        pass
+
+
+def _drain(outbox, project, manifest):
+    """Upload due jobs until the outbox is empty."""
+    while True:
+        jobs = outbox.jobs()
+        if not jobs:
+            return
+
+        now = time.time()
+        for job in [job for job in jobs if job['next_attempt'] <= now]:
+            if not os.path.exists(job['file_path']):
+                print(f"Dropping upload of missing file {job['file_path']}")
+                outbox.complete(job)
+                continue
+            try:
+                result = upload_job(project, job, manifest)
+                outbox.complete(job)
+                print(f"{job['file_name']} -> record {job['record_id']} ({job['field']}): {result}")
+            except Exception as e:
+                if outbox.fail(job, e):
+                    print(f"Upload of {job['file_name']} failed (attempt {job['attempts']}): {e}; "
+                          f"retrying in {backoff_delay(job['attempts']):.0f}s")
+                else:
+                    print(f"Upload of {job['file_name']} failed {job['attempts']} times, giving up: {e}; "
+                          f"moved to {os.path.join(outbox.directory, FAILED_DIR)}")
+
+        # Sleep until the next job is due, waking regularly to pick up new jobs
+        remaining = outbox.jobs()
+        if remaining:
+            wait = min(job['next_attempt'] for job in remaining) - time.time()
+            time.sleep(min(max(wait, 0.0), LOCK_STALE_SECONDS / 3))
+
+
+def run_worker(directory, api_url, api_token):
+    """Upload due jobs until the outbox is empty."""
+    from redcap_client import get_client
+
+    outbox = UploadOutbox(directory)
+    if not _acquire_lock(outbox.directory):
+        print("Another upload worker is already running.")
+        return
+    lock_path = os.path.join(outbox.directory, LOCK_FILE)
+    # One client for the worker's lifetime, so every upload reuses its open connections
+    project = get_client(api_url, api_token)
+    while True:
+        manifest = UploadManifest(outbox.directory)
+        # Heartbeat on its own thread: a single job may take longer than LOCK_STALE_SECONDS
+        stop_heartbeat = threading.Event()
+        threading.Thread(target=_heartbeat, args=(lock_path, stop_heartbeat), name="outbox-heartbeat",
+                         daemon=True).start()
+        try:
+            _drain(outbox, project, manifest)
+        finally:
+            stop_heartbeat.set()
+            _release_lock(lock_path)
+        # A job queued while the lock was still held saw a live worker and started none;
+        # jobs queued after the release start their own worker
+        if not outbox.jobs() or not _acquire_lock(outbox.directory):
+            break
+        print("New jobs arrived while exiting, continuing.")
+    print("Outbox empty, upload worker exiting.")
+    print(project.metrics.summary())
+
+
+def ensure_worker(api_url, api_token, directory=OUTBOX_DIR):
+    """Start a detached worker process unless one is already running."""
+    if worker_alive(directory):
+        return False
+    os.makedirs(directory, exist_ok=True)
+    env = dict(os.environ, MSI_REDCAP_URL=api_url, MSI_REDCAP_TOKEN=api_token)
+    kwargs = {}
+    if sys.platform == 'win32':
+        kwargs['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+    with open(os.path.join(directory, LOG_FILE), 'a') as log:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), directory],
+                         env=env, stdout=log, stderr=subprocess.STDOUT, **kwargs)
+    return True
+
+
+def _load_api_credentials(filename="api_text.txt"):
+    api_url = os.environ.get('MSI_REDCAP_URL')
+    api_token = os.environ.get('MSI_REDCAP_TOKEN')
+    if (not api_url or not api_token) and os.path.exists(filename):
+        with open(filename, 'r') as file:
+            for line in file:
+                key_value = line.strip().split('=')
+                if len(key_value) == 2:
+                    key, value = key_value
+                    if key == 'api_url':
+                        api_url = value
+                    elif key == 'api_token':
+                        api_token = value
+    return api_url, api_token
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drain the REDCap upload outbox")
+    parser.add_argument('directory', nargs='?', default=OUTBOX_DIR, help="Outbox directory")
+    parser.add_argument('--status', action='store_true', help="Show pending jobs and exit")
+    parser.add_argument('--manifest', action='store_true', help="Show the upload manifest and exit")
+    parser.add_argument('--retry-failed', action='store_true', help="Queue the jobs given up on again and exit")
+    args = parser.parse_args()
+
+    if args.retry_failed:
+        print(f"Queued {UploadOutbox(args.directory).retry_failed()} failed jobs again.")
+        return
+
+    if args.manifest:
+        for entry in UploadManifest(args.directory).entries.values():
+            print(f"{entry['file_name']} -> record {entry['record_id']} ({entry['field']}): "
+                  f"{entry['size']} bytes, sha256 {entry['sha256']}, {len(entry['segments'])} segments")
+        return
+
+    if args.status:
+        outbox = UploadOutbox(args.directory)
+        for job in outbox.jobs():
+            print(f"{job['file_name']} -> record {job['record_id']} ({job['field']}, {job.get('mode', 'full')}), "
+                  f"attempts: {job['attempts']}, last error: {job['last_error']}")
+        for job in outbox.failed_jobs():
+            print(f"FAILED {job['file_name']} -> record {job['record_id']} ({job['field']}), "
+                  f"gave up after {job['attempts']} attempts: {job['last_error']}")
+        print(outbox.status())
+        return
+
+    api_url, api_token = _load_api_credentials()
+    if not api_url or not api_token:
+        print("API credentials not found. Cannot upload.")
+        return 1
+    run_worker(args.directory, api_url, api_token)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+Local stand-in for the REDCap API, for testing uploads without a real project.
+
+Serves the subset of the API the suite uses (project info, metadata, record
+export and import, file import) from memory, optionally slowed down to
+mimic a remote server:
+
+    python redcap_standin.py --port 8765 --latency 80
+    MSI_REDCAP_STANDIN=http://127.0.0.1:8765/api/ python run_MSI_GUI_experiment.py
+
+Any token is accepted unless --token is given. Uploaded files are kept in
+memory, or written below --files-dir when it is set, and every request is
+logged with its duration. Gzip-compressed request bodies are accepted
+unless --no-gzip is given; then they arrive as an empty form, as on a
+server without a gzip input filter. filterLogic is ignored.
+"""
+import argparse
+import email.parser
+import email.policy
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+METADATA = [
+    {'field_name': 'record_id', 'form_name': 'participant', 'field_type': 'text'},
+    {'field_name': 'python_data_file', 'form_name': 'participant', 'field_type': 'file'},
+    {'field_name': 'demographic_data_file', 'form_name': 'participant', 'field_type': 'file'},
+]
+
+
+class StandinProject:
+    """In-memory records and files of the stand-in server.
+
+    Parameters:
+    -----------
+    files_dir : str
+        Directory uploaded files are written to (None keeps them in memory)
+    """
+
+    def __init__(self, files_dir=None):
+        self.lock = threading.Lock()
+        self.records = {}   # (record_id, repeat instrument or '', instance or 0) -> fields
+        self.modified = {}  # record_id -> datetime of last change
+        self.files = {}     # (record_id, field, instance) -> (file name, size)
+        self.files_dir = files_dir
+
+    def import_records(self, rows):
+        now = datetime.now()
+        with self.lock:
+            for row in rows:
+                record_id = str(row['record_id'])
+                key = (record_id, row.get('redcap_repeat_instrument', ''), int(row.get('redcap_repeat_instance') or 0))
+                self.records.setdefault(key, {}).update(row)
+                self.modified[record_id] = now
+        return len({str(row['record_id']) for row in rows})
+
+    def export_records(self, records=None, fields=None, begin=None, end=None):
+        with self.lock:
+            rows = []
+            for (record_id, instrument, instance), row in sorted(self.records.items()):
+                modified = self.modified[record_id]
+                if (records and record_id not in records) or (begin and modified < begin) or (end and modified > end):
+                    continue
+                row = {field: row.get(field, '') for field in fields} if fields else dict(row)
+                if instrument:
+                    row.update(redcap_repeat_instrument=instrument, redcap_repeat_instance=instance)
+                rows.append(row)
+            return rows
+
+    def import_file(self, record_id, field, instance, file_name, content):
+        if self.files_dir:
+            directory = os.path.join(self.files_dir, record_id, field)
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f"{instance or 1}_{file_name}"), 'wb') as f:
+                f.write(content)
+        with self.lock:
+            self.files[(record_id, field, instance)] = (file_name, len(content))
+            if not instance:
+                # Record exports show a file field as the name of its file
+                self.records.setdefault((record_id, '', 0), {'record_id': record_id})[field] = file_name
+            self.modified[record_id] = datetime.now()
+
+
+def _parse_time(value):
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S') if value else None
+
+
+def _indexed(fields, name):
+    """Values of name[0], name[1], ... in form order."""
+    keys = sorted((key for key in fields if key.startswith(name + '[')), key=lambda key: int(key[len(name) + 1:-1]))
+    return [fields[key] for key in keys]
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    server_version = 'REDCapStandin/1.0'
+    protocol_version = 'HTTP/1.1'  # Keep connections open, as a real server does
+    disable_nagle_algorithm = True  # Headers and body go out as separate writes
+
+    def _form(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            if not self.server.accept_gzip:
+                return {}, None  # Like a server without an input filter: the form looks empty
+            body = gzip.decompress(body)
+        content_type = self.headers.get('Content-Type', '')
+        if not content_type.startswith('multipart/form-data'):
+            return {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}, None
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        fields, upload = {}, None
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename() is not None:
+                upload = (part.get_filename(), part.get_payload(decode=True))
+            else:
+                fields[name] = part.get_payload(decode=True).decode('utf-8')
+        return fields, upload
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        start = time.perf_counter()
+        fields, upload = self._form()
+        time.sleep(self.server.latency)
+        status, payload = self._handle(fields, upload)
+        self._reply(status, payload)
+        self.log_message('%s %s -> %d in %.1fms', fields.get('content'), fields.get('action', ''), status,
+                         (time.perf_counter() - start) * 1000)
+
+    def _handle(self, fields, upload):
+        project = self.server.project
+        if self.server.token and fields.get('token') != self.server.token:
+            return 403, {'error': 'You do not have permissions to use the API'}
+        content = fields.get('content')
+        if content == 'project':
+            return 200, {'project_id': 1, 'project_title': 'MSI stand-in project'}
+        if content == 'metadata':
+            return 200, METADATA
+        if content == 'version':
+            return 200, '13.0.0'
+        if content == 'record' and 'data' in fields:
+            count = project.import_records(json.loads(fields['data']))
+            return 200, {'count': count}
+        if content == 'record':
+            return 200, project.export_records(_indexed(fields, 'records'), _indexed(fields, 'fields'),
+                                               _parse_time(fields.get('dateRangeBegin')),
+                                               _parse_time(fields.get('dateRangeEnd')))
+        if content == 'file' and fields.get('action') == 'import' and upload:
+            project.import_file(fields['record'], fields['field'], fields.get('repeat_instance'), *upload)
+            return 200, {}
+        return 400, {'error': f"Unsupported request: content={content} action={fields.get('action')}"}
+
+
+def serve(host='127.0.0.1', port=8765, latency=0.0, token=None, files_dir=None, accept_gzip=True):
+    """Start the stand-in server; returns the ThreadingHTTPServer (call serve_forever on it)."""
+    server = ThreadingHTTPServer((host, port), StandinHandler)
+    server.project = StandinProject(files_dir)
+    server.latency = latency
+    server.token = token
+    server.accept_gzip = accept_gzip
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the REDCap API")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8765, help="Port to listen on")
+    parser.add_argument('--latency', type=float, default=0.0, help="Milliseconds added to every request")
+    parser.add_argument('--token', help="Only accept this API token")
+    parser.add_argument('--files-dir', help="Write uploaded files below this directory")
+    parser.add_argument('--no-gzip', action='store_true', help="Reject gzip-compressed request bodies")
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.latency / 1000, args.token, args.files_dir, not args.no_gzip)
+    print(f"REDCap stand-in listening on http://{args.host}:{server.server_port}/api/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
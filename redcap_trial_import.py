@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Send trial data to REDCap as records of a repeating instrument.
+
+Normally the data file only reaches REDCap as an attachment, which the
+server cannot query. With "redcap_trial_instrument" set in the configuration,
+each block's trials are also sent by the upload worker as instances of that
+repeating instrument on the participant's record: one instance per trial,
+one field per data file column (TRIAL_FIELDS), and the data file name in
+tr_session. Central analysis can then export only the rows and fields it
+needs (export_trials).
+
+Rows are sent with import_records in chunks of "redcap_trial_chunk_size"
+(CHUNK_SIZE by default). With "redcap_compress": true each request body is
+gzipped. Most servers do not accept that, so the client falls back to plain
+requests once one is refused. A checkpoint per data file records the first
+instance number and how many rows have been sent, so an interrupted push
+resumes with the next chunk. Re-sending a chunk writes the same instances
+again, so a crash between a chunk and its checkpoint does no harm.
+
+The instrument has to exist in the project and be enabled as a repeating
+instrument (Project Setup, "Repeatable instruments and events"). REDCap's
+data dictionary upload replaces the project's whole dictionary, so
+
+    python redcap_trial_import.py --data-dictionary trial_data.csv
+
+exports the project's current dictionary and writes it with the trial
+instrument's fields appended (replacing any earlier version of them), ready
+to upload in the Data Dictionary page. Push a file by hand with
+
+    python redcap_trial_import.py data_001_25_m_vandy_20231115_123456.csv 001
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+
+import numpy as np
+
+from session_table import MISSING_INT, TRIAL_COLUMNS, TRIAL_DTYPE, load_trials, to_record
+
+TRIAL_INSTRUMENT = 'trial_data'
+CHUNK_SIZE = 500
+CHECKPOINT_DIR = 'trial_checkpoints'
+SESSION_FIELD = 'tr_session'
+# Data file column -> REDCap field; the prefix keeps them apart from demographic fields
+TRIAL_FIELDS = {column: 'tr_' + column.lower() for column in TRIAL_COLUMNS if column != 'Participant_ID'}
+
+
+def _value(value):
+    """One field as REDCap text; NaN and missing integers become empty."""
+    if isinstance(value, float):
+        return '' if math.isnan(value) else repr(value)
+    if isinstance(value, int) and value == MISSING_INT:
+        return ''
+    return str(value)
+
+
+def trial_rows(data_filename, record_id, instrument=TRIAL_INSTRUMENT, first_instance=1):
+    """The data file's trials as repeating-instrument rows for import_records."""
+    table = load_trials(data_filename)
+    columns = {field: table[column].tolist() for column, field in TRIAL_FIELDS.items()}
+    session = os.path.basename(data_filename)
+    rows = []
+    for i in range(len(table)):
+        row = {'record_id': record_id, 'redcap_repeat_instrument': instrument,
+               'redcap_repeat_instance': first_instance + i, SESSION_FIELD: session}
+        row.update({field: _value(values[i]) for field, values in columns.items()})
+        rows.append(row)
+    return rows
+
+
+def next_instance(project, record_id, instrument=TRIAL_INSTRUMENT):
+    """First instance number after the record's existing instances of instrument."""
+    # REDCap only returns an instrument's repeating rows when a field of that instrument is asked for
+    rows = project.export_records(records=[record_id], fields=['record_id', SESSION_FIELD])
+    instances = [int(row['redcap_repeat_instance']) for row in rows
+                 if row.get('redcap_repeat_instrument') == instrument and row.get('redcap_repeat_instance')]
+    return max(instances, default=0) + 1
+
+
+class TrialCheckpoint:
+    """How far the trials of one data file have been sent, saved after every chunk."""
+
+    def __init__(self, directory, data_filename, record_id, instrument):
+        name = f"{record_id}_{instrument}_{os.path.splitext(os.path.basename(data_filename))[0]}.json"
+        self.path = os.path.join(directory, name)
+        self.first_instance = None
+        self.sent = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self.first_instance = data['first_instance']
+            self.sent = data['sent']
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'first_instance': self.first_instance, 'sent': self.sent}, f)
+        os.replace(tmp_path, self.path)
+
+
+def push_trials(project, data_filename, record_id, instrument=TRIAL_INSTRUMENT, chunk_size=CHUNK_SIZE,
+                checkpoint_dir=CHECKPOINT_DIR, compress=False):
+    """Send the trials of data_filename not yet sent, chunk_size rows per request.
+
+    Returns a short description of what was done.
+    """
+    checkpoint = TrialCheckpoint(checkpoint_dir, data_filename, record_id, instrument)
+    if checkpoint.first_instance is None:
+        # Fixed before anything is sent, so a resumed push writes the same instances
+        checkpoint.first_instance = next_instance(project, record_id, instrument)
+        checkpoint.save()
+
+    rows = trial_rows(data_filename, record_id, instrument, checkpoint.first_instance)
+    if len(rows) < checkpoint.sent:
+        print(f"{os.path.basename(data_filename)} has fewer trials than were sent, sending all again")
+        checkpoint.sent = 0
+    if checkpoint.sent == len(rows):
+        return "no new trials"
+
+    start, chunks = checkpoint.sent, 0
+    for offset in range(start, len(rows), chunk_size):
+        chunk = rows[offset:offset + chunk_size]
+        project.import_records(chunk, compress=compress)
+        checkpoint.sent = offset + len(chunk)
+        checkpoint.save()
+        chunks += 1
+    return f"imported trials {start + 1}-{len(rows)} as {instrument} instances in {chunks} requests"
+
+
+def export_trials(project, records=None, instrument=TRIAL_INSTRUMENT, filter_logic=None):
+    """Trials stored in REDCap as a TRIAL_DTYPE array, for the given records (default: all).
+
+    filter_logic is passed to REDCap, e.g. "[tr_experiment] = 'SJ'", so only
+    matching rows are sent.
+    """
+    fields = ['record_id', SESSION_FIELD] + list(TRIAL_FIELDS.values())
+    rows = project.export_records(records=records, fields=fields, filter_logic=filter_logic)
+    rows = sorted((row for row in rows if row.get('redcap_repeat_instrument') == instrument),
+                  key=lambda row: (str(row['record_id']), int(row['redcap_repeat_instance'])))
+    records_out = [to_record([row['record_id']] + [row.get(field) for field in TRIAL_FIELDS.values()])
+                   for row in rows]
+    return np.array(records_out, dtype=TRIAL_DTYPE)
+
+
+# Data dictionary CSV columns and the export_metadata keys they hold
+DICTIONARY_COLUMNS = [
+    ('Variable / Field Name', 'field_name'), ('Form Name', 'form_name'), ('Section Header', 'section_header'),
+    ('Field Type', 'field_type'), ('Field Label', 'field_label'),
+    ('Choices, Calculations, OR Slider Labels', 'select_choices_or_calculations'), ('Field Note', 'field_note'),
+    ('Text Validation Type OR Show Slider Number', 'text_validation_type_or_show_slider_number'),
+    ('Text Validation Min', 'text_validation_min'), ('Text Validation Max', 'text_validation_max'),
+    ('Identifier?', 'identifier'), ('Branching Logic (Show field only if...)', 'branching_logic'),
+    ('Required Field?', 'required_field'), ('Custom Alignment', 'custom_alignment'),
+    ('Question Number (surveys only)', 'question_number'), ('Matrix Group Name', 'matrix_group_name'),
+    ('Matrix Ranking?', 'matrix_ranking'), ('Field Annotation', 'field_annotation'),
+]
+
+
+def trial_instrument_metadata(instrument=TRIAL_INSTRUMENT):
+    """Data dictionary entries (export_metadata format) of the trial instrument."""
+    validation = {'f': 'number', 'i': 'integer', 'U': ''}
+    fields = [{'field_name': SESSION_FIELD, 'form_name': instrument, 'field_type': 'text', 'field_label': 'Data file'}]
+    for column, field in TRIAL_FIELDS.items():
+        fields.append({'field_name': field, 'form_name': instrument, 'field_type': 'text',
+                       'field_label': column.replace('_', ' '),
+                       'text_validation_type_or_show_slider_number': validation[TRIAL_DTYPE[column].kind]})
+    return fields
+
+
+def write_data_dictionary(project, output_path, instrument=TRIAL_INSTRUMENT):
+    """Write the project's data dictionary with the trial instrument added, for the Data Dictionary upload.
+
+    The upload replaces the whole dictionary, so every existing field is kept
+    (the record ID field stays first) and an earlier version of the
+    instrument is replaced. Returns the number of fields written.
+    """
+    trial_fields = trial_instrument_metadata(instrument)
+    trial_names = {field['field_name'] for field in trial_fields}
+    fields = [field for field in project.export_metadata()
+              if field.get('form_name') != instrument and field['field_name'] not in trial_names]
+    fields += trial_fields
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([column for column, _ in DICTIONARY_COLUMNS])
+        for field in fields:
+            writer.writerow([field.get(key, '') for _, key in DICTIONARY_COLUMNS])
+    return len(fields)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a data file's trials to REDCap as repeating-instrument records")
+    parser.add_argument('data_file', nargs='?', help="Data file to send")
+    parser.add_argument('record_id', nargs='?', help="Participant's record ID")
+    parser.add_argument('--instrument', default=TRIAL_INSTRUMENT, help="Repeating instrument name")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="Rows per import_records request")
+    parser.add_argument('--compress', action='store_true', help="Gzip request bodies if the server accepts it")
+    parser.add_argument('--checkpoint-dir', default=CHECKPOINT_DIR, help="Directory for resume checkpoints")
+    parser.add_argument('--data-dictionary', metavar='CSV',
+                        help="Write the project's data dictionary with the instrument added and exit")
+    args = parser.parse_args()
+    if not args.data_dictionary and (not args.data_file or not args.record_id):
+        parser.error("data_file and record_id are required")
+
+    from redcap_client import get_client
+    from redcap_outbox import _load_api_credentials
+    api_url, api_token = _load_api_credentials()
+    if not api_url or not api_token:
+        print("API credentials not found.")
+        return 1
+    project = get_client(api_url, api_token)
+
+    if args.data_dictionary:
+        try:
+            count = write_data_dictionary(project, args.data_dictionary, args.instrument)
+        except Exception as e:
+            print(f"Could not export the project's data dictionary: {e}")
+            return 1
+        print(f"Wrote {count} fields, including the {args.instrument} instrument, to {args.data_dictionary}. "
+              f"Upload it on the Data Dictionary page and enable {args.instrument} as a repeating instrument.")
+        return 0
+    try:
+        print(push_trials(project, args.data_file, args.record_id, args.instrument, args.chunk_size,
+                          args.checkpoint_dir, args.compress))
+    except Exception as e:
+        print(f"Trial import failed: {e}")
+        return 1
+    finally:
+        print(project.metrics.summary())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
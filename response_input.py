@@ -0,0 +1,65 @@
+"""
+Hardware-timestamped response collection.
+
+ResponseInput wraps psychopy.hardware.keyboard.Keyboard. With the PTB backend
+that device keeps a background event queue, and every key-down carries the
+time the key went down, not the time Python got around to polling it.
+Reaction times are taken from those timestamps relative to a keyboard clock
+that is reset on the stimulus onset flip. Their resolution therefore no longer
+depends on the frame rate, and waiting for a response does not need a render
+loop.
+"""
+import math
+
+
+class ResponseInput:
+    """Key presses with hardware timestamps, relative to the last clock reset.
+
+    Parameters:
+    -----------
+    keyboard_module : module
+        psychopy.hardware.keyboard (or the virtual backend's stand-in)
+    core_module : module
+        psychopy.core, used for sleeping between polls
+    poll_interval : float
+        Seconds slept between polls while waiting; the timestamps do not
+        depend on it
+    """
+
+    def __init__(self, keyboard_module, core_module, poll_interval=0.005):
+        self.keyboard = keyboard_module.Keyboard()
+        self.core = core_module
+        self.poll_interval = poll_interval
+
+    def reset_on_flip(self, win):
+        """Make following reaction times relative to win's next flip."""
+        win.callOnFlip(self.keyboard.clock.reset)
+
+    def clear(self):
+        """Discard presses made so far."""
+        self.keyboard.clearEvents()
+
+    def poll(self, keys):
+        """Presses of keys since the last poll, as (name, rt) tuples.
+
+        rt is negative for presses made before the clock was reset.
+        """
+        return [(press.name, press.rt) for press in self.keyboard.getKeys(keyList=keys, waitRelease=False)]
+
+    def wait(self, keys, max_wait=math.inf, idle=None):
+        """Block until one of keys is pressed or max_wait seconds pass.
+
+        Returns the first (name, rt) press, or None on timeout. idle is called
+        between polls, e.g. to keep the window's event queue serviced.
+        """
+        deadline = self.core.getTime() + max_wait
+        while True:
+            presses = self.poll(keys)
+            if presses:
+                return presses[0]
+            if self.core.getTime() >= deadline:
+                return None
+            if idle is not None:
+                idle()
+            self.core.wait(min(self.poll_interval, max(0.0, deadline - self.core.getTime())),
+                           hogCPUperiod=0)
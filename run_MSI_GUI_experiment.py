@@ -5,206 +5,34 @@ Created on Thu Sep  5 07:48:19 2024
 
 @author: David Tovar
 """
+import math
 import platform
 import random
 import os
 import csv
 import json
 import sys
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
-from psychopy import visual, core, event, monitors, sound
-from psychopy import prefs
-
-# Configure audio settings before importing sound - using only PTB for reliability
-prefs.hardware['audioLib'] = ['PTB']  # Using only PTB (PsychToolbox) as it's most reliable
-prefs.general['audioDevice'] = 'default'  # Use system default audio device
-
-print("\nAudio Configuration:")
-print(f"Selected Audio Library: {sound.audioLib}")
-print(f"Audio Device: {prefs.general['audioDevice']}")
-sound.init()  # Explicitly initialize sound system
 
 import numpy as np
-import redcap
-import subprocess  # Add this import at the top
+from trial_writer import TrialWriter, recover_pending_journals
+from session_table import TRIAL_COLUMNS, SessionTable
+from trial_timeline import STIM_CENTER, STIM_LEFT, STIM_RIGHT, STIM_BILATERAL, build_trial_list, compile_block, stimulus_frames
+from redcap_outbox import UploadOutbox, ensure_worker
+from offline_sync import start_background_sync
+from display_calibration import calibrate_display
+from audio_registry import AudioRegistry
+from response_input import ResponseInput
+from sound_creator import STIMULUS_TONES, export_stimulus_files, stimulus_specs, tone_cache
+from frame_timing import FrameTimingRecorder, PHASE_PRETRIAL, PHASE_STIMULUS, PHASE_RESPONSE
 
 def load_config(config_file):
     with open(config_file, 'r') as f:
         return json.load(f)
 
-def check_and_upload_offline_files(api_url, api_token):
-    """Check for offline data files and upload them to REDCap if online.
-    
-    Fetches the latest record ID from REDCap and ensures offline files
-    are correctly numbered before upload.
-    """
-    try:
-        print("\nChecking for offline data files...")
-        offline_files = []
-        
-        # Find all data files with 'offline' in the filename
-        for file in os.listdir():
-            if file.startswith('data_') and file.endswith('.csv') and 'offline' in file:
-                offline_files.append(file)
-                
-        # Also find offline demographic files
-        for file in os.listdir():
-            if file.startswith('demographic_data_') and file.endswith('.csv') and 'offline' in file:
-                offline_files.append(file)
-        
-        if not offline_files:
-            print("No offline files found.")
-            return
-            
-        print(f"Found {len(offline_files)} offline files.")
-        
-        # Try to connect to REDCap and get the latest record ID
-        try:
-            project = redcap.Project(api_url, api_token)
-            print("Connected to REDCap project for offline file upload.")
-            
-            # Get all existing record IDs to find the highest one
-            try:
-                records = project.export_records(fields=['record_id'])
-                record_ids = [int(record['record_id']) for record in records if record['record_id'].isdigit()]
-                
-                if record_ids:
-                    next_id = max(record_ids) + 1
-                else:
-                    next_id = 1
-                    
-                print(f"Next available REDCap record ID: {next_id}")
-                
-                # Group files by participant to ensure data and demographic files for the same 
-                # participant get the same new ID
-                participant_files = {}
-                
-                for file in offline_files:
-                    parts = file.split('_')
-                    if file.startswith('data_'):
-                        participant_id = parts[1]
-                    else:  # demographic file
-                        participant_id = parts[2]
-                    
-                    if participant_id not in participant_files:
-                        participant_files[participant_id] = []
-                    
-                    participant_files[participant_id].append(file)
-                
-                # Process files in batches by participant, assigning new sequential IDs
-                for offline_id, files in participant_files.items():
-                    new_id_str = str(next_id).zfill(3)  # Format with leading zeros
-                    print(f"Assigning ID {new_id_str} to offline participant {offline_id}")
-                    
-                    for file in files:
-                        # Prepare the record and upload
-                        record_data = [{'record_id': new_id_str}]
-                        project.import_records(record_data)
-                        
-                        # Create new filename before upload
-                        if file.startswith('data_'):
-                            # Format: data_ID_age_gender_site_offline_timestamp.csv
-                            parts = file.split('_')
-                            timestamp = parts[-1]  # Get timestamp
-                            age = parts[2]
-                            gender = parts[3]
-                            site = parts[4]
-                            new_filename = f"data_{new_id_str}_{age}_{gender}_{site}_{timestamp}"
-                        else:
-                            # Format: demographic_data_ID_offline_timestamp.csv
-                            parts = file.split('_')
-                            timestamp = parts[-1]  # Get timestamp
-                            new_filename = f"demographic_data_{new_id_str}_{timestamp}"
-                        
-                        print(f"Renaming {file} to {new_filename} for upload")
-                        
-                        # Determine the field name for upload
-                        if file.startswith('data_'):
-                            field_name = 'python_data_file'
-                        else:
-                            field_name = 'demographic_data_file'
-                        
-                        # Upload file with the new ID
-                        try:
-                            with open(file, 'rb') as f:
-                                file_content = f.read()
-                                
-                                # For data files, we need to update the participant ID inside the CSV content
-                                if file.startswith('data_'):
-                                    # Read the file, update the participant ID in the content
-                                    with open(file, 'r') as csv_file:
-                                        lines = csv_file.readlines()
-                                        
-                                    header = lines[0]
-                                    updated_lines = [header]
-                                    
-                                    # Update each data row with the new participant ID
-                                    for line in lines[1:]:
-                                        data = line.split(',')
-                                        data[0] = new_id_str  # Replace participant ID
-                                        updated_lines.append(','.join(data))
-                                    
-                                    # Write updated content to the new file
-                                    with open(new_filename, 'w') as new_file:
-                                        new_file.writelines(updated_lines)
-                                        
-                                    # Now read the updated file for upload
-                                    with open(new_filename, 'rb') as new_file:
-                                        file_content = new_file.read()
-                                else:
-                                    # Simply rename the demographic file and update its content
-                                    with open(file, 'r') as csv_file:
-                                        lines = csv_file.readlines()
-                                        
-                                    header = lines[0]
-                                    # There should be only one data row in demographic files
-                                    if len(lines) > 1:
-                                        data = lines[1].split(',')
-                                        data[0] = new_id_str  # Replace participant ID
-                                        updated_content = header + ','.join(data)
-                                        
-                                        with open(new_filename, 'w') as new_file:
-                                            new_file.write(updated_content)
-                                            
-                                        with open(new_filename, 'rb') as new_file:
-                                            file_content = new_file.read()
-                            
-                            # Upload the file with the new name and ID
-                            project.import_file(
-                                record=new_id_str,
-                                field=field_name,
-                                file_name=new_filename,
-                                file_content=file_content
-                            )
-                            
-                            print(f"Successfully uploaded {new_filename} to REDCap with ID {new_id_str}")
-                            
-                            # Delete the original offline file since we've created a renamed version
-                            if os.path.exists(file):
-                                os.remove(file)
-                                print(f"Removed original offline file: {file}")
-                                
-                        except Exception as e:
-                            print(f"Error processing {file}: {str(e)}")
-                            continue
-                    
-                    # Increment the ID for the next participant
-                    next_id += 1
-                    
-            except Exception as e:
-                print(f"Error fetching REDCap records: {str(e)}")
-                return
-                    
-        except Exception as e:
-            print(f"Error connecting to REDCap: {str(e)}")
-            return
-            
-    except Exception as e:
-        print(f"Error checking for offline files: {str(e)}")
-        import traceback
-        print(traceback.format_exc())
-        return
-
 def load_api_credentials(filename="api_text.txt"):
     """Load API URL and token from file. Returns None if not found or incomplete."""
     api_url = None
@@ -227,35 +55,91 @@ def load_api_credentials(filename="api_text.txt"):
 
     return api_url, api_token
 
-# Load API credentials
-api_url, api_token = load_api_credentials()
+def queue_redcap_upload(filename, field, segment_instrument=None):
+    """Queue a file for upload to the participant's REDCap record.
 
-# Initialize REDCap project if credentials are available and not in offline mode
-config = load_config(sys.argv[1])
-offline_mode = config.get('offline_mode', False)
+    The upload runs in a background worker process fed from a persistent
+    on-disk outbox, so this returns immediately and nothing is lost if the
+    runner exits before the upload finishes. Files whose content was already
+    uploaded are skipped by the worker. With segment_instrument only the
+    bytes added since the last segment are sent, as a new instance of that
+    repeating instrument.
+    """
+    if not project:
+        print("REDCap project not initialized. Skipping REDCap upload.")
+        return False
+    try:
+        upload_outbox.enqueue(filename, config['participant_id'], field, segment_instrument)
+        ensure_worker(api_url, api_token, upload_outbox.directory)
+        print(f"Queued {filename} for REDCap upload ({field})")
+        return True
+    except Exception as e:
+        print(f"Error queueing {filename} for upload: {e}")
+        return False
+
+def queue_redcap_trials(filename, instrument):
+    """Queue the file's trials not yet sent for import as instances of a repeating instrument.
 
-if api_url and api_token and not offline_mode:
+    Like file uploads, the import runs in the background worker, in chunks of
+    "redcap_trial_chunk_size" rows.
+    """
+    if not project:
+        return False
     try:
-        project = redcap.Project(api_url, api_token)
+        upload_outbox.enqueue_trials(filename, config['participant_id'], instrument,
+                                     config.get('redcap_trial_chunk_size', 500), config.get('redcap_compress', False))
+        ensure_worker(api_url, api_token, upload_outbox.directory)
+        print(f"Queued the trials of {filename} for REDCap import ({instrument})")
+        return True
+    except Exception as e:
+        print(f"Error queueing the trials of {filename}: {e}")
+        return False
+
+def print_upload_status():
+    status = upload_outbox.status()
+    print(f"REDCap outbox: {status['pending']} pending, {status['retrying']} retrying, {status['failed']} failed, "
+          f"worker {'running' if status['worker_running'] else 'idle'}")
+    if status['last_error']:
+        print(f"Last upload error: {status['last_error']}")
+
+def connect_redcap(config, api_url, api_token):
+    """Connect to REDCap. Returns the project or None.
+
+    Runs on the startup network thread, so it may block on the network
+    without delaying the window and audio setup. The background uploaders
+    are started by start_uploaders once main has accepted the connection.
+    """
+    offline_mode = config.get('offline_mode', False)
+    if not api_url or not api_token or offline_mode:
+        if offline_mode:
+            print("Running in offline mode. Data will be saved locally.")
+        else:
+            print("REDCap credentials not available. Running in offline mode.")
+        return None
+
+    try:
+        from redcap_client import get_client
+        project = get_client(api_url, api_token)
         print("\nVerifying REDCap connection...")
         project_info = project.export_project_info()
         print(f"Connected to REDCap project: {project_info['project_title']}")
-        
-        # Check for offline files and upload them
-        check_and_upload_offline_files(api_url, api_token)
+        print(project.metrics.summary())
+        return project
     except Exception as e:
         print(f"Error connecting to REDCap: {e}")
-        project = None
-else:
-    if offline_mode:
-        print("Running in offline mode. Data will be saved locally.")
-    else:
-        print("REDCap credentials not available. Running in offline mode.")
-    project = None
+        return None
+
+def start_uploaders():
+    """Resume uploads left in the outbox and sync earlier offline sessions, in the background."""
+    try:
+        if upload_outbox.jobs():
+            ensure_worker(api_url, api_token, upload_outbox.directory)
+        start_background_sync(api_url, api_token)
+    except Exception as e:
+        print(f"Could not start the background uploads: {e}")
 
 # Detect operating system
 RUNNING_ON_MAC = platform.system() == 'Darwin'
-print(f"Running on {'Mac' if RUNNING_ON_MAC else 'Windows/Linux'}")
 
 # OS-specific settings
 if RUNNING_ON_MAC:
@@ -279,7 +163,7 @@ else:
 
 
 def save_demographic_data(config):
-    """Save demographic data to CSV and create REDCap record if possible."""
+    """Save demographic data to CSV and queue it for REDCap if connected."""
     # Generate filename with timestamp
     timestamp = datetime.now().strftime("%Y%m%d")
     
@@ -299,48 +183,17 @@ def save_demographic_data(config):
         print("Running in offline mode. Demographic data saved locally.")
         return demo_filename
     
-    if project:
-        try:
-            # First create/update just the record_id
-            data = {
-                'record_id': config['participant_id']
-            }
-            
-            # Import just the record_id
-            response = project.import_records([data])
-            print(f"Created/Updated record for participant: {config['participant_id']}")
-            
-            # Now upload the CSV file as an attachment
-            try:
-                with open(demo_filename, 'rb') as file:
-                    file_content = file.read()
-                    response = project.import_file(
-                        record=config['participant_id'],
-                        field='demographic_data_file',
-                        file_name=demo_filename,
-                        file_content=file_content
-                    )
-                print(f"Uploaded demographic CSV file for participant: {config['participant_id']}")
-            except Exception as e:
-                print(f"Error uploading demographic file: {e}")
-                # Continue execution even if file upload fails
-        except Exception as e:
-            print(f"Error creating REDCap record: {e}")
-            # Continue execution even if REDCap upload fails
-    else:
-        print("REDCap project not initialized. Skipping REDCap upload.")
+    # The background worker creates the record and attaches the file
+    queue_redcap_upload(demo_filename, 'demographic_data_file')
 
     return demo_filename
 
-# Replace existing config loading code with:
-if len(sys.argv) < 2:
-    print("Please provide a configuration file.")
-    sys.exit(1)
-
-config = load_config(sys.argv[1])
-demographic_file = save_demographic_data(config)
-print(f"Demographic data saved to: {demographic_file}")
+# Audio libraries whose Sound.play() can start at a given time (when=); the
+# virtual backend emulates PTB's scheduling
+SCHEDULING_AUDIO_LIBS = ('PTB', 'virtual')
 
+# Longest the first instruction screen waits for the REDCap connection
+REDCAP_CONNECT_TIMEOUT = 30.0
 
 # Common parameters
 bg_color = [255, 255, 255]  # White
@@ -350,120 +203,290 @@ distance = 57  # cm
 stim_size = 2  # degrees
 VISUAL_STIM_DURATION = 0.1
 
-# Set up the window with timing-critical settings
-mon = monitors.Monitor('testMonitor')
-mon.setWidth(32)
-mon.setDistance(distance)
-mon.setSizePix((win_width, win_height))
-
-# Create window with Mac-specific settings
-win = visual.Window([win_width, win_height], 
-                   color=[c/255 for c in bg_color], 
-                   units="deg", 
-                   monitor=mon,
-                   **WINDOW_CONFIG)
-# Get frame rate once at startup
-try:
-    actual_fps = win.getActualFrameRate(nIdentical=10, nMaxFrames=100, nWarmUpFrames=10)
-    if actual_fps is None:
-        actual_fps = 60.0  # Common Mac refresh rate
+# Filled in by main(): PsychoPy (or the virtual backend), the session config,
+# REDCap connection, window and display timing
+visual = core = event = monitors = sound = prefs = keyboard = None
+config = None
+project = None
+api_url = api_token = None
+upload_outbox = None
+win = None
+fixation = None
+audio = None
+audio_scheduling = False
+responses = None
+actual_fps = None
+frame_dur = None
+VISUAL_FRAMES = None
+timing_recorder = None
+
+# Duration of each startup phase in seconds, in order
+startup_timings = []
+
+@contextmanager
+def startup_phase(name):
+    """Time one named startup phase and record it in startup_timings."""
+    start = time.perf_counter()
+    print(f"\n[startup] {name}...")
+    try:
+        yield
+    finally:
+        startup_timings.append((name, time.perf_counter() - start))
+
+def print_startup_timings():
+    print("\nStartup phases:")
+    for name, duration in startup_timings:
+        print(f"  {name:<24}{duration:7.2f}s")
+    print(f"  {'total':<24}{sum(duration for _, duration in startup_timings):7.2f}s")
+
+def load_backend():
+    """Import PsychoPy (or the headless virtual backend) and initialise audio."""
+    global visual, core, event, monitors, sound, prefs, keyboard, responses
+    # MSI_BACKEND=virtual swaps PsychoPy for the headless simulation (see run_headless.py)
+    virtual = os.environ.get('MSI_BACKEND') == 'virtual'
+    if virtual:
+        from virtual_backend import prefs
+    else:
+        from psychopy import prefs
+
+    # Configure audio settings before importing sound - using only PTB for reliability
+    prefs.hardware['audioLib'] = ['PTB']  # Using only PTB (PsychToolbox) as it's most reliable
+    prefs.general['audioDevice'] = 'default'  # Use system default audio device
+
+    if virtual:
+        from virtual_backend import visual, core, event, monitors, sound, keyboard
+    else:
+        from psychopy import visual, core, event, monitors, sound
+        from psychopy.hardware import keyboard
+
+    print("\nAudio Configuration:")
+    print(f"Selected Audio Library: {sound.audioLib}")
+    print(f"Audio Device: {prefs.general['audioDevice']}")
+    sound.init()  # Explicitly initialize sound system
+
+    # Responses come from the hardware-timestamped keyboard queue
+    responses = ResponseInput(keyboard, core)
+
+def preload_audio():
+    """Put every stimulus sound in the shared registry once; blocks reuse the Sounds.
+
+    The tones are synthesized in memory (sound_creator.py). With
+    "use_sound_files" in the config the <name>.wav files next to this script
+    are decoded instead, so sites can substitute their own recordings.
+    """
+    global audio, audio_scheduling
+    audio = AudioRegistry(sound)
+    audio_scheduling = sound.audioLib in SCHEDULING_AUDIO_LIBS and config.get('audio_scheduling', True)
+    print(f"Audio onsets: {'scheduled against predicted flip times' if audio_scheduling else 'started on flip'}")
+    if config.get('use_sound_files', False):
+        check_sound_files()
+        for name in STIMULUS_TONES:
+            audio.load(name, os.path.join(os.path.dirname(__file__), f"{name}.wav"))
+        return
+
+    ramp = config.get('tone_ramp_ms', 0.0) / 1000.0
+    for name, (samples, fs) in tone_cache.tones(stimulus_specs(VISUAL_STIM_DURATION, ramp=ramp)).items():
+        audio.add(name, samples, fs)
+    print(f"Synthesized {len(STIMULUS_TONES)} stimulus tones")
+
+def open_window():
+    """Create the experiment window and the fixation cross shared by all blocks."""
+    global win, fixation
+    print(f"Running on {'Mac' if RUNNING_ON_MAC else 'Windows/Linux'}")
+
+    # Set up the window with timing-critical settings
+    mon = monitors.Monitor('testMonitor')
+    mon.setWidth(32)
+    mon.setDistance(distance)
+    mon.setSizePix((win_width, win_height))
+
+    # Create window with Mac-specific settings
+    win = visual.Window([win_width, win_height], 
+                       color=[c/255 for c in bg_color], 
+                       units="deg", 
+                       monitor=mon,
+                       **WINDOW_CONFIG)
+
+    # Create common stimuli
+    fixation = visual.ShapeStim(win, 
+        vertices=((0, -0.5), (0, 0.5), (0,0), (-0.5,0), (0.5, 0)),
+        lineWidth=5,
+        closeShape=False,
+        lineColor="black"
+    )
+
+def measure_frame_rate(force_recalibration=False):
+    """Set the session's single refresh rate and the frame timing globals derived from it.
+
+    The rate comes from the per-machine calibration cache (verified with a
+    short flip pass) and is measured in full only when the cache is missing
+    or disagrees, see display_calibration.py.
+    """
+    global actual_fps, frame_dur, VISUAL_FRAMES, timing_recorder
+    actual_fps = calibrate_display(win, screen=WINDOW_CONFIG['screen'], force=force_recalibration)
     frame_dur = 1.0/actual_fps
-except:
-    actual_fps = 60.0
-    frame_dur = 1.0/60.0
-
-print(f"Using refresh rate: {actual_fps}Hz")
-VISUAL_FRAMES = max(1, int(VISUAL_STIM_DURATION * actual_fps))
-print(f"Frames per stimulus: {VISUAL_FRAMES}")
-
-# Create common stimuli
-fixation = visual.ShapeStim(win, 
-    vertices=((0, -0.5), (0, 0.5), (0,0), (-0.5,0), (0.5, 0)),
-    lineWidth=5,
-    closeShape=False,
-    lineColor="black"
-)
+
+    print(f"Using refresh rate: {actual_fps:.3f}Hz")
+    VISUAL_FRAMES = stimulus_frames(VISUAL_STIM_DURATION, actual_fps)
+    print(f"Frames per stimulus: {VISUAL_FRAMES}")
+
+    # Session-wide flip timestamps; the trace is saved next to the data file
+    timing_recorder = FrameTimingRecorder(frame_dur)
 
 # Move to top, after imports
 def verify_visual_timing(win, target_dur):
     """Returns True if the last visual timing was acceptable"""
     return abs(win.lastFrameT - target_dur) < 0.001  # 1ms tolerance
 
-def create_sound(filename, duration):
-    """Create and configure a sound stimulus with improved error handling"""
-    try:
-        filepath = os.path.join(os.path.dirname(__file__), filename)
-        print(f"\nAttempting to create sound: {filepath}")
-        print(f"Using audio library: {sound.audioLib}")
-        
-        # Create sound with PTB backend
-        try:
-            sound_stim = sound.Sound(filepath, secs=duration)
-            sound_stim.setVolume(0.8)  # Set to 80% volume for safety
-            
-            # Test the sound
-            print("Testing sound playback...")
-            sound_stim.play()
-            core.wait(0.1)  # Wait briefly
-            sound_stim.stop()
-            print("Sound test complete")
-            
-            return sound_stim
-        except Exception as e:
-            print(f"Error creating sound: {e}")
-            print("Sound system details:")
-            print(f"Audio library: {sound.audioLib}")
-            if os.path.exists(filepath):
-                print(f"Sound file exists at {filepath}")
-            else:
-                print(f"Sound file not found at {filepath}")
-                print("Attempting to create sound files using sound_creator.py")
-                subprocess.call(["python", "sound_creator.py"])
-                if os.path.exists(filepath):
-                    try:
-                        sound_stim = sound.Sound(filepath, secs=duration)
-                        sound_stim.setVolume(0.8)
-                        return sound_stim
-                    except Exception as new_e:
-                        print(f"Failed to create sound even after regenerating file: {new_e}")
-        
-        # If we get here, nothing worked
-        print("Unable to initialize sound system. Please check your audio settings and device.")
-        return None
-        
-    except Exception as e:
-        print(f"Error in create_sound: {e}")
-        return None
-
 def cleanup():
     """Clean up resources properly"""
     try:
-        # Stop any playing sounds by stopping individual sound objects
-        # If you have multiple sound objects, stop them individually
-        # Example:
-        # sound_stim.stop()
-        win.close()
+        # Stop any playing sounds and free the audio buffers
+        if sound is not None:
+            sound.stopAllSounds()
+        if audio is not None:
+            audio.clear()
+        # Close the window
+        if win is not None:
+            win.close()
     finally:
-        core.quit()
+        # Quit PsychoPy
+        if core is not None:
+            core.quit()
 
 def show_instructions(text):
     instructions = visual.TextStim(win, text=text, color="black", height=0.7, wrapWidth=30)
-    while True:
-        instructions.draw()
-        win.flip()
-        keys = event.getKeys(keyList=['space', 'escape'])
-        if 'space' in keys:
-            return
-        if 'escape' in keys:
-            win.close()
-            core.quit()
-        core.wait(0.001)
+    instructions.draw()
+    responses.clear()
+    key = hold_frame(['space', 'escape'])
+    if key[0] == 'escape':
+        win.close()
+        core.quit()
+
+def pump_window_events():
+    """Service the window's event queue without consuming key presses."""
+    event.clearEvents('mouse')
+
+def hold_frame(keys, max_wait=math.inf, phase=None):
+    """Present the frame already drawn, then hold it until one of keys is pressed.
+
+    The window is flipped once and not re-rendered while waiting; the wait
+    blocks on the keyboard queue, sleeping between polls, so the CPU and GPU
+    stay idle. Key timestamps come from the keyboard and are unaffected.
+    The flip is recorded under phase if given. Returns the (name, rt) press,
+    or None if max_wait seconds pass first.
+    """
+    flip_time = win.flip()
+    if phase is not None:
+        timing_recorder.record(flip_time, phase)
+    return responses.wait(keys, max_wait, idle=pump_window_events)
+
+def wait_foreperiod(duration, on_foreperiod=None):
+    """Wait out the foreperiod, running on_foreperiod (e.g. a data flush) inside it.
+
+    The time spent in on_foreperiod is subtracted from the wait so the
+    foreperiod length is unchanged.
+    """
+    start = core.getTime()
+    if on_foreperiod is not None:
+        on_foreperiod()
+    core.wait(max(0.0, duration - (core.getTime() - start)))
+
+# Cached static layer: (key, BufferImageStim)
+_background_cache = {'key': None, 'image': None}
+
+def background_layer(additional_stims):
+    """Return the fixation cross and text stimuli pre-rendered as one texture.
+
+    The layer is captured with visual.BufferImageStim and reused until the
+    set of stimuli or any of their texts (trial counter, feedback) changes,
+    so each frame draws a single textured quad instead of re-rendering text.
+    """
+    key = tuple((id(stim), getattr(stim, 'text', None)) for stim in additional_stims)
+    if key != _background_cache['key']:
+        image = visual.BufferImageStim(win, stim=[fixation] + additional_stims)
+        win.clearBuffer()  # Discard the capture pass from the back buffer
+        _background_cache['key'] = key
+        _background_cache['image'] = image
+    return _background_cache['image']
+
+def stim_lookup(slots):
+    """Map every timeline stimulus mask to the tuple of stimuli it selects.
+
+    slots maps stimulus bits (STIM_CENTER, STIM_LEFT, STIM_RIGHT) to the
+    block's visual or sound objects. The last entry holds every stimulus.
+    """
+    all_bits = STIM_CENTER | STIM_LEFT | STIM_RIGHT
+    return [tuple(stim for bit, stim in slots.items() if mask & bit) for mask in range(all_bits + 1)]
 
-def run_sj_trial(soa, visual_stim, sound_stim, instructions, trial_counter):
+def stereo_lookup(left_name, right_name):
+    """Sound lookup for lateralized blocks: exactly one Sound per audio mask.
+
+    Left, right and bilateral sounds are each a single stereo buffer with
+    left_name's stimulus in the left channel and right_name's in the right
+    (both in both channels if "lateralize_audio" is off), so a bilateral
+    onset is one play() call. The last entry holds all three for stopping.
+    """
+    lateralize = config.get('lateralize_audio', True)
+    sounds = {
+        STIM_LEFT: audio.stereo(left_name, None, VISUAL_STIM_DURATION, lateralize),
+        STIM_RIGHT: audio.stereo(None, right_name, VISUAL_STIM_DURATION, lateralize),
+        STIM_BILATERAL: audio.stereo(left_name, right_name, VISUAL_STIM_DURATION, lateralize),
+    }
+    all_bits = STIM_CENTER | STIM_LEFT | STIM_RIGHT
+    lookup = [(sounds[mask],) if mask in sounds else () for mask in range(all_bits + 1)]
+    lookup[-1] = tuple(sounds.values())
+    return lookup
+
+def play_timeline(timeline, visual_lookup, sound_lookup, background, trial_clock):
+    """Play a compiled trial timeline, one flip per frame.
+
+    background is the pre-rendered static layer from background_layer().
+    With audio_scheduling, each sound is handed to the audio backend before
+    its flip, to start at the predicted flip time plus the frame's sub-frame
+    delay; otherwise sounds start from a callOnFlip callback. The trial clock
+    is reset on the first stimulus flip, visual or audio, and the response
+    keyboard clock on the onset flip (the visual onset when there is one).
+    Returns the trial clock time of the onset flip, so a key time plus that
+    is the time from the first stimulus.
+    """
+    # Resolve masks to stimuli before entering the flip loop
+    frame_visuals = [visual_lookup[mask] for mask in timeline.frames['visual']]
+    frame_sounds = [sound_lookup[mask] for mask in timeline.frames['audio']]
+    frame_delays = timeline.frames['audio_delay'].tolist()
+    onset_frame = timeline.onset_frame
+    first_frame = timeline.first_stimulus_frame
+    stim_onset = None
+
+    for frame in range(len(timeline)):
+        background.draw()
+        for stim in frame_visuals[frame]:
+            stim.draw()
+        if frame_sounds[frame]:
+            if audio_scheduling:
+                predicted_flip = win.getFutureFlipTime(clock=None)
+                when = win.getFutureFlipTime(clock='ptb') + frame_delays[frame]
+                for sound_stim in frame_sounds[frame]:
+                    sound_stim.play(when=when)
+                timing_recorder.record_audio(frame, when, predicted_flip)
+            else:
+                for sound_stim in frame_sounds[frame]:
+                    win.callOnFlip(sound_stim.play)
+        if frame == first_frame:
+            win.callOnFlip(trial_clock.reset)
+        if frame == onset_frame:
+            responses.reset_on_flip(win)
+        timing_recorder.record(win.flip(), PHASE_STIMULUS, frame)
+        if frame == onset_frame:
+            stim_onset = trial_clock.getTime()
+
+    return stim_onset
+
+def run_sj_trial(soa, timeline, visual_lookup, sound_lookup, instructions, trial_counter, on_foreperiod=None):
     print(f"\nStarting SJ trial with SOA: {soa}ms")
     av_sync = config.get('av_sync_correction', 0.0)
-    adjusted_soa = soa + av_sync
-    print(f"AV sync correction: {av_sync}ms, Adjusted SOA: {adjusted_soa}ms")
+    print(f"AV sync correction: {av_sync}ms, Adjusted SOA: {timeline.requested_lag_ms}ms "
+          f"(presented as {timeline.realized_lag_ms:.1f}ms)")
     
     # Create SOA display text for test mode
     test_mode = config.get('test_mode', False)
@@ -488,8 +511,6 @@ def run_sj_trial(soa, visual_stim, sound_stim, instructions, trial_counter):
         display_text = f"{soa_display} (corr: {av_sync}ms)\n{timing_indicator}"
         soa_text = visual.TextStim(win, text=display_text, color="black", height=0.5, pos=(0, 3))
     
-    # Rest of function remains unchanged
-    response_made = False
     rt = None
     response = -1
     
@@ -498,114 +519,36 @@ def run_sj_trial(soa, visual_stim, sound_stim, instructions, trial_counter):
     if test_mode and soa_text:
         additional_stims.append(soa_text)
     
-    # Pre-trial setup
-    fixation.draw()
-    for stim in additional_stims:
-        stim.draw()
-    win.flip()
-    core.wait(random.uniform(1, 2))  # Random foreperiod
+    # Pre-trial setup: capture the static layer once, outside the flip loop
+    background = background_layer(additional_stims)
+    background.draw()
+    responses.clear()
+    timing_recorder.record(win.flip(), PHASE_PRETRIAL)
+    wait_foreperiod(random.uniform(1, 2), on_foreperiod)  # Random foreperiod
     
     trial_clock = core.Clock()
+    stim_onset = play_timeline(timeline, visual_lookup, sound_lookup, background, trial_clock)
     
-    # Ensure visual stimulus duration is constant
-    visual_duration = VISUAL_FRAMES * frame_dur
-    
-    if adjusted_soa <= 0:  # Audio first or simultaneous
-        if adjusted_soa == 0:  # Truly simultaneous
-            # For simultaneous presentation, play audio in a separate step
-            # to avoid timing issues that can shorten the visual stimulus
-            
-            # First, reset the clock but don't play audio yet
-            fixation.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(trial_clock.reset)
-            win.flip()
-            
-            # Now draw visual and play audio
-            fixation.draw()
-            visual_stim.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(sound_stim.play)
-            win.flip()
-            
-            # Use robust presentation for remaining frames
-            ensure_visual_presentation(visual_stim, VISUAL_FRAMES - 1, additional_stims)
-        
-        else:  # Audio leads
-            fixation.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(trial_clock.reset)
-            win.callOnFlip(sound_stim.play)
-            win.flip()
-            
-            # Wait for SOA
-            frames_to_wait = round(abs(adjusted_soa/1000.0) / frame_dur)
-            for frame in range(frames_to_wait):
-                fixation.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.flip()
-            
-            # Use robust presentation for visual stimulus
-            ensure_visual_presentation(visual_stim, VISUAL_FRAMES, additional_stims)
-    
-    else:  # Visual first
-        # Show visual for its full duration
-        fixation.draw()
-        visual_stim.draw()
-        for stim in additional_stims:
-            stim.draw()
-        win.callOnFlip(trial_clock.reset)
-        win.flip()
-        
-        # Use robust presentation for remaining frames
-        ensure_visual_presentation(visual_stim, VISUAL_FRAMES - 1, additional_stims)
-        
-        # Wait until time to play audio
-        frames_to_wait = round((adjusted_soa/1000.0 - visual_duration) / frame_dur)
-        frames_to_wait = max(0, frames_to_wait)
-        
-        for frame in range(frames_to_wait):
-            fixation.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.flip()
-        
-        # Play audio
-        fixation.draw()
-        for stim in additional_stims:
-            stim.draw()
-        win.callOnFlip(sound_stim.play)
-        win.flip()
-    
-    # Modified response collection - wait indefinitely until response
-    while not response_made:
-        fixation.draw()
-        for stim in additional_stims:
-            stim.draw()
-        win.flip()
-        
-        keys = event.getKeys(timeStamped=trial_clock, keyList=['1', '2', 'escape'])
-        if keys:
-            if 'escape' in keys[0][0]:
-                cleanup()
-            else:
-                rt = keys[0][1]
-                response = 1 if keys[0][0] == '1' else 2
-                response_made = True
-                print(f"Response: {response} at {rt}s")
+    # Modified response collection - hold the frame until a response, without a time limit
+    background.draw()
+    key = hold_frame(['1', '2', 'escape'], phase=PHASE_RESPONSE)
+    if key[0] == 'escape':
+        cleanup()
+    else:
+        # Key-down time from the onset flip, reported from the first stimulus
+        rt = key[1] + stim_onset
+        response = 1 if key[0] == '1' else 2
+        print(f"Response: {response} at {rt}s")
     
-    sound_stim.stop()
+    # The last lookup entry holds every sound of the block
+    for sound_stim in sound_lookup[-1]:
+        sound_stim.stop()
     return response, rt
 
-def run_srt_trial(trial_type, visual_stim, sound_stim, instructions, feedback):
+def run_srt_trial(trial_type, timeline, visual_lookup, sound_lookup, instructions, feedback, on_foreperiod=None):
     print(f"\nStarting SRT trial: {trial_type}")
     av_sync = config.get('av_sync_correction', 0.0)
     print(f"AV sync correction: {av_sync}ms")
-    response_made = False
     rt = None
     
     # Create correction text for test mode
@@ -620,163 +563,33 @@ def run_srt_trial(trial_type, visual_stim, sound_stim, instructions, feedback):
     if test_mode and correction_text:
         additional_stims.append(correction_text)
     
-    # Pre-trial setup
-    fixation.draw()
-    for stim in additional_stims:
-        stim.draw()
-    win.flip()
+    # Pre-trial setup: capture the static layer once, outside the flip loop
+    background = background_layer(additional_stims)
+    background.draw()
+    responses.clear()
+    timing_recorder.record(win.flip(), PHASE_PRETRIAL)
     foreperiod = random.uniform(1, 3)
     print(f"Waiting foreperiod: {foreperiod}s")
-    core.wait(foreperiod)
+    wait_foreperiod(foreperiod, on_foreperiod)
     
     trial_clock = core.Clock()
-    trial_clock.reset()
-    stim_onset = None
+    stim_onset = play_timeline(timeline, visual_lookup, sound_lookup, background, trial_clock)
     
-    # Present stimulus
-    if trial_type == 'audiovisual':
-        print(f"Starting AV stimulus with {av_sync}ms offset")
-        if av_sync <= 0:  # Audio first or simultaneous
-            if av_sync == 0:  # Truly simultaneous
-                # First, reset the clock but don't play audio yet
-                fixation.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.callOnFlip(trial_clock.reset)
-                win.flip()
-                
-                # Now draw visual and play audio together
-                fixation.draw()
-                visual_stim.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.callOnFlip(sound_stim.play)
-                win.flip()
-                stim_onset = trial_clock.getTime()
-                
-                # Use our robust presentation method for remaining frames
-                ensure_visual_presentation(visual_stim, VISUAL_FRAMES - 1, additional_stims)
-            
-            else:  # Audio leads
-                print("Playing audio")
-                fixation.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.callOnFlip(trial_clock.reset)
-                win.callOnFlip(sound_stim.play)
-                win.flip()
-                
-                # Wait for SOA
-                wait_frames = round(abs(av_sync/1000.0) / frame_dur)
-                for frame in range(wait_frames):
-                    fixation.draw()
-                    for stim in additional_stims:
-                        stim.draw()
-                    win.flip()
-                
-                # Show visual for full duration using our robust method
-                stim_onset = trial_clock.getTime()
-                ensure_visual_presentation(visual_stim, VISUAL_FRAMES, additional_stims)
-                
-        else:  # Visual first
-            # Start with visual
-            fixation.draw()
-            visual_stim.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(trial_clock.reset)
-            win.flip()
-            stim_onset = trial_clock.getTime()
-            
-            # Use robust presentation for remaining visual frames
-            ensure_visual_presentation(visual_stim, VISUAL_FRAMES - 1, additional_stims)
-            
-            # Calculate frames to wait before audio
-            frames_to_wait = round((av_sync/1000.0) / frame_dur)
-            
-            win.callOnFlip(trial_clock.reset)
-            win.flip()
-            stim_onset = trial_clock.getTime()
-            
-            # Ensure full VISUAL_FRAMES duration
-            for frame in range(VISUAL_FRAMES - 1):
-                fixation.draw()
-                visual_stim.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.flip()
-            
-            # Calculate frames to wait before audio
-            frames_to_wait = round((av_sync/1000.0) / frame_dur)
-            
-            # Wait until audio should start
-            for frame in range(frames_to_wait):
-                fixation.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.flip()
-            
-            # Play audio
-            fixation.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(sound_stim.play)
-            win.flip()
-            
-    elif trial_type == 'visual':
-        # Visual only trial
-        fixation.draw()
-        visual_stim.draw()
-        for stim in additional_stims:
-            stim.draw()
-        win.callOnFlip(trial_clock.reset)
-        win.flip()
-        stim_onset = trial_clock.getTime()
-        
-        # Ensure full VISUAL_FRAMES duration
-        for frame in range(VISUAL_FRAMES - 1):
-            fixation.draw()
-            visual_stim.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.flip()
-            
-    else:  # audio
-        print("Starting audio stimulus")
-        fixation.draw()
-        for stim in additional_stims:
-            stim.draw()
-        win.callOnFlip(trial_clock.reset)
-        win.callOnFlip(sound_stim.play)
-        win.flip()
-        stim_onset = trial_clock.getTime()
-        
-        # Show fixation for consistent duration (matching visual)
-        for frame in range(VISUAL_FRAMES - 1):
-            fixation.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.flip()
-    
-    # Response collection
+    # Response collection: clear the stimulus, then hold that frame and wait for
+    # the key-down instead of re-rendering. RT is the hardware key-down time
+    # from the onset flip.
     response_window = 2.0  # Allow 2 seconds for response
-    while (trial_clock.getTime() - stim_onset) < response_window and not response_made:
-        fixation.draw()
-        for stim in additional_stims:
-            stim.draw()
-        win.flip()
-        
-        keys = event.getKeys(['space', 'escape'], timeStamped=trial_clock)
-        for key in keys:
-            if key[0] == 'escape':
-                cleanup()
-            elif key[0] == 'space':
-                rt = key[1] - stim_onset
-                response_made = True
-                print(f"Response at {rt}s")
-                break
+    background.draw()
+    key = hold_frame(['space', 'escape'], response_window - (trial_clock.getTime() - stim_onset),
+                     PHASE_RESPONSE)
+    if key is not None:
+        if key[0] == 'escape':
+            cleanup()
+        rt = key[1]
+        print(f"Response at {rt}s")
     
-    sound_stim.stop()
+    for sound_stim in sound_lookup[-1]:
+        sound_stim.stop()
     
     if rt is not None and rt < 0.05:
         print("Response too fast")
@@ -784,11 +597,10 @@ def run_srt_trial(trial_type, visual_stim, sound_stim, instructions, feedback):
     
     return rt
 
-def run_srt_mod_trial(trial_type, visual_stim_left, visual_stim_right, sound_left, sound_right, instructions, feedback):
+def run_srt_mod_trial(trial_type, timeline, visual_lookup, sound_lookup, instructions, feedback, on_foreperiod=None):
     print(f"\nStarting SRT_Mod trial: {trial_type}")
     av_sync = config.get('av_sync_correction', 0.0)
     print(f"AV sync correction: {av_sync}ms")
-    response_made = False
     rt = None
     
     # Create correction text for test mode
@@ -803,276 +615,32 @@ def run_srt_mod_trial(trial_type, visual_stim_left, visual_stim_right, sound_lef
     if test_mode and correction_text:
         additional_stims.append(correction_text)
     
-    # Pre-trial setup
-    fixation.draw()
-    for stim in additional_stims:
-        stim.draw()
-    win.flip()
-    core.wait(random.uniform(1, 3))
+    # Pre-trial setup: capture the static layer once, outside the flip loop
+    background = background_layer(additional_stims)
+    background.draw()
+    responses.clear()
+    timing_recorder.record(win.flip(), PHASE_PRETRIAL)
+    wait_foreperiod(random.uniform(1, 3), on_foreperiod)
     
     trial_clock = core.Clock()
-    trial_clock.reset()
-    stim_onset = 0  # We'll reset the clock at stimulus onset
+    stim_onset = play_timeline(timeline, visual_lookup, sound_lookup, background, trial_clock)
     
-    # Helper functions remain unchanged
-    def get_visual_stim():
-        if '_left' in trial_type:
-            return visual_stim_left
-        elif '_right' in trial_type:
-            return visual_stim_right
-        elif '_bilateral' in trial_type:
-            return None
-        return None
-
-    def draw_bilateral():
-        visual_stim_left.draw()
-        visual_stim_right.draw()
-        
-    # Present stimulus
-    if 'audiovisual' in trial_type:
-        # Stop any playing sounds
-        sound_left.stop()
-        sound_right.stop()
-        
-        if av_sync <= 0:  # Audio first or simultaneous
-            if av_sync == 0:  # Truly simultaneous
-                # For bilateral stimuli
-                if '_bilateral' in trial_type:
-                    # Reset the clock first
-                    fixation.draw()
-                    for stim in additional_stims:
-                        stim.draw()
-                    win.callOnFlip(trial_clock.reset)
-                    win.flip()
-                    
-                    # Now start visual and audio together
-                    fixation.draw()
-                    draw_bilateral()
-                    for stim in additional_stims:
-                        stim.draw()
-                    
-                    # Schedule audio
-                    if '_left' in trial_type:
-                        win.callOnFlip(sound_left.play)
-                    elif '_right' in trial_type:
-                        win.callOnFlip(sound_right.play)
-                    else:  # bilateral
-                        win.callOnFlip(sound_left.play)
-                        win.callOnFlip(sound_right.play)
-                    
-                    win.flip()
-                    
-                    # Use our new robust method to ensure visual presentation
-                    # Create a temporary custom function for bilateral presentation
-                    def draw_bilateral_with_fixation():
-                        fixation.draw()
-                        draw_bilateral()
-                        for stim in additional_stims:
-                            stim.draw()
-                        
-                    # We handle this special case with a loop because ensure_visual_presentation 
-                    # expects a single visual stim object
-                    for frame in range(VISUAL_FRAMES - 1):
-                        fixation.draw()
-                        draw_bilateral()
-                        for stim in additional_stims:
-                            stim.draw()
-                        win.flip()
-                else:
-                    # Single stimulus case - use our robust methods
-                    visual_stim = get_visual_stim()
-                    
-                    # Reset the clock first
-                    fixation.draw()
-                    for stim in additional_stims:
-                        stim.draw()
-                    win.callOnFlip(trial_clock.reset)
-                    win.flip()
-                    
-                    # Now start visual and audio together
-                    fixation.draw()
-                    visual_stim.draw()
-                    for stim in additional_stims:
-                        stim.draw()
-                    
-                    # Schedule audio
-                    if '_left' in trial_type:
-                        win.callOnFlip(sound_left.play)
-                    elif '_right' in trial_type:
-                        win.callOnFlip(sound_right.play)
-                    
-                    win.flip()
-                    
-                    # Use robust presentation for remaining frames
-                    ensure_visual_presentation(visual_stim, VISUAL_FRAMES - 1, additional_stims)
-                        
-            else:  # Audio leads
-                # Play audio first
-                fixation.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.callOnFlip(trial_clock.reset)
-                
-                if '_left' in trial_type:
-                    win.callOnFlip(sound_left.play)
-                elif '_right' in trial_type:
-                    win.callOnFlip(sound_right.play)
-                else:  # bilateral
-                    win.callOnFlip(sound_left.play)
-                    win.callOnFlip(sound_right.play)
-                
-                win.flip()
-                
-                # Wait for SOA
-                frames_to_wait = round(abs(av_sync/1000.0) / frame_dur)
-                for frame in range(frames_to_wait):
-                    fixation.draw()
-                    for stim in additional_stims:
-                        stim.draw()
-                    win.flip()
-                
-                # Show visual for full duration
-                if '_bilateral' in trial_type:
-                    # Bilateral case - use manual drawing with a guaranteed frame rate
-                    for frame in range(VISUAL_FRAMES):
-                        fixation.draw()
-                        draw_bilateral()
-                        for stim in additional_stims:
-                            stim.draw()
-                        win.flip(clearBuffer=True)
-                else:
-                    # Single visual stimulus - use our robust method
-                    visual_stim = get_visual_stim()
-                    ensure_visual_presentation(visual_stim, VISUAL_FRAMES, additional_stims)
-                    
-        else:  # Visual first
-            # Start with visual
-            if '_bilateral' in trial_type:
-                fixation.draw()
-                draw_bilateral()
-                for stim in additional_stims:
-                    stim.draw()
-                win.callOnFlip(trial_clock.reset)
-                win.flip()
-                
-                # Bilateral case - use manual drawing with a guaranteed frame rate
-                for frame in range(VISUAL_FRAMES - 1):
-                    fixation.draw()
-                    draw_bilateral()
-                    for stim in additional_stims:
-                        stim.draw()
-                    win.flip(clearBuffer=True)
-            else:
-                visual_stim = get_visual_stim()
-                fixation.draw()
-                visual_stim.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.callOnFlip(trial_clock.reset)
-                win.flip()
-                
-                # Use robust presentation for remaining frames
-                ensure_visual_presentation(visual_stim, VISUAL_FRAMES - 1, additional_stims)
-            
-            # Calculate time to wait before audio
-            frames_to_wait = round((av_sync/1000.0) / frame_dur)
-            
-            # Wait until audio should start
-            for frame in range(frames_to_wait):
-                fixation.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.flip()
-            
-            # Play audio
-            fixation.draw()
-            for stim in additional_stims:
-                stim.draw()
-            
-            if '_left' in trial_type:
-                win.callOnFlip(sound_left.play)
-            elif '_right' in trial_type:
-                win.callOnFlip(sound_right.play)
-            else:  # bilateral
-                win.callOnFlip(sound_left.play)
-                win.callOnFlip(sound_right.play)
-            
-            win.flip()
-    
-    elif 'visual' in trial_type:
-        # Visual only trial
-        if '_bilateral' in trial_type:
-            fixation.draw()
-            draw_bilateral()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(trial_clock.reset)
-            win.flip()
-            
-            # Bilateral case - use manual drawing with a guaranteed frame rate
-            for frame in range(VISUAL_FRAMES - 1):
-                fixation.draw()
-                draw_bilateral()
-                for stim in additional_stims:
-                    stim.draw()
-                win.flip(clearBuffer=True)
-        else:
-            visual_stim = get_visual_stim()
-            fixation.draw()
-            visual_stim.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(trial_clock.reset)
-            win.flip()
-            
-            # Use robust presentation for remaining frames
-            ensure_visual_presentation(visual_stim, VISUAL_FRAMES - 1, additional_stims)
-    
-    elif 'audio' in trial_type:
-        # Audio only trial
-        fixation.draw()
-        for stim in additional_stims:
-            stim.draw()
-        win.callOnFlip(trial_clock.reset)
-        
-        if '_left' in trial_type:
-            win.callOnFlip(sound_left.play)
-        elif '_right' in trial_type:
-            win.callOnFlip(sound_right.play)
-        else:  # bilateral
-            win.callOnFlip(sound_left.play)
-            win.callOnFlip(sound_right.play)
-        
-        win.flip()
-        
-        # Show fixation for consistent duration
-        for frame in range(VISUAL_FRAMES - 1):
-            fixation.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.flip()
-    
-    # Response collection
+    # Response collection: clear the stimulus, then hold that frame and wait for
+    # the key-down instead of re-rendering. RT is the hardware key-down time
+    # from the onset flip.
     response_window = 2.0  # Allow 2 seconds for response
-    while (trial_clock.getTime()) < response_window and not response_made:
-        fixation.draw()
-        for stim in additional_stims:
-            stim.draw()
-        win.flip()
-        
-        keys = event.getKeys(['space', 'escape'], timeStamped=trial_clock)
-        for key in keys:
-            if key[0] == 'escape':
-                cleanup()
-            elif key[0] == 'space':
-                rt = key[1]  # Already relative to stim_onset since we reset clock at stimulus
-                response_made = True
-                print(f"Response at {rt}s")
-                break
+    background.draw()
+    key = hold_frame(['space', 'escape'], response_window - (trial_clock.getTime() - stim_onset),
+                     PHASE_RESPONSE)
+    if key is not None:
+        if key[0] == 'escape':
+            cleanup()
+        rt = key[1]
+        print(f"Response at {rt}s")
     
     # End trial - stop all sounds
-    sound_left.stop()
-    sound_right.stop()
+    for sound_stim in sound_lookup[-1]:
+        sound_stim.stop()
     
     if rt is not None and rt < 0.05:
         print("Response too fast")
@@ -1080,11 +648,11 @@ def run_srt_mod_trial(trial_type, visual_stim_left, visual_stim_right, sound_lef
     
     return rt
 
-def run_sj_mod_trial(trial_type, soa, side, visual_stim_left, visual_stim_right, sound_left, sound_right, instructions, trial_counter):
+def run_sj_mod_trial(trial_type, soa, side, timeline, visual_lookup, sound_lookup, instructions, trial_counter, on_foreperiod=None):
     print(f"\nStarting SJ_Mod trial: {trial_type}, SOA: {soa}ms, Side: {side}")
     av_sync = config.get('av_sync_correction', 0.0)
-    adjusted_soa = soa + av_sync
-    print(f"AV sync correction: {av_sync}ms, Adjusted SOA: {adjusted_soa}ms")
+    print(f"AV sync correction: {av_sync}ms, Adjusted SOA: {timeline.requested_lag_ms}ms "
+          f"(presented as {timeline.realized_lag_ms:.1f}ms)")
     
     # Create SOA display text for test mode
     test_mode = config.get('test_mode', False)
@@ -1117,7 +685,6 @@ def run_sj_mod_trial(trial_type, soa, side, visual_stim_left, visual_stim_right,
         soa_text = visual.TextStim(win, text=f"{trial_type}: {soa_display} (corr: {av_sync}ms)", 
                                   color="black", height=0.5, pos=(0, 3))
     
-    response_made = False
     rt = None
     response = -1
     
@@ -1126,246 +693,45 @@ def run_sj_mod_trial(trial_type, soa, side, visual_stim_left, visual_stim_right,
     if test_mode and soa_text:
         additional_stims.append(soa_text)
     
-    # Pre-trial setup
-    fixation.draw()
-    for stim in additional_stims:
-        stim.draw()
-    win.flip()
-    core.wait(random.uniform(1, 2))
+    # Pre-trial setup: capture the static layer once, outside the flip loop
+    background = background_layer(additional_stims)
+    background.draw()
+    responses.clear()
+    timing_recorder.record(win.flip(), PHASE_PRETRIAL)
+    wait_foreperiod(random.uniform(1, 2), on_foreperiod)
     
     trial_clock = core.Clock()
-    visual_duration = VISUAL_FRAMES * frame_dur  # Ensure consistent duration
-    soa_frames = int(abs(adjusted_soa/1000.0) / frame_dur)
+    stim_onset = play_timeline(timeline, visual_lookup, sound_lookup, background, trial_clock)
     
-    # Handle different trial types
-    if trial_type == 'visual':
-        if side == 'left':
-            first_stim, second_stim = visual_stim_left, visual_stim_right
-        else:
-            first_stim, second_stim = visual_stim_right, visual_stim_left
-        
-        if soa == 0:  # Simultaneous
-            # Show both stimuli for full duration
-            fixation.draw()
-            first_stim.draw()
-            second_stim.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(trial_clock.reset)
-            win.flip()
-            
-            # Use a custom function for bilateral stimulus presentation since
-            # we can't use ensure_visual_presentation with multiple stimuli
-            for frame in range(VISUAL_FRAMES - 1):
-                fixation.draw()
-                first_stim.draw()
-                second_stim.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.flip(clearBuffer=True)  # Force clean frame rendering
-        else:  # Sequential
-            # First stimulus
-            fixation.draw()
-            first_stim.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(trial_clock.reset)
-            win.flip()
-            
-            # Use robust presentation for first stimulus
-            ensure_visual_presentation(first_stim, VISUAL_FRAMES - 1, additional_stims)
-            
-            # Gap period if SOA > duration
-            frames_gap = max(0, soa_frames - VISUAL_FRAMES)
-            for frame in range(frames_gap):
-                fixation.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.flip()
-            
-            # Second stimulus gets full duration with robust presentation
-            fixation.draw()
-            second_stim.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.flip()
-            
-            ensure_visual_presentation(second_stim, VISUAL_FRAMES - 1, additional_stims)
-    
-    elif trial_type == 'auditory':
-        # Stop any playing sounds
-        sound_left.stop()
-        sound_right.stop()
-        
-        if side == 'left':
-            first_sound, second_sound = sound_left, sound_right
-        else:
-            first_sound, second_sound = sound_right, sound_left
-        
-        if soa == 0:  # Simultaneous
-            fixation.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(trial_clock.reset)
-            win.callOnFlip(first_sound.play)
-            win.callOnFlip(second_sound.play)
-            win.flip()
-            
-            # Show fixation for consistent duration
-            for frame in range(VISUAL_FRAMES - 1):
-                fixation.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.flip(clearBuffer=True)  # Force clean frame rendering
-        else:  # Sequential
-            fixation.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(trial_clock.reset)
-            win.callOnFlip(first_sound.play)
-            win.flip()
-            
-            # Wait for SOA with clean frame rendering
-            for frame in range(soa_frames):
-                fixation.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.flip(clearBuffer=True)
-            
-            # Play second sound
-            fixation.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(second_sound.play)
-            win.flip()
-            
-            # Show fixation for consistent duration with clean frame rendering
-            for frame in range(VISUAL_FRAMES - 1):
-                fixation.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.flip(clearBuffer=True)
-    
-    elif trial_type == 'audiovisual':
-        # Stop any playing sounds
-        sound_left.stop()
-        sound_right.stop()
-        
-        if side == 'left':
-            visual_stim, sound_stim = visual_stim_left, sound_left
-        else:
-            visual_stim, sound_stim = visual_stim_right, sound_right
-        
-        if adjusted_soa == 0:  # Simultaneous
-            # For simultaneous presentation, we separate the audio and visual
-            # timing to avoid issues that can shorten the visual duration
-            
-            # First, reset clock but don't do anything else yet
-            fixation.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(trial_clock.reset)
-            win.flip()
-            
-            # Now start the visual and audio together
-            fixation.draw()
-            visual_stim.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(sound_stim.play)
-            win.flip()
-            
-            # Use robust presentation for remaining frames
-            ensure_visual_presentation(visual_stim, VISUAL_FRAMES - 1, additional_stims)
-                
-        elif adjusted_soa < 0:  # Audio first
-            fixation.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(trial_clock.reset)
-            win.callOnFlip(sound_stim.play)
-            win.flip()
-            
-            # Wait for SOA with clean frame rendering
-            for frame in range(soa_frames):
-                fixation.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.flip(clearBuffer=True)
-            
-            # Show visual for full duration using robust presentation
-            ensure_visual_presentation(visual_stim, VISUAL_FRAMES, additional_stims)
-            
-        else:  # Visual first
-            # Start with visual using robust presentation
-            fixation.draw()
-            visual_stim.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(trial_clock.reset)
-            win.flip()
-            
-            # Use robust presentation for visual stimulus
-            ensure_visual_presentation(visual_stim, VISUAL_FRAMES - 1, additional_stims)
-            
-            # Wait additional time if SOA > visual duration
-            frames_to_wait = max(0, soa_frames - VISUAL_FRAMES)
-            for frame in range(frames_to_wait):
-                fixation.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.flip(clearBuffer=True)
-            
-            # Play audio
-            fixation.draw()
-            for stim in additional_stims:
-                stim.draw()
-            win.callOnFlip(sound_stim.play)
-            win.flip()
-            
-            # Show fixation for consistent duration
-            for frame in range(VISUAL_FRAMES - 1):
-                fixation.draw()
-                for stim in additional_stims:
-                    stim.draw()
-                win.flip(clearBuffer=True)
-    
-    # Wait for response with clean frame rendering
-    while not response_made:
-        fixation.draw()
-        for stim in additional_stims:
-            stim.draw()
-        win.flip(clearBuffer=True)
-        
-        keys = event.getKeys(timeStamped=trial_clock, keyList=['1', '2', 'escape'])
-        if keys:
-            if 'escape' in keys[0][0]:
-                cleanup()
-            else:
-                rt = keys[0][1]
-                response = 1 if keys[0][0] == '1' else 2
-                response_made = True
-                print(f"Response: {response} at {rt}s")
+    # Wait for response on a held frame
+    background.draw()
+    key = hold_frame(['1', '2', 'escape'], phase=PHASE_RESPONSE)
+    if key[0] == 'escape':
+        cleanup()
+    else:
+        # Key-down time from the onset flip, reported from the first stimulus
+        rt = key[1] + stim_onset
+        response = 1 if key[0] == '1' else 2
+        print(f"Response: {response} at {rt}s")
     
     # Stop all sounds
-    sound_left.stop()
-    sound_right.stop()
+    for sound_stim in sound_lookup[-1]:
+        sound_stim.stop()
     return response, rt
 
-def run_block(block_config, data_filename, config):
+def run_block(block_config, data_filename, config, table=None):
     exp_type = block_config['experiment'].lower()
-    trials_per_condition = block_config['trials_per_condition']
     block_number = block_config['block_number']
     
     # Create experiment-specific stimuli
     if exp_type == 'srt':
         stim_color = [255, 0, 0]  # Red
         visual_stim = visual.Circle(win, radius=stim_size/2, fillColor=[c/255 for c in stim_color], pos=(0, 0))
-        sound_stim = sound.Sound(os.path.join(os.path.dirname(__file__), "tone.wav"), secs=VISUAL_STIM_DURATION)
-        total_trials = trials_per_condition * 3
+        sound_stim = audio.get("tone", VISUAL_STIM_DURATION)
         instructions = visual.TextStim(win, text="Press spacebar when you see or hear a stimulus.", color="black", pos=(0, -7), height=0.5)
         feedback = visual.TextStim(win, text="", color="black", pos=(0, -5))
-        trial_types = ['visual', 'audio', 'audiovisual'] * trials_per_condition
+        visual_slots = {STIM_CENTER: visual_stim}
+        sound_lookup = stim_lookup({STIM_CENTER: sound_stim})
         
     elif exp_type == 'srt_mod':
         left_color = [0, 255, 0] if block_config.get('left_visual_green', False) else [255, 0, 0]
@@ -1375,45 +741,39 @@ def run_block(block_config, data_filename, config):
         
         left_audio = "high" if block_config.get('left_audio_high', False) else "low"
         right_audio = "low" if block_config.get('left_audio_high', False) else "high"
-        sound_left = sound.Sound(os.path.join(os.path.dirname(__file__), f"{left_audio}_pitch.wav"), secs=VISUAL_STIM_DURATION)
-        sound_right = sound.Sound(os.path.join(os.path.dirname(__file__), f"{right_audio}_pitch.wav"), secs=VISUAL_STIM_DURATION)
-
-        trial_types = (['visual_left', 'visual_right', 'visual_bilateral',
-                       'audio_left', 'audio_right', 'audio_bilateral',
-                       'audiovisual_left', 'audiovisual_right', 'audiovisual_bilateral']
-                      * trials_per_condition)
-        total_trials = len(trial_types)
+        sound_lookup = stereo_lookup(f"{left_audio}_pitch", f"{right_audio}_pitch")
+
         instructions = visual.TextStim(win, text="Press spacebar when you see or hear a stimulus.", color="black", pos=(0, -7), height=0.5)
         feedback = visual.TextStim(win, text="", color="black", pos=(0, -5))
+        visual_slots = {STIM_LEFT: visual_stim_left, STIM_RIGHT: visual_stim_right}
 
     elif exp_type == 'sj':
         stim_color = [255, 0, 0]  # Red
         visual_stim = visual.Circle(win, radius=stim_size/2, fillColor=[c/255 for c in stim_color], pos=(0, 0))
-        sound_stim = sound.Sound(os.path.join(os.path.dirname(__file__), "tone.wav"), secs=VISUAL_STIM_DURATION)
-        sj_soas = [-300, -250, -200, -150, -100, -50, 0, 50, 100, 150, 200, 250, 300]
-        total_trials = len(sj_soas) * trials_per_condition
+        sound_stim = audio.get("tone", VISUAL_STIM_DURATION)
         instructions = visual.TextStim(win, text="Press '1' for Same Time, '2' for Different Time", color="black", pos=(0, -7), height=0.5)
         trial_counter = visual.TextStim(win, text="", color="black", pos=(0, -8), height=0.5)
-        trial_types = sj_soas * trials_per_condition
+        visual_slots = {STIM_CENTER: visual_stim}
+        sound_lookup = stim_lookup({STIM_CENTER: sound_stim})
         
     elif exp_type == 'sj_mod':
         stim_color = [255, 0, 0]  # Red
         visual_stim_left = visual.Circle(win, radius=stim_size/2, fillColor=[c/255 for c in stim_color], pos=(-10, 0))
         visual_stim_right = visual.Circle(win, radius=stim_size/2, fillColor=[c/255 for c in stim_color], pos=(10, 0))
-        sound_left = sound.Sound(os.path.join(os.path.dirname(__file__), "low_pitch.wav"), secs=VISUAL_STIM_DURATION)
-        sound_right = sound.Sound(os.path.join(os.path.dirname(__file__), "high_pitch.wav"), secs=VISUAL_STIM_DURATION)
-        sj_mod_soas = [-300, -200, -100, -50, 0, 50, 100, 200, 300]
-        total_trials = len(sj_mod_soas) * trials_per_condition * 6  # 6 conditions
+        sound_lookup = stereo_lookup("low_pitch", "high_pitch")
         instructions = visual.TextStim(win, text="Press '1' for Same Time, '2' for Different Time", color="black", pos=(0, -7), height=0.5)
         trial_counter = visual.TextStim(win, text="", color="black", pos=(0, -8), height=0.5)
-        trial_types = [(cond, soa, side) 
-                      for cond in ['visual', 'auditory', 'audiovisual']
-                      for soa in sj_mod_soas
-                      for side in ['left', 'right']
-                      for _ in range(trials_per_condition)]
+        visual_slots = {STIM_LEFT: visual_stim_left, STIM_RIGHT: visual_stim_right}
 
-    # Prepare trials
+    # Prepare trials and compile every trial's frame schedule before the block starts
+    trial_types = build_trial_list(block_config)
     random.shuffle(trial_types)
+    total_trials = len(trial_types)
+    # Scheduled audio is placed at sample resolution; otherwise onsets snap to frames
+    sample_rate = audio.buffer("tone")[1] if audio_scheduling else None
+    timelines = compile_block(exp_type, trial_types, config.get('av_sync_correction', 0.0),
+                              frame_dur, VISUAL_FRAMES, sample_rate)
+    visual_lookup = stim_lookup(visual_slots)
 
     # Show instructions
     if exp_type in ['sj', 'sj_mod']:
@@ -1426,58 +786,70 @@ def run_block(block_config, data_filename, config):
         show_instructions("Press spacebar when you see or hear a stimulus.\n\n"
                         "Press SPACE to begin.")
 
-    best_rt = float('inf')  # Initialize best RT for SRT and SRT_Mod
-    for trial_num, trial in enumerate(trial_types, 1):
-        # Initialize all possible fields with default values
-        participant_id = config['participant_id']
-        age = config['age']
-        gender = config['gender']
-        site = config['site']
-        trial_type = np.nan
-        soa = np.nan
-        side = ''
-        response = np.nan
-        rt = np.nan
-        timestamp = core.getTime()
-
-        if exp_type == 'sj':
-            trial_counter.text = f"Trial {trial_num}/{total_trials}"
-            soa = trial
-            response, rt = run_sj_trial(soa, visual_stim, sound_stim, instructions, trial_counter)
-            trial_type = 'audiovisual'
-        elif exp_type == 'sj_mod':
-            trial_counter.text = f"Trial {trial_num}/{total_trials}"
-            trial_type, soa, side = trial
-            response, rt = run_sj_mod_trial(trial_type, soa, side, visual_stim_left, visual_stim_right, sound_left, sound_right, instructions, trial_counter)
-        elif exp_type == 'srt':
-            trial_type = trial
-            rt = run_srt_trial(trial_type, visual_stim, sound_stim, instructions, feedback)
-            if rt is not None:
-                best_rt = min(best_rt, rt)
-                feedback.text = f"Block {block_number}, Trial {trial_num}/{total_trials}\nLast RT: {rt:.3f}s\nBest RT: {best_rt:.3f}s"
-            else:
-                feedback.text = f"Block {block_number}, Trial {trial_num}/{total_trials}\nToo fast or too slow! Invalid response."
-        elif exp_type == 'srt_mod':
-            trial_type = trial
-            rt = run_srt_mod_trial(trial_type, visual_stim_left, visual_stim_right, sound_left, sound_right, instructions, feedback)
-            if rt is not None:
-                best_rt = min(best_rt, rt)
-                feedback.text = f"Block {block_number}, Trial {trial_num}/{total_trials}\nLast RT: {rt:.3f}s\nBest RT: {best_rt:.3f}s"
-            else:
-                feedback.text = f"Block {block_number}, Trial {trial_num}/{total_trials}\nToo fast or too slow! Invalid response."
-
-        # Save data
-        trial_data = [
-            participant_id, age, gender, site, block_number, trial_num, 
-            trial_type, soa, side, response, rt, timestamp, exp_type
-        ]
-        with open(data_filename, 'a', newline='') as csvfile:
-            csv.writer(csvfile).writerow(trial_data)
-            csvfile.flush()
-
-        # Check for escape key
-        if event.getKeys(['escape']):
-            break
+    # Keep the data file open for the whole block; fsync happens on close
+    with TrialWriter(data_filename) as writer:
+        best_rt = float('inf')  # Initialize best RT for SRT and SRT_Mod
+        for trial_num, (trial, timeline) in enumerate(zip(trial_types, timelines), 1):
+            # Initialize all possible fields with default values
+            participant_id = config['participant_id']
+            age = config['age']
+            gender = config['gender']
+            site = config['site']
+            trial_type = np.nan
+            soa = np.nan
+            side = ''
+            response = np.nan
+            rt = np.nan
+            timestamp = core.getTime()
+            timing_recorder.start_trial(block_number, trial_num)
+
+            if exp_type == 'sj':
+                trial_counter.text = f"Trial {trial_num}/{total_trials}"
+                soa = trial
+                response, rt = run_sj_trial(soa, timeline, visual_lookup, sound_lookup, instructions, trial_counter, writer.flush)
+                trial_type = 'audiovisual'
+            elif exp_type == 'sj_mod':
+                trial_counter.text = f"Trial {trial_num}/{total_trials}"
+                trial_type, soa, side = trial
+                response, rt = run_sj_mod_trial(trial_type, soa, side, timeline, visual_lookup, sound_lookup, instructions, trial_counter, writer.flush)
+            elif exp_type == 'srt':
+                trial_type = trial
+                rt = run_srt_trial(trial_type, timeline, visual_lookup, sound_lookup, instructions, feedback, writer.flush)
+                if rt is not None:
+                    best_rt = min(best_rt, rt)
+                    feedback.text = f"Block {block_number}, Trial {trial_num}/{total_trials}\nLast RT: {rt:.3f}s\nBest RT: {best_rt:.3f}s"
+                else:
+                    feedback.text = f"Block {block_number}, Trial {trial_num}/{total_trials}\nToo fast or too slow! Invalid response."
+            elif exp_type == 'srt_mod':
+                trial_type = trial
+                rt = run_srt_mod_trial(trial_type, timeline, visual_lookup, sound_lookup, instructions, feedback, writer.flush)
+                if rt is not None:
+                    best_rt = min(best_rt, rt)
+                    feedback.text = f"Block {block_number}, Trial {trial_num}/{total_trials}\nLast RT: {rt:.3f}s\nBest RT: {best_rt:.3f}s"
+                else:
+                    feedback.text = f"Block {block_number}, Trial {trial_num}/{total_trials}\nToo fast or too slow! Invalid response."
+
+            # Frame timing of this trial, analysed now that the flips are over
+            max_interval, dropped_frames, onset_error = timing_recorder.trial_summary(timeline.onset_frame)
+            audio_time, audio_error = timing_recorder.audio_summary()
+            if dropped_frames:
+                print(f"TIMING WARNING: {dropped_frames} dropped frames, max interval {max_interval:.4f}s "
+                      f"(should be ~{frame_dur:.4f}s), onset error {onset_error * 1000:.1f}ms")
+
+            # Save data
+            trial_data = [
+                participant_id, age, gender, site, block_number, trial_num, 
+                trial_type, soa, side, response, rt, timestamp, exp_type,
+                max_interval, dropped_frames, onset_error, audio_time, audio_error
+            ]
+            # Buffered and journaled; the next foreperiod flushes it to disk
+            writer.write_row(trial_data)
+            if table is not None:
+                table.append(trial_data)
+
+            # Check for escape key
+            if event.getKeys(['escape']):
+                break
 
     # Final message
     final_message = visual.TextStim(win, text=f"Block complete!\nThank you for participating in the {exp_type.upper()} experiment.", color="black", height=0.7)
@@ -1487,33 +859,53 @@ def run_block(block_config, data_filename, config):
 
 def run_experiment_series(config):
     """Run the experiment series with improved logging and error handling."""
+    trace_filename = None
+    table = None
     try:
         print("Starting experiment series...")
-        
+
+        # Rebuild any block left half-written by a crashed session
+        for recovered_file, rows in recover_pending_journals().items():
+            print(f"Recovered {rows} trials into {recovered_file} from its journal")
+
         # Create unique filename for data saving
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         offline_mode = config.get('offline_mode', False)
         offline_tag = "_offline" if offline_mode else ""
         data_filename = f"data_{config['participant_id']}_{config['age']}_{config['gender']}_{config['site']}{offline_tag}_{timestamp}.csv"
         print(f"Created data file: {data_filename}")
+        trace_filename = data_filename.replace('data_', 'frame_trace_', 1).replace('.csv', '.npz')
+        segment_field = config.get('redcap_segment_field') if config.get('redcap_segment_instrument') else None
+        # Typed copy of the trials; the CSV remains the file uploaded to REDCap
+        columnar_output = config.get('columnar_output', 'npy')
+        if columnar_output:
+            table = SessionTable(data_filename, columnar_output)
 
         # Prepare data file with headers
         with open(data_filename, 'w', newline='') as csvfile:
             csvwriter = csv.writer(csvfile)
-            csvwriter.writerow(['Participant_ID', 'Age', 'Gender', 'Site', 'Block_Number', 'Trial_Number', 
-                              'Trial_Type', 'SOA', 'Side', 'Response', 'Reaction_Time', 'Timestamp', 'Experiment'])
+            csvwriter.writerow(TRIAL_COLUMNS)
         
         print(f"Starting {len(config['blocks'])} blocks...")
         for i, block in enumerate(config['blocks'], 1):
             print(f"\nRunning block {i}/{len(config['blocks'])}")
-            run_block(block, data_filename, config)
+            run_block(block, data_filename, config, table)
             print(f"Block {i} complete")
+            if table is not None:
+                print(f"Saved typed data: {table.save()}")
             
-            # Upload data after each block if not in offline mode
+            # Queue the data for upload after each block if not in offline mode. With a
+            # segment field configured only this block's rows are sent; otherwise the
+            # whole file is queued and the worker skips it if nothing changed.
             if project and not offline_mode:
-                print("\nInitiating REDCap upload...")
                 if os.path.exists(data_filename):
-                    upload_csv_to_redcap(data_filename)
+                    if segment_field:
+                        queue_redcap_upload(data_filename, segment_field, config['redcap_segment_instrument'])
+                    else:
+                        queue_redcap_upload(data_filename, 'python_data_file')
+                    if config.get('redcap_trial_instrument'):
+                        queue_redcap_trials(data_filename, config['redcap_trial_instrument'])
+                    print_upload_status()
                 else:
                     print(f"Data file {data_filename} not found.")
             elif offline_mode:
@@ -1527,9 +919,9 @@ def run_experiment_series(config):
                 break_text = visual.TextStim(win, text=f"Take a short break.\n\nPress SPACE when you're ready to continue to the next block.", 
                                           color="black", height=0.7)
                 break_text.draw()
-                win.flip()
-                keys = event.waitKeys(keyList=['space', 'escape'])
-                if 'escape' in keys:
+                responses.clear()
+                key = hold_frame(['space', 'escape'])
+                if key[0] == 'escape':
                     raise KeyboardInterrupt("Experiment terminated by user")
 
         # Experiment series complete
@@ -1540,14 +932,14 @@ def run_experiment_series(config):
         win.flip()
         core.wait(1)
         
-        # Final upload to ensure everything is saved
+        # Final compacted upload of the whole file; skipped by the worker if the
+        # same content was already sent after the last block. The worker outlives the runner.
         if project and os.path.exists(data_filename) and not offline_mode:
-            print("Performing final data upload...")
-            upload_success = upload_csv_to_redcap(data_filename)
-            if upload_success:
-                print("Final data upload successful")
+            print("Queueing final data upload...")
+            if queue_redcap_upload(data_filename, 'python_data_file'):
+                print_upload_status()
             else:
-                print("Final data upload failed")
+                print("Final data upload could not be queued")
         elif offline_mode:
             print("Experiment completed in offline mode. Data saved locally.")
         
@@ -1558,255 +950,86 @@ def run_experiment_series(config):
         raise
     finally:
         print("Cleaning up experiment resources...")
-        # Stop individual sounds if necessary
-        # Example:
-        # sound_stim.stop()
+        if trace_filename:
+            timing_recorder.save(trace_filename)
+            print(f"Saved frame timing trace: {trace_filename}")
+        if table is not None and len(table):
+            # Also keeps the trials of a block cut short by an error
+            table.save()
+        if audio is not None:
+            audio.clear()
         win.close()
         core.quit()
 
-actual_fps = win.getActualFrameRate()
-if actual_fps is not None:
-    frame_dur = 1.0/actual_fps
-else:
-    frame_dur = 1.0/60.0  # Assume 60Hz if can't get actual rate
-print(f"Actual frame rate: {actual_fps}")
-
-# Function to verify if a flip occurred at the right time
-def verify_visual_timing(win, target_dur):
-    """Returns True if the last visual timing was acceptable"""
-    return abs(win.lastFrameT - target_dur) < 0.001  # 1ms tolerance
-
-def verify_timing_accuracy(expected_time, actual_time, tolerance=0.002):
-    """Verify timing accuracy and log any issues"""
-    diff = abs(actual_time - expected_time)
-    if diff > tolerance:
-        print(f"TIMING WARNING: Expected {expected_time}s, got {actual_time}s (diff: {diff}s)")
-    return diff <= tolerance
-
-def soa_to_frames(soa_ms, frame_duration):
-    """Convert SOA in milliseconds to number of frames"""
-    return round((soa_ms/1000.0) / frame_duration)
-
-# Modify sound creation to include error handling and cleanup
-def create_sound(filename, duration):
-    try:
-        sound_stim = sound.Sound(filename, secs=duration)
-        sound_stim.setVolume(1.0)
-        return sound_stim
-    except Exception as e:
-        print(f"Error loading sound file {filename}: {e}")
-        sys.exit(1)
-
-# Add proper cleanup
-def cleanup():
-    """Clean up resources properly"""
-    try:
-        # Stop any playing sounds
-        sound.stopAllSounds()
-        # Close the window
-        win.close()
-    finally:
-        # Quit PsychoPy
-        core.quit()
+# Check for required sound files at the start
+def check_sound_files():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    missing_files = [f"{name}.wav" for name in STIMULUS_TONES
+                     if not os.path.exists(os.path.join(directory, f"{name}.wav"))]
+    if missing_files:
+        print(f"Missing sound files: {', '.join(missing_files)}")
+        print("Writing the default tones for the missing sound files.")
+        export_stimulus_files(directory, [spec for spec in stimulus_specs()
+                                          if f"{spec['name']}.wav" in missing_files])
 
-# Modify visual stimulus presentation to respect frame timing
-def present_visual_stimulus(visual_stim, duration_frames, additional_stims=None):
-    """Present a visual stimulus for a specific number of frames
-    
-    Returns True if successfully presented for the full duration.
-    Implements robust frame timing to prevent dropped frames.
-    
-    Parameters:
-    -----------
-    visual_stim : visual.BaseVisualStim
-        The primary visual stimulus to draw
-    duration_frames : int
-        Number of frames to display the stimulus
-    additional_stims : list, optional
-        List of additional visual stimuli to draw along with the main stimulus
-    """
-    # Ensure we have at least one frame for visibility
-    duration_frames = max(1, duration_frames)
-    
-    # Create a clock to measure timing
-    frame_clock = core.Clock()
-    frame_times = []
-    
-    # Prepare PsychoPy for consistent timing
-    # Using drawStim method for more direct control
-    win.recordFrameIntervals = True
-    
-    # Start with the minimum elements - first frame
-    fixation.draw()
-    visual_stim.draw()
-    
-    # Draw any additional stimuli if provided
-    if additional_stims:
-        for stim in additional_stims:
-            if stim is not None:
-                stim.draw()
-                
-    # Reset the timer and flip
-    frame_clock.reset()
-    win.flip()
-    frame_times.append(frame_clock.getTime())
-    frames_shown = 1
-    
-    # Remaining frames with robust timing
-    for frame in range(duration_frames - 1):
-        # Critical priority: Draw visual stimulus first
-        fixation.draw()
-        visual_stim.draw()
-        
-        # Draw additional stimuli - always include them for visual timing consistency
-        if additional_stims:
-            for stim in additional_stims:
-                if stim is not None:
-                    stim.draw()
-        
-        # Force a proper frame update with waitBlanking=True to ensure precise timing
-        win.flip(clearBuffer=True)
-        curr_time = frame_clock.getTime()
-        frame_times.append(curr_time)
-        frames_shown += 1
-        
-        # Check if we're falling behind on timing and log it
-        if len(frame_times) >= 2:
-            last_interval = frame_times[-1] - frame_times[-2]
-            if last_interval > frame_dur * 1.5:
-                print(f"WARNING: Possible frame drop detected at frame {frame+1}/{duration_frames}")
-    
-    # Measure the actual duration
-    actual_duration = frame_clock.getTime()
-    expected_duration = duration_frames * frame_dur
-    
-    # Detailed timing analysis
-    frame_intervals = [frame_times[i] - frame_times[i-1] for i in range(1, len(frame_times))]
-    max_interval = max(frame_intervals) if frame_intervals else 0
-    dropped_frames = sum(1 for interval in frame_intervals if interval > frame_dur * 1.5)
-    
-    # Always log timing information for debugging
-    if dropped_frames > 0:
-        print(f"TIMING WARNING: Expected {expected_duration:.4f}s, got {actual_duration:.4f}s")
-        print(f"Frames requested: {duration_frames}, frames shown: {frames_shown}")
-        print(f"Dropped frames: {dropped_frames}")
-        print(f"Max interval: {max_interval:.4f}s (should be ~{frame_dur:.4f}s)")
-        print(f"Frame intervals: {[round(i*1000) for i in frame_intervals]}ms")
-    
-    # Turn off frame recording to avoid memory issues
-    win.recordFrameIntervals = False
-    
-    return dropped_frames == 0  # Return success only if no frames were dropped
+def main(config_file):
+    """Staged startup, then the experiment series.
 
-def ensure_visual_presentation(visual_stim, duration_frames, additional_stims=None, max_attempts=3):
-    """Ensures visual stimulus is presented properly, retrying if frames are dropped.
-    
-    This function is used when reliable visual presentation is critical.
-    
-    Parameters:
-    -----------
-    visual_stim : visual.BaseVisualStim
-        The primary visual stimulus to draw
-    duration_frames : int
-        Number of frames to display the stimulus
-    additional_stims : list, optional
-        List of additional visual stimuli to draw along with the main stimulus
-    max_attempts : int
-        Maximum number of retry attempts if frames are dropped
-        
-    Returns:
-    --------
-    bool : True if presentation was successful (no dropped frames)
+    The REDCap connection runs on a background thread while PsychoPy, the
+    stimulus audio, the window and the frame-rate measurement are set up, and is
+    only waited for just before the first instruction screen. Each phase is
+    timed and the timings are printed before the experiment starts.
     """
-    success = False
-    attempts = 0
-    
-    while not success and attempts < max_attempts:
-        success = present_visual_stimulus(visual_stim, duration_frames, additional_stims)
-        attempts += 1
-        if not success and attempts < max_attempts:
-            print(f"Retrying visual presentation (attempt {attempts+1}/{max_attempts})...")
-            # Short delay to let system recover before next attempt
-            core.wait(0.05)
-    
-    if not success:
-        print("WARNING: Could not achieve clean visual presentation after multiple attempts")
-    
-    return success
-
-def upload_csv_to_redcap(csv_filename):
-    """Upload CSV file to REDCap as a file attachment if project is available."""
-    if project:
-        try:
-            print(f"\nAttempting to upload {csv_filename} to REDCap...")
-            print(f"Using record_id: {config['participant_id']}")
-            
-            # First create/ensure the record exists
-            record_data = [{
-                'record_id': config['participant_id']
-            }]
-            
-            try:
-                # First create or update the record with just the ID
-                project.import_records(record_data)
-                print(f"Created/updated record for ID: {config['participant_id']}")
-                
-                # Now upload the file as a separate operation
-                with open(csv_filename, 'rb') as file_obj:
-                    file_content = file_obj.read()
-                    response = project.import_file(
-                        record=config['participant_id'],
-                        field='python_data_file',
-                        file_name=os.path.basename(csv_filename),
-                        file_content=file_content
-                    )
-                
-                print(f"Successfully uploaded {csv_filename} to REDCap")
-                return True
-                
-            except redcap.RedcapError as e:
-                print(f"REDCap API error: {str(e)}")
-                return False
-                
-        except Exception as e:
-            print(f"Error during upload: {str(e)}")
-            print(f"Error type: {type(e)}")
-            import traceback
-            print(traceback.format_exc())
-            return False
-    else:
-        print("REDCap project not initialized. Skipping REDCap upload.")
-        return False
+    global config, project, api_url, api_token, upload_outbox
+
+    with startup_phase("load config"):
+        config = load_config(config_file)
+        api_url, api_token = load_api_credentials()
+        upload_outbox = UploadOutbox()
+
+    network = {}
+    network_thread = threading.Thread(
+        target=lambda: network.update(project=connect_redcap(config, api_url, api_token)),
+        name="redcap-connect", daemon=True)
+    network_thread.start()
+
+    with startup_phase("load PsychoPy and audio"):
+        load_backend()
+    with startup_phase("preload audio"):
+        preload_audio()
+    with startup_phase("open window"):
+        open_window()
+    with startup_phase("measure frame rate"):
+        measure_frame_rate(config.get('recalibrate_display', False))
+
+    with startup_phase("wait for REDCap"):
+        network_thread.join(REDCAP_CONNECT_TIMEOUT)
+        timed_out = network_thread.is_alive()
+        # A connection that completes after the timeout is ignored
+        project = None if timed_out else network.get('project')
+        if timed_out:
+            print(f"REDCap did not answer within {REDCAP_CONNECT_TIMEOUT:.0f}s.")
+        if project:
+            start_uploaders()
+        elif not config.get('offline_mode', False):
+            # Without a connection the session's files are named _offline,
+            # so the offline sync uploads them later
+            config['offline_mode'] = True
+            print("Running in offline mode. Data will be saved locally and uploaded by the offline sync.")
+
+    with startup_phase("save demographics"):
+        demographic_file = save_demographic_data(config)
+        print(f"Demographic data saved to: {demographic_file}")
+
+    print_startup_timings()
+    run_experiment_series(config)
 
-# Use in run_experiment_series:
 if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Please provide a configuration file.")
+        sys.exit(1)
     try:
-        run_experiment_series(config)
+        main(sys.argv[1])
     except Exception as e:
         print(f"Error during experiment: {e}")
         cleanup()
-
-# Check for required sound files at the start
-def check_sound_files():
-    required_files = ["tone.wav", "high_pitch.wav", "low_pitch.wav"]
-    missing_files = []
-    for filename in required_files:
-        filepath = os.path.join(os.path.dirname(__file__), filename)
-        if not os.path.exists(filepath):
-            missing_files.append(filename)
-    if missing_files:
-        print(f"Missing sound files: {', '.join(missing_files)}")
-        print("Launching sound_creator.py to generate missing sound files.")
-        # Run sound_creator.py
-        subprocess.call(["python", "sound_creator.py"])
-        # After sound_creator.py exits, check again
-        for filename in missing_files:
-            filepath = os.path.join(os.path.dirname(__file__), filename)
-            if not os.path.exists(filepath):
-                print(f"Error: Sound file {filename} was not created.")
-                sys.exit(1)
-
-# Call the function before running the experiment
-check_sound_files()
-
-
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Run a full experiment configuration headless, in accelerated simulated time.
+
+    python run_headless.py demo.json --refresh 60 --drop-rate 0.01 --seed 1
+
+The runner is executed unmodified against virtual_backend.py: no window, sound
+device, participant or network is needed, so this works on build servers. Data
+files are written to --output-dir (a temporary directory by default) and a
+throughput and timing summary is printed at the end.
+"""
+import argparse
+import glob
+import json
+import os
+import runpy
+import sys
+import tempfile
+import time
+
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_MSI_GUI_experiment.py')
+
+
+def run_headless(config_file, refresh_rate=60.0, drop_rate=0.0, seed=None, output_dir=None,
+                 responder=None):
+    """Run every block of config_file against the virtual backend.
+
+    The configuration is copied into output_dir with offline_mode forced on.
+    Returns a summary dict.
+    """
+    os.environ['MSI_BACKEND'] = 'virtual'
+    import virtual_backend
+    session = virtual_backend.configure(refresh_rate, drop_rate, seed, responder)
+
+    with open(config_file, 'r') as f:
+        config = json.load(f)
+    config['offline_mode'] = True
+
+    output_dir = os.path.abspath(output_dir or tempfile.mkdtemp(prefix='msi_headless_'))
+    os.makedirs(output_dir, exist_ok=True)
+    config_copy = os.path.join(output_dir, os.path.basename(config_file))
+    with open(config_copy, 'w') as f:
+        json.dump(config, f, indent=2)
+
+    previous_dir, previous_argv = os.getcwd(), sys.argv
+    os.chdir(output_dir)
+    sys.argv = [RUNNER, config_copy]
+    wall_start = time.perf_counter()
+    try:
+        runpy.run_path(RUNNER, run_name='__main__')
+    except SystemExit:
+        pass  # The runner ends the session with core.quit()
+    finally:
+        wall_time = time.perf_counter() - wall_start
+        os.chdir(previous_dir)
+        sys.argv = previous_argv
+
+    trials = 0
+    for data_file in glob.glob(os.path.join(output_dir, 'data_*.csv')):
+        with open(data_file, 'r') as f:
+            trials += max(0, sum(1 for _ in f) - 1)
+
+    return {
+        'output_dir': output_dir,
+        'wall_time_s': wall_time,
+        'simulated_time_s': session.now,
+        'speedup': session.now / wall_time if wall_time > 0 else float('inf'),
+        'trials': trials,
+        'flips': session.flips,
+        'dropped_frames': session.dropped_frames,
+        'sounds_played': len(session.sound_log),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an experiment configuration headless in simulated time")
+    parser.add_argument('config', help="Experiment configuration JSON file")
+    parser.add_argument('--refresh', type=float, default=60.0, help="Simulated refresh rate in Hz")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Probability that a flip misses its vsync")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for frame drops and scripted responses")
+    parser.add_argument('--output-dir', default=None, help="Where data files are written")
+    args = parser.parse_args()
+
+    summary = run_headless(args.config, args.refresh, args.drop_rate, args.seed, args.output_dir)
+
+    print("\nHeadless run summary:")
+    print(f"Output directory: {summary['output_dir']}")
+    print(f"Trials written: {summary['trials']}")
+    print(f"Simulated time: {summary['simulated_time_s']:.1f}s in {summary['wall_time_s']:.2f}s wall "
+          f"({summary['speedup']:.0f}x)")
+    print(f"Flips: {summary['flips']}, injected frame drops: {summary['dropped_frames']}, "
+          f"sounds played: {summary['sounds_played']}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""
+Load experiment data files for analysis.
+
+The runner writes one data_*.csv per session with one row per trial.
+load_session() reads the columns the analyses need into a NumPy structured
+array (SESSION_DTYPE), one record per trial. Missing or non-numeric values
+(no response, SRT rows without an SOA) become NaN. find_session_files()
+expands files, directories and glob patterns into a sorted list of data
+files, so whole archives can be passed on the command line. When the runner
+saved a typed .npy table next to a data file, load_session() reads that
+instead of parsing the CSV.
+"""
+import csv
+import glob
+import os
+
+import numpy as np
+
+from session_table import load_trials
+
+DATA_PATTERN = 'data_*.csv'
+
+SESSION_DTYPE = np.dtype([
+    ('participant', 'U32'), ('block', 'i4'), ('trial', 'i4'), ('trial_type', 'U32'),
+    ('soa', 'f8'), ('side', 'U8'), ('response', 'f8'), ('rt', 'f8'), ('experiment', 'U16'),
+])
+
+# SESSION_DTYPE field -> data file column
+COLUMNS = {
+    'participant': 'Participant_ID', 'block': 'Block_Number', 'trial': 'Trial_Number',
+    'trial_type': 'Trial_Type', 'soa': 'SOA', 'side': 'Side', 'response': 'Response',
+    'rt': 'Reaction_Time', 'experiment': 'Experiment',
+}
+
+
+def find_session_files(paths, pattern=DATA_PATTERN):
+    """Expand files, directories (searched for pattern) and globs into a sorted list of files."""
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files.update(glob.glob(os.path.join(path, pattern)))
+        elif os.path.exists(path):
+            files.add(path)
+        else:
+            files.update(glob.glob(path))
+    return sorted(files)
+
+
+def load_session(path):
+    """Read one data file (or its typed table) into a SESSION_DTYPE array, one record per trial."""
+    table = load_trials(path)
+    session = np.zeros(len(table), dtype=SESSION_DTYPE)
+    for field, column in COLUMNS.items():
+        session[field] = np.char.strip(table[column]) if table.dtype[column].kind == 'U' else table[column]
+    session['experiment'] = np.char.lower(session['experiment'])
+    return session
+
+
+def load_sessions(paths):
+    """Yield (path, table) for every data file found in paths, skipping unreadable ones."""
+    for path in find_session_files(paths):
+        try:
+            yield path, load_session(path)
+        except (OSError, csv.Error, UnicodeDecodeError) as e:
+            print(f"Skipping {path}: {e}")
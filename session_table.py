@@ -0,0 +1,185 @@
+"""
+Typed, columnar copy of a session's trial data.
+
+The CSV data file stays the format sent to REDCap. Next to it, the runner
+keeps every trial as a record of a fixed NumPy structured dtype
+(TRIAL_DTYPE) and rewrites data_<...>.npy at the end of each block. Fields
+are fixed-width, so the file can be opened with np.load(mmap_mode='r')
+without parsing, and archives of many sessions can be stacked with
+concatenate_tables(). With "columnar_output": "parquet" in the
+configuration, a Parquet file is written instead if pyarrow is installed.
+
+Existing CSV archives can be converted in place:
+
+    python session_table.py data/
+"""
+import argparse
+import csv
+import glob
+import math
+import os
+import sys
+
+import numpy as np
+
+# Column name -> dtype, in data file order
+TRIAL_SCHEMA = [
+    ('Participant_ID', 'U32'), ('Age', 'f8'), ('Gender', 'U16'), ('Site', 'U32'),
+    ('Block_Number', 'i4'), ('Trial_Number', 'i4'), ('Trial_Type', 'U32'), ('SOA', 'f8'),
+    ('Side', 'U8'), ('Response', 'f8'), ('Reaction_Time', 'f8'), ('Timestamp', 'f8'),
+    ('Experiment', 'U16'), ('Max_Frame_Interval', 'f8'), ('Dropped_Frames', 'i4'),
+    ('Onset_Error', 'f8'), ('Audio_Scheduled_Time', 'f8'), ('Audio_Schedule_Error', 'f8'),
+]
+TRIAL_COLUMNS = [name for name, _ in TRIAL_SCHEMA]
+TRIAL_DTYPE = np.dtype(TRIAL_SCHEMA)
+
+FORMATS = {'npy': '.npy', 'parquet': '.parquet'}
+MISSING_INT = -1
+
+
+def _field(value, kind):
+    """Convert one CSV-style value to a field of the given dtype kind; missing values become NaN/-1/''."""
+    if kind == 'U':
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return ''
+        return str(value)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        number = math.nan
+    if kind == 'i':
+        return MISSING_INT if math.isnan(number) else int(number)
+    return number
+
+
+def to_record(row):
+    """One data file row (a sequence in TRIAL_COLUMNS order) as a tuple of TRIAL_DTYPE fields."""
+    return tuple(_field(value, TRIAL_DTYPE[i].kind) for i, value in enumerate(row))
+
+
+def table_path(data_filename, fmt='npy'):
+    return os.path.splitext(data_filename)[0] + FORMATS[fmt]
+
+
+def _write_parquet(table, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    pq.write_table(pa.table({name: table[name] for name in TRIAL_COLUMNS}), path)
+
+
+def write_table(table, path):
+    """Write a TRIAL_DTYPE array to path (.npy or .parquet), replacing it atomically."""
+    tmp_path = path + '.tmp'
+    if path.endswith(FORMATS['parquet']):
+        _write_parquet(table, tmp_path)
+    else:
+        with open(tmp_path, 'wb') as f:
+            np.save(f, table)
+    os.replace(tmp_path, path)
+    return path
+
+
+class SessionTable:
+    """In-memory trial records of one session, saved as a columnar file at block ends.
+
+    Parameters:
+    -----------
+    data_filename : str
+        The session's CSV data file; the table is saved next to it
+    fmt : str
+        'npy' or 'parquet'. Parquet needs pyarrow and falls back to npy
+        without it
+    """
+
+    def __init__(self, data_filename, fmt='npy'):
+        if fmt == 'parquet':
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                print("pyarrow is not installed; writing the typed data as .npy instead of Parquet")
+                fmt = 'npy'
+        self.path = table_path(data_filename, fmt)
+        self._records = []
+
+    def append(self, row):
+        self._records.append(to_record(row))
+
+    def __len__(self):
+        return len(self._records)
+
+    def save(self):
+        """Write every record so far; returns the file name."""
+        return write_table(np.array(self._records, dtype=TRIAL_DTYPE), self.path)
+
+
+def load_table(path, mmap=True):
+    """Open a saved table as a TRIAL_DTYPE array (memory-mapped for .npy when mmap)."""
+    if path.endswith(FORMATS['parquet']):
+        import pyarrow.parquet as pq
+
+        columns = pq.read_table(path, columns=TRIAL_COLUMNS).to_pydict()
+        table = np.zeros(len(columns[TRIAL_COLUMNS[0]]), dtype=TRIAL_DTYPE)
+        for name in TRIAL_COLUMNS:
+            table[name] = columns[name]
+        return table
+    table = np.load(path, mmap_mode='r' if mmap else None)
+    if table.dtype != TRIAL_DTYPE:
+        raise ValueError(f"{path}: unexpected dtype {table.dtype}")
+    return table
+
+
+def concatenate_tables(paths):
+    """Stack many saved .npy tables into one array, reading only their headers to size it."""
+    tables = [load_table(path) for path in paths]
+    combined = np.empty(sum(len(table) for table in tables), dtype=TRIAL_DTYPE)
+    start = 0
+    for table in tables:
+        combined[start:start + len(table)] = table
+        start += len(table)
+    return combined
+
+
+def table_from_csv(data_filename):
+    """Read a CSV data file into a TRIAL_DTYPE array; columns it lacks are left missing."""
+    with open(data_filename, 'r', newline='') as f:
+        rows = list(csv.DictReader(f))
+    return np.array([to_record([row.get(name) for name in TRIAL_COLUMNS]) for row in rows], dtype=TRIAL_DTYPE)
+
+
+def load_trials(data_filename):
+    """The trials of a data file, from its typed table when that is up to date, else from the CSV."""
+    typed = data_filename if data_filename.endswith(FORMATS['npy']) else table_path(data_filename)
+    # A CSV newer than its table was changed afterwards (e.g. by journal recovery)
+    if os.path.exists(typed) and (typed == data_filename
+                                  or os.path.getmtime(typed) >= os.path.getmtime(data_filename)):
+        try:
+            return load_table(typed)
+        except ValueError as e:
+            print(f"Reading {data_filename} instead of its typed table: {e}")
+    return table_from_csv(data_filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write typed .npy tables for existing CSV data files")
+    parser.add_argument('paths', nargs='+', help="Data files or directories")
+    parser.add_argument('--overwrite', action='store_true', help="Also convert files that already have a table")
+    args = parser.parse_args()
+
+    converted = 0
+    for path in args.paths:
+        files = glob.glob(os.path.join(path, 'data_*.csv')) if os.path.isdir(path) else [path]
+        for data_filename in sorted(files):
+            output = table_path(data_filename)
+            if os.path.exists(output) and not args.overwrite:
+                continue
+            try:
+                write_table(table_from_csv(data_filename), output)
+                converted += 1
+            except (OSError, csv.Error, UnicodeDecodeError) as e:
+                print(f"Skipping {data_filename}: {e}")
+    print(f"Converted {converted} data files")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
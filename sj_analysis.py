@@ -0,0 +1,356 @@
+"""
+Batch psychometric fits of simultaneity-judgment sessions.
+
+Every SJ and SJ_Mod condition of every data file becomes one curve: the
+proportion of "same time" responses ('1') at each SOA (negative SOA = audio
+first). Two models of the curve are fitted:
+
+    gaussian      amp * exp(-(soa - mu)^2 / (2 sigma^2))
+    two_sigmoid   amp * L((soa - left) / s_left) * L((right - soa) / s_right)
+
+where L is the logistic function. From each fit come the point of subjective
+simultaneity (PSS) and the width of the temporal binding window, measured
+between the two SOAs where the curve reaches half its peak.
+
+The fits run on all curves at once. A batched Levenberg-Marquardt solver
+works on (curves, SOAs, parameters) arrays and minimises the
+binomially weighted squared error. Bootstrap confidence intervals redraw
+every SOA level from a binomial with the observed proportion. The
+replicates are fitted as one more batch, starting from the point estimate.
+Curves are split into chunks that are spread over a process pool:
+
+    python sj_analysis.py data/ --bootstrap 1000 --workers 8 --output sj_fits.csv
+
+Each SJ_Mod trial type is a separate condition. Audiovisual SJ_Mod trials
+pool both sides on the usual audio/visual SOA axis. The unimodal pairs
+(visual-visual, auditory-auditory) always present the `side` stimulus first
+after |SOA|, so their SOA is signed by side instead: positive = left first.
+Their PSS is therefore a left/right bias, not an audiovisual one.
+"""
+import argparse
+import csv
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from session_data import load_sessions
+
+SJ_EXPERIMENTS = ('sj', 'sj_mod')
+# SJ_Mod trial types whose order is set by side, not by the sign of the SOA
+UNIMODAL_PAIRS = ('visual', 'auditory')
+SAME_RESPONSE = 1
+DIFFERENT_RESPONSE = 2
+
+# Half of the full width at half maximum of a Gaussian, in units of sigma
+HALF_MAX_SIGMAS = math.sqrt(2 * math.log(2))
+
+# Limits of the unconstrained parameters; keeps degenerate curves finite
+LOGIT_LIMIT = 8.0
+CENTER_LIMIT = 2000.0
+LOG_SCALE_LIMITS = (0.0, math.log(2000.0))  # 1 ms to 2 s
+
+RESULT_FIELDS = ['file', 'participant', 'experiment', 'condition', 'model', 'trials', 'soa_levels',
+                 'amplitude', 'pss', 'pss_ci_low', 'pss_ci_high', 'width', 'width_ci_low',
+                 'width_ci_high', 'left', 'right', 'sse', 'converged']
+
+
+class SJCurve:
+    """Response counts of one SJ condition of one session.
+
+    Parameters:
+    -----------
+    source : str
+        Data file the trials came from
+    participant, experiment, condition : str
+        Participant ID, experiment ('sj' or 'sj_mod') and trial type
+    soas : np.ndarray
+        Distinct SOAs in ms, ascending
+    n, same : np.ndarray
+        Number of trials and of "same time" responses at each SOA
+    """
+
+    def __init__(self, source, participant, experiment, condition, soas, n, same):
+        self.source = source
+        self.participant = participant
+        self.experiment = experiment
+        self.condition = condition
+        self.soas = soas
+        self.n = n
+        self.same = same
+
+
+def sj_curves(source, table):
+    """The SJ curves of one session table (see session_data.load_session)."""
+    answered = (np.isin(table['experiment'], SJ_EXPERIMENTS)
+                & np.isin(table['response'], (SAME_RESPONSE, DIFFERENT_RESPONSE))
+                & np.isfinite(table['soa']))
+    table = table[answered].copy()
+    unimodal = (table['experiment'] == 'sj_mod') & np.isin(table['trial_type'], UNIMODAL_PAIRS)
+    table['soa'] = np.where(unimodal, np.where(np.char.lower(table['side']) == 'left', 1.0, -1.0)
+                            * np.abs(table['soa']), table['soa'])
+    curves = []
+    for experiment, condition in sorted(set(zip(table['experiment'], table['trial_type']))):
+        trials = table[(table['experiment'] == experiment) & (table['trial_type'] == condition)]
+        soas, level = np.unique(trials['soa'], return_inverse=True)
+        n = np.bincount(level, minlength=len(soas)).astype(np.float64)
+        same = np.bincount(level, weights=trials['response'] == SAME_RESPONSE, minlength=len(soas))
+        curves.append(SJCurve(source, trials['participant'][0], experiment, condition, soas, n, same))
+    return curves
+
+
+def pack_curves(curves):
+    """Stack curves into (B, K) SOA, trial count and proportion arrays, padded with n = 0."""
+    levels = max(len(curve.soas) for curve in curves)
+    x = np.zeros((len(curves), levels))
+    n = np.zeros((len(curves), levels))
+    y = np.zeros((len(curves), levels))
+    for i, curve in enumerate(curves):
+        k = len(curve.soas)
+        x[i, :k] = curve.soas
+        n[i, :k] = curve.n
+        y[i, :k] = curve.same / curve.n
+    return x, n, y
+
+
+def _logistic(z):
+    return 0.5 * (1.0 + np.tanh(0.5 * z))
+
+
+def _logit(p):
+    p = np.clip(p, 0.02, 0.98)
+    return np.log(p / (1 - p))
+
+
+def _moments(x, n, y):
+    """Centre and spread of the proportion curves, used as starting values."""
+    weight = n * y
+    total = np.maximum(weight.sum(axis=1), 1e-12)
+    center = (weight * x).sum(axis=1) / total
+    spread = np.sqrt((weight * (x - center[:, None]) ** 2).sum(axis=1) / total)
+    peak = np.where(n > 0, y, 0).max(axis=1)
+    return center, np.clip(spread, 20.0, 1000.0), peak
+
+
+class GaussianModel:
+    """Scaled Gaussian; parameters (logit amp, mu, log sigma)."""
+
+    name = 'gaussian'
+    n_params = 3
+    lower = np.array([-LOGIT_LIMIT, -CENTER_LIMIT, LOG_SCALE_LIMITS[0]])
+    upper = np.array([LOGIT_LIMIT, CENTER_LIMIT, LOG_SCALE_LIMITS[1]])
+
+    def predict(self, theta, x):
+        amp = _logistic(theta[:, 0:1])
+        return amp * np.exp(-0.5 * ((x - theta[:, 1:2]) / np.exp(theta[:, 2:3])) ** 2)
+
+    def initial(self, x, n, y):
+        center, spread, peak = _moments(x, n, y)
+        return np.stack([_logit(peak), center, np.log(spread)], axis=1)
+
+    def summarize(self, theta):
+        half_width = HALF_MAX_SIGMAS * np.exp(theta[:, 2])
+        return {'amplitude': _logistic(theta[:, 0]), 'pss': theta[:, 1],
+                'left': theta[:, 1] - half_width, 'right': theta[:, 1] + half_width,
+                'width': 2 * half_width}
+
+
+class TwoSigmoidModel:
+    """Product of a rising and a falling logistic; parameters
+    (logit amp, left, log s_left, right, log s_right)."""
+
+    name = 'two_sigmoid'
+    n_params = 5
+    lower = np.array([-LOGIT_LIMIT, -CENTER_LIMIT, LOG_SCALE_LIMITS[0], -CENTER_LIMIT, LOG_SCALE_LIMITS[0]])
+    upper = np.array([LOGIT_LIMIT, CENTER_LIMIT, LOG_SCALE_LIMITS[1], CENTER_LIMIT, LOG_SCALE_LIMITS[1]])
+
+    def predict(self, theta, x):
+        amp = _logistic(theta[:, 0:1])
+        rise = _logistic((x - theta[:, 1:2]) / np.exp(theta[:, 2:3]))
+        fall = _logistic((theta[:, 3:4] - x) / np.exp(theta[:, 4:5]))
+        return amp * rise * fall
+
+    def initial(self, x, n, y):
+        center, spread, peak = _moments(x, n, y)
+        half_width = HALF_MAX_SIGMAS * spread
+        slope = np.log(half_width / 4)
+        return np.stack([_logit(peak), center - half_width, slope, center + half_width, slope], axis=1)
+
+    def summarize(self, theta):
+        # The sigmoid midpoints are the half-maximum points when the window is
+        # wider than the slopes, which is the case for any usable SJ curve
+        return {'amplitude': _logistic(theta[:, 0]), 'pss': (theta[:, 1] + theta[:, 3]) / 2,
+                'left': theta[:, 1], 'right': theta[:, 3], 'width': theta[:, 3] - theta[:, 1]}
+
+
+MODELS = {model.name: model for model in (GaussianModel(), TwoSigmoidModel())}
+
+
+def _jacobian(model, theta, x, weight):
+    """Forward-difference Jacobian of the weighted residuals, (B, K, P)."""
+    base = model.predict(theta, x)
+    jac = np.empty(x.shape + (theta.shape[1],))
+    for j in range(theta.shape[1]):
+        step = 1e-6 * (1.0 + np.abs(theta[:, j]))
+        shifted = theta.copy()
+        shifted[:, j] += step
+        jac[:, :, j] = weight * (model.predict(shifted, x) - base) / step[:, None]
+    return jac
+
+
+def fit_curves(model, x, n, y, theta0=None, max_iter=100, tol=1e-5):
+    """Fit model to B curves at once with a batched Levenberg-Marquardt solver.
+
+    x, n and y are (B, K) arrays of SOA, trial count and proportion "same";
+    levels with n == 0 are ignored. Each curve has its own damping and stops
+    on its own once an accepted step lowers its error by less than the
+    fraction tol. Returns (theta (B, P),
+    weighted squared error (B,), converged (B,)).
+    """
+    theta = model.initial(x, n, y) if theta0 is None else np.array(theta0, dtype=np.float64)
+    theta = np.clip(theta, model.lower, model.upper)
+    weight = np.sqrt(n)
+    identity = np.eye(model.n_params)
+
+    residuals = weight * (model.predict(theta, x) - y)
+    cost = (residuals ** 2).sum(axis=1)
+    damping = np.full(len(theta), 1e-3)
+    converged = np.zeros(len(theta), dtype=bool)
+    active = np.arange(len(theta))
+
+    for _ in range(max_iter):
+        if not active.size:
+            break
+        xa, wa, ya = x[active], weight[active], y[active]
+        jac = _jacobian(model, theta[active], xa, wa)
+        jac_t = jac.transpose(0, 2, 1)
+        gradient = np.matmul(jac_t, residuals[active][:, :, None])[:, :, 0]
+        hessian = np.matmul(jac_t, jac)
+        diagonal = np.diagonal(hessian, axis1=1, axis2=2)
+        system = hessian + identity * (damping[active, None] * diagonal + 1e-9)[:, :, None]
+        step = np.linalg.solve(system, -gradient[:, :, None])[:, :, 0]
+
+        trial = np.clip(theta[active] + step, model.lower, model.upper)
+        trial_residuals = wa * (model.predict(trial, xa) - ya)
+        trial_cost = (trial_residuals ** 2).sum(axis=1)
+        better = trial_cost < cost[active]
+
+        improved = active[better]
+        gain = (cost[improved] - trial_cost[better]) / np.maximum(cost[improved], 1e-300)
+        theta[improved] = trial[better]
+        residuals[improved] = trial_residuals[better]
+        cost[improved] = trial_cost[better]
+        damping[improved] = np.maximum(damping[improved] / 10, 1e-12)
+        damping[active[~better]] *= 10
+
+        done = damping[active] > 1e10
+        done[better] = gain < tol
+        converged[active[done]] = True
+        active = active[~done]
+
+    return theta, cost, converged
+
+
+def bootstrap_curves(model, x, n, y, theta_hat, n_boot, rng):
+    """Fit n_boot binomial resamples of every curve; returns theta (B, n_boot, P)."""
+    curves, levels = x.shape
+    counts = rng.binomial(n.astype(np.int64)[:, None, :], y[:, None, :], size=(curves, n_boot, levels))
+    boot_y = counts / np.maximum(n, 1)[:, None, :]
+    tile = lambda a: np.repeat(a, n_boot, axis=0)
+    theta, _, _ = fit_curves(model, tile(x), tile(n), boot_y.reshape(-1, levels), tile(theta_hat))
+    return theta.reshape(curves, n_boot, model.n_params)
+
+
+def _fit_chunk(task):
+    """Fit one chunk of curves with every requested model; runs in a worker process."""
+    curves, model_names, n_boot, seed, ci = task
+    rng = np.random.default_rng(seed)
+    x, n, y = pack_curves(curves)
+    levels = (n > 0).sum(axis=1)
+    tail = (100 - ci) / 2
+
+    rows = []
+    for name in model_names:
+        model = MODELS[name]
+        theta, sse, converged = fit_curves(model, x, n, y)
+        stats = model.summarize(theta)
+        usable = levels >= model.n_params
+        if n_boot:
+            boot = model.summarize(bootstrap_curves(model, x, n, y, theta, n_boot, rng).reshape(-1, model.n_params))
+            bounds = {stat: np.percentile(boot[stat].reshape(len(curves), n_boot), [tail, 100 - tail], axis=1)
+                      for stat in ('pss', 'width')}
+        for i, curve in enumerate(curves):
+            row = {'file': os.path.basename(curve.source), 'participant': str(curve.participant),
+                   'experiment': str(curve.experiment), 'condition': str(curve.condition), 'model': name,
+                   'trials': int(curve.n.sum()), 'soa_levels': int(levels[i])}
+            if usable[i]:
+                row.update({stat: float(values[i]) for stat, values in stats.items()})
+                row.update({'sse': float(sse[i]), 'converged': bool(converged[i])})
+                if n_boot:
+                    for stat, (low, high) in bounds.items():
+                        row[f'{stat}_ci_low'] = float(low[i])
+                        row[f'{stat}_ci_high'] = float(high[i])
+            rows.append(row)
+    return rows
+
+
+def fit_sessions(curves, models=tuple(MODELS), n_boot=1000, workers=None, seed=None, chunk_size=50, ci=95.0):
+    """Fit every curve with every model, spreading chunks of curves over a process pool.
+
+    Returns one result dict (RESULT_FIELDS) per curve and model. Curves with
+    fewer SOA levels than the model has parameters get no estimates. seed
+    makes the bootstrap reproducible for a given chunk_size.
+    """
+    chunks = [curves[i:i + chunk_size] for i in range(0, len(curves), chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    tasks = [(chunk, tuple(models), n_boot, chunk_seed, ci) for chunk, chunk_seed in zip(chunks, seeds)]
+    if workers == 1 or len(tasks) <= 1:
+        results = map(_fit_chunk, tasks)
+        return [row for rows in results for row in rows]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return [row for rows in pool.map(_fit_chunk, tasks) for row in rows]
+
+
+def write_results(rows, output_path):
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit simultaneity-judgment curves of many sessions")
+    parser.add_argument('paths', nargs='+', help="Data files, directories or glob patterns")
+    parser.add_argument('--models', nargs='+', choices=sorted(MODELS), default=list(MODELS),
+                        help="Models to fit (default: all)")
+    parser.add_argument('--bootstrap', type=int, default=1000, help="Bootstrap replicates per curve (0 for none)")
+    parser.add_argument('--ci', type=float, default=95.0, help="Confidence interval in percent")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--chunk-size', type=int, default=50, help="Curves per worker task")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for the bootstrap")
+    parser.add_argument('--output', default='sj_fits.csv', help="Results CSV file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    curves = []
+    sessions = 0
+    for path, table in load_sessions(args.paths):
+        sessions += 1
+        curves.extend(sj_curves(path, table))
+    if not curves:
+        print("No SJ trials found")
+        return 1
+    print(f"Loaded {len(curves)} SJ curves from {sessions} sessions in {time.perf_counter() - start:.1f}s")
+
+    rows = fit_sessions(curves, args.models, args.bootstrap, args.workers, args.seed, args.chunk_size, args.ci)
+    write_results(rows, args.output)
+    failed = sum(1 for row in rows if row.get('converged') is False)
+    print(f"Wrote {len(rows)} fits to {args.output} in {time.perf_counter() - start:.1f}s"
+          + (f" ({failed} did not converge)" if failed else ""))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
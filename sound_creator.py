@@ -1,17 +1,102 @@
 import os
+import wave
 import numpy as np
-from scipy.io.wavfile import write
-from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QPushButton, QVBoxLayout, QMessageBox
+
+# The stimulus family used by the experiments: name -> frequency in Hz
+STIMULUS_TONES = {'tone': 1000, 'high_pitch': 1500, 'low_pitch': 500}
+SAMPLE_RATE = 48000
+TONE_DURATION = 0.1
+
+def synthesize_tones(frequencies, durations=TONE_DURATION, fs=SAMPLE_RATE, ramps=0.0, pans=0.0,
+                     amplitude=1.0):
+    """Synthesize a batch of sine tones at one sample rate in a single NumPy pass.
+
+    durations, ramps (raised-cosine onset/offset, in seconds) and pans
+    (-1 left only, 0 both channels at full level, +1 right only) are scalars
+    or one value per frequency. Returns a list of float32 (samples, 2) arrays.
+    """
+    frequencies = np.atleast_1d(np.asarray(frequencies, dtype=np.float64))
+    n = len(frequencies)
+    durations, ramps, pans = (np.broadcast_to(np.asarray(value, dtype=np.float64), (n,))
+                              for value in (durations, ramps, pans))
+    lengths = np.round(durations * fs).astype(int)
+    idx = np.arange(lengths.max())
+
+    waveforms = amplitude * np.sin(2 * np.pi * frequencies[:, None] * (idx / fs)[None, :])
+
+    # Onset/offset envelope; ramps of zero samples leave the tone untouched
+    ramp_samples = np.round(ramps * fs)[:, None]
+    rise = idx[None, :] / np.maximum(ramp_samples, 1)
+    fall = (lengths[:, None] - 1 - idx[None, :]) / np.maximum(ramp_samples, 1)
+    envelope = np.sin(np.pi / 2 * np.clip(np.minimum(rise, fall), 0, 1)) ** 2
+    waveforms *= np.where(ramp_samples > 0, envelope, 1.0)
+
+    gains = np.stack([np.clip(1 - pans, 0, 1), np.clip(1 + pans, 0, 1)], axis=1)
+    stereo = (waveforms[:, :, None] * gains[:, None, :]).astype(np.float32)
+    return [stereo[i, :lengths[i]] for i in range(n)]
+
+class ToneCache:
+    """In-process cache of synthesized tones, keyed by their full specification."""
+
+    def __init__(self):
+        self._tones = {}
+
+    def tones(self, specs):
+        """Return {name: (samples, fs)} for specs, synthesizing missing ones in batches.
+
+        Each spec is a dict with 'name' and 'frequency' and optionally
+        'duration', 'fs', 'ramp' and 'pan'. Tones are batched per sample rate.
+        """
+        keys = {}
+        for spec in specs:
+            keys[spec['name']] = (float(spec['frequency']), float(spec.get('duration', TONE_DURATION)),
+                                  int(spec.get('fs', SAMPLE_RATE)), float(spec.get('ramp', 0.0)),
+                                  float(spec.get('pan', 0.0)))
+        missing = sorted({key for key in keys.values() if key not in self._tones}, key=lambda key: key[2])
+        for fs in sorted({key[2] for key in missing}):
+            batch = [key for key in missing if key[2] == fs]
+            frequencies, durations, _, ramps, pans = zip(*batch)
+            for key, samples in zip(batch, synthesize_tones(frequencies, durations, fs, ramps, pans)):
+                self._tones[key] = samples
+        return {name: (self._tones[key], key[2]) for name, key in keys.items()}
+
+    def clear(self):
+        self._tones.clear()
+
+tone_cache = ToneCache()
+
+def stimulus_specs(duration=TONE_DURATION, fs=SAMPLE_RATE, ramp=0.0):
+    """Specs for the experiments' stimulus family."""
+    return [{'name': name, 'frequency': frequency, 'duration': duration, 'fs': fs, 'ramp': ramp}
+            for name, frequency in STIMULUS_TONES.items()]
+
+def write_wav(filename, samples, fs):
+    """Write float samples in [-1, 1] as a 16-bit PCM WAV file."""
+    samples = np.asarray(samples)
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    pcm = np.int16(np.clip(samples, -1, 1) * 32767)
+    with wave.open(filename, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(fs)
+        wav.writeframes(pcm.astype('<i2').tobytes())
+
+def export_stimulus_files(directory, specs=None):
+    """Write the stimulus family to <name>.wav files in directory (optional; the runner does not need them)."""
+    for name, (samples, fs) in tone_cache.tones(specs or stimulus_specs()).items():
+        filename = os.path.join(directory, f"{name}.wav")
+        write_wav(filename, samples, fs)
+        print(f"Created {filename}")
 
 def create_tone(filename, frequency, duration=0.1, fs=44100):
     """Create a tone and save it as a WAV file."""
-    samples = np.arange(duration * fs) / fs
-    waveform = np.sin(2 * np.pi * frequency * samples)
-    waveform_integers = np.int16(waveform * 32767)
-    write(filename, fs, waveform_integers)
+    samples, = synthesize_tones([frequency], duration, fs)
+    write_wav(filename, samples[:, 0], fs)
     print(f"Created {filename}")
 
 def main():
+    from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QPushButton, QVBoxLayout, QMessageBox
+
     app = QApplication([])
     window = QWidget()
     window.setWindowTitle("Sound Creator")
@@ -19,10 +104,7 @@ def main():
     create_button = QPushButton("Create Sound Files")
 
     def on_create():
-        directory = os.path.dirname(__file__)
-        create_tone(os.path.join(directory, "tone.wav"), frequency=1000)
-        create_tone(os.path.join(directory, "high_pitch.wav"), frequency=1500)
-        create_tone(os.path.join(directory, "low_pitch.wav"), frequency=500)
+        export_stimulus_files(os.path.dirname(os.path.abspath(__file__)))
         QMessageBox.information(window, "Success", "Sound files created successfully.")
         window.close()
 
@@ -36,4 +118,4 @@ def main():
     app.exec_()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
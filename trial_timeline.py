@@ -0,0 +1,301 @@
+"""
+Compile trials into frame-indexed timelines.
+
+Each trial (its experiment type, SOA, side and the audiovisual synchrony
+correction) is turned into an array with one entry per flip saying which
+stimuli are drawn and which sounds start on that flip. All of the SOA-to-frame
+arithmetic happens here, before the block starts, so the runner only has to
+play the arrays back. Visual events are whole frames. When the audio backend
+can start a sound at a given time, audio events can also carry a sub-frame
+delay after their flip, so SOAs and the synchrony correction are realised at
+sample resolution instead of being rounded to frames. The module has no
+PsychoPy dependency, so a whole configuration can be compiled and checked
+offline:
+
+    python trial_timeline.py demo.json --refresh 60
+"""
+import argparse
+import json
+import math
+import sys
+
+import numpy as np
+
+# Stimulus bits used in the 'visual' and 'audio' masks
+STIM_CENTER = 1
+STIM_LEFT = 2
+STIM_RIGHT = 4
+STIM_BILATERAL = STIM_LEFT | STIM_RIGHT
+
+# Frame 0 is a blank lead-in flip before the first stimulus
+LEAD_IN_FRAMES = 1
+
+FRAME_DTYPE = np.dtype([('visual', 'u1'), ('audio', 'u1'), ('audio_delay', 'f8')])
+
+SJ_SOAS = [-300, -250, -200, -150, -100, -50, 0, 50, 100, 150, 200, 250, 300]
+SJ_MOD_SOAS = [-300, -200, -100, -50, 0, 50, 100, 200, 300]
+SRT_TRIAL_TYPES = ['visual', 'audio', 'audiovisual']
+SRT_MOD_TRIAL_TYPES = ['visual_left', 'visual_right', 'visual_bilateral',
+                       'audio_left', 'audio_right', 'audio_bilateral',
+                       'audiovisual_left', 'audiovisual_right', 'audiovisual_bilateral']
+
+
+class TrialTimeline:
+    """Frame events for one trial.
+
+    frames is a FRAME_DTYPE array: 'visual' is the mask of stimuli drawn on
+    each flip, 'audio' the mask of sounds started on it and 'audio_delay'
+    how long after that flip they start, in seconds. onset_frame is the
+    visual onset flip (the first stimulus flip when there is no visual
+    stimulus), which SRT reaction times are measured from; SJ reaction times
+    run from first_stimulus_frame. requested_lag_ms and
+    realized_lag_ms describe the asynchrony between the two onsets of a
+    paired trial (None for single-stimulus trials).
+    """
+
+    def __init__(self, frames, onset_frame, requested_lag_ms=None, realized_lag_ms=None):
+        self.frames = frames
+        self.onset_frame = onset_frame
+        self.requested_lag_ms = requested_lag_ms
+        self.realized_lag_ms = realized_lag_ms
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def first_stimulus_frame(self):
+        """The flip on which the first stimulus, visual or sound, is presented."""
+        active = np.flatnonzero(self.frames['visual'] | self.frames['audio'])
+        return int(active[0]) if len(active) else self.onset_frame
+
+    @property
+    def lag_error_ms(self):
+        if self.requested_lag_ms is None:
+            return 0.0
+        return self.realized_lag_ms - self.requested_lag_ms
+
+
+def stimulus_frames(duration, frame_rate):
+    """Flips a visual stimulus of duration seconds stays on screen, at least one.
+
+    Rounded, so a measured 59.98Hz still gives the same frame count as 60Hz.
+    """
+    return max(1, int(round(duration * frame_rate)))
+
+
+def _lag_frames(soa_ms, frame_dur):
+    """Convert an SOA in milliseconds to a whole number of frames"""
+    return int(round(abs(soa_ms) / 1000.0 / frame_dur))
+
+
+def _build(events, visual_frames, frame_dur, requested_lag_ms=None):
+    """Lay out a list of (kind, mask, start_frame, delay) events as a frame array.
+
+    Visual events stay on screen for visual_frames flips; audio events start
+    delay seconds after their flip and the timeline runs on for visual_frames
+    flips so the sound finishes before the response period.
+    """
+    n_frames = max(start for _, _, start, _ in events) + visual_frames
+    frames = np.zeros(n_frames, dtype=FRAME_DTYPE)
+    for kind, mask, start, delay in events:
+        if kind == 'visual':
+            frames['visual'][start:start + visual_frames] |= mask
+        else:
+            frames['audio'][start] |= mask
+            frames['audio_delay'][start] = delay
+
+    # Reaction times run from the visual onset when there is one
+    visual_starts = [start for kind, _, start, _ in events if kind == 'visual']
+    onset_frame = min(visual_starts) if visual_starts else min(start for _, _, start, _ in events)
+
+    realized_lag_ms = None
+    if requested_lag_ms is not None:
+        (_, _, first, first_delay), (_, _, second, second_delay) = events[:2]
+        realized_lag_ms = ((second - first) * frame_dur + second_delay - first_delay) * 1000.0
+    return TrialTimeline(frames, onset_frame, requested_lag_ms, realized_lag_ms)
+
+
+def _pair(first, second, soa_ms, visual_frames, frame_dur, sample_rate=None, min_lag_frames=0):
+    """Timeline for two stimuli where second lags first by soa_ms.
+
+    first and second are (kind, mask) tuples. A negative SOA means second
+    comes first. With a sample_rate, an audio event is placed at the exact
+    SOA (rounded to whole samples) as a delay after the flip before it;
+    otherwise both events are rounded to whole frames, at least
+    min_lag_frames apart.
+    """
+    if sample_rate and 'audio' in (first[0], second[0]):
+        timeline = _pair_subframe(first, second, soa_ms, visual_frames, frame_dur, sample_rate)
+        if timeline is not None:
+            return timeline
+
+    lag = max(_lag_frames(soa_ms, frame_dur), min_lag_frames)
+    if soa_ms >= 0:
+        first_start, second_start = LEAD_IN_FRAMES, LEAD_IN_FRAMES + lag
+    else:
+        first_start, second_start = LEAD_IN_FRAMES + lag, LEAD_IN_FRAMES
+    events = [(first[0], first[1], first_start, 0.0), (second[0], second[1], second_start, 0.0)]
+    return _build(events, visual_frames, frame_dur, requested_lag_ms=soa_ms)
+
+
+def _pair_subframe(first, second, soa_ms, visual_frames, frame_dur, sample_rate):
+    """Sub-frame placement for _pair; None when it cannot be used.
+
+    The visual event (or, for two sounds, the earlier one) is anchored to a
+    flip and the other sound is placed lag seconds from it.
+    """
+    lag = round(soa_ms / 1000.0 * sample_rate) / sample_rate
+    if first[0] == 'visual' or (second[0] == 'audio' and lag >= 0):
+        anchor, floating, offset = first, second, lag
+    else:
+        anchor, floating, offset = second, first, -lag
+
+    # Push the anchor late enough that the other event is not before the lead-in
+    anchor_start = LEAD_IN_FRAMES + math.ceil(max(0.0, -offset) / frame_dur - 1e-9)
+    floating_time = anchor_start * frame_dur + offset
+    floating_start = int(math.floor(floating_time / frame_dur + 1e-9))
+    delay = max(0.0, floating_time - floating_start * frame_dur)
+    if floating[0] == anchor[0] == 'audio' and floating_start == anchor_start and delay > 0:
+        return None  # Only one audio delay per flip
+
+    if anchor is first:
+        events = [first + (anchor_start, 0.0), second + (floating_start, delay)]
+    else:
+        events = [first + (floating_start, delay), second + (anchor_start, 0.0)]
+    return _build(events, visual_frames, frame_dur, requested_lag_ms=soa_ms)
+
+
+def _side_mask(trial_type):
+    if '_left' in trial_type:
+        return STIM_LEFT
+    elif '_right' in trial_type:
+        return STIM_RIGHT
+    return STIM_BILATERAL
+
+
+def compile_trial(exp_type, trial, av_sync, frame_dur, visual_frames, sample_rate=None):
+    """Compile one trial into a TrialTimeline.
+
+    Parameters:
+    -----------
+    exp_type : str
+        'sj', 'srt', 'srt_mod' or 'sj_mod'
+    trial : int, str or tuple
+        The entry from build_trial_list(): the SOA for SJ, the trial type for
+        SRT/SRT_Mod and (trial_type, soa, side) for SJ_Mod
+    av_sync : float
+        Audiovisual synchrony correction in ms (positive moves visual earlier)
+    frame_dur : float
+        Duration of one frame in seconds
+    visual_frames : int
+        Number of frames each visual stimulus stays on screen
+    sample_rate : int, optional
+        Audio sample rate when sounds can be scheduled between flips; None
+        rounds every onset to whole frames
+    """
+    if exp_type == 'sj':
+        # Positive SOAs are visual first
+        return _pair(('visual', STIM_CENTER), ('audio', STIM_CENTER),
+                     trial + av_sync, visual_frames, frame_dur, sample_rate)
+
+    elif exp_type == 'srt':
+        if trial == 'audiovisual':
+            return _pair(('visual', STIM_CENTER), ('audio', STIM_CENTER),
+                         av_sync, visual_frames, frame_dur, sample_rate)
+        kind = 'visual' if trial == 'visual' else 'audio'
+        return _build([(kind, STIM_CENTER, LEAD_IN_FRAMES, 0.0)], visual_frames, frame_dur)
+
+    elif exp_type == 'srt_mod':
+        mask = _side_mask(trial)
+        if 'audiovisual' in trial:
+            return _pair(('visual', mask), ('audio', mask), av_sync, visual_frames, frame_dur, sample_rate)
+        kind = 'visual' if 'visual' in trial else 'audio'
+        return _build([(kind, mask, LEAD_IN_FRAMES, 0.0)], visual_frames, frame_dur)
+
+    elif exp_type == 'sj_mod':
+        trial_type, soa, side = trial
+        first_mask = STIM_LEFT if side == 'left' else STIM_RIGHT
+        second_mask = STIM_BILATERAL & ~first_mask
+        if trial_type == 'audiovisual':
+            return _pair(('visual', first_mask), ('audio', first_mask),
+                         soa + av_sync, visual_frames, frame_dur, sample_rate)
+        # Unimodal pairs: 'side' goes first. As in the original presentation code,
+        # a non-zero SOA gets the correction too, and the second visual stimulus
+        # only appears once the first has gone
+        kind = 'visual' if trial_type == 'visual' else 'audio'
+        if soa == 0:
+            return _pair((kind, first_mask), (kind, second_mask), 0, visual_frames, frame_dur, sample_rate)
+        return _pair((kind, first_mask), (kind, second_mask), abs(soa + av_sync), visual_frames, frame_dur,
+                     sample_rate, min_lag_frames=visual_frames if kind == 'visual' else 0)
+
+    raise ValueError(f"Unknown experiment type: {exp_type}")
+
+
+def build_trial_list(block_config):
+    """Return the unshuffled list of trials for a block configuration."""
+    exp_type = block_config['experiment'].lower()
+    trials_per_condition = block_config['trials_per_condition']
+
+    if exp_type == 'srt':
+        return SRT_TRIAL_TYPES * trials_per_condition
+    elif exp_type == 'srt_mod':
+        return SRT_MOD_TRIAL_TYPES * trials_per_condition
+    elif exp_type == 'sj':
+        return SJ_SOAS * trials_per_condition
+    elif exp_type == 'sj_mod':
+        return [(cond, soa, side)
+                for cond in ['visual', 'auditory', 'audiovisual']
+                for soa in SJ_MOD_SOAS
+                for side in ['left', 'right']
+                for _ in range(trials_per_condition)]
+    raise ValueError(f"Unknown experiment type: {exp_type}")
+
+
+def compile_block(exp_type, trials, av_sync, frame_dur, visual_frames, sample_rate=None):
+    """Compile every trial of a block. Returns a list of TrialTimelines."""
+    return [compile_trial(exp_type, trial, av_sync, frame_dur, visual_frames, sample_rate) for trial in trials]
+
+
+def summarize_block(timelines, frame_dur):
+    """Offline timing summary of a compiled block."""
+    lengths = np.array([len(timeline) for timeline in timelines])
+    lag_errors = np.array([abs(timeline.lag_error_ms) for timeline in timelines])
+    return {
+        'trials': len(timelines),
+        'total_frames': int(lengths.sum()),
+        'stimulus_time_s': float(lengths.sum() * frame_dur),
+        'longest_trial_frames': int(lengths.max()) if len(lengths) else 0,
+        'max_lag_error_ms': float(lag_errors.max()) if len(lag_errors) else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile and check the trial timelines of a configuration")
+    parser.add_argument('config', help="Experiment configuration JSON file")
+    parser.add_argument('--refresh', type=float, default=60.0, help="Display refresh rate in Hz")
+    parser.add_argument('--stim-duration', type=float, default=0.1, help="Visual stimulus duration in s")
+    parser.add_argument('--sample-rate', type=int, default=None,
+                        help="Schedule audio between flips at this sample rate (default: whole frames)")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+
+    frame_dur = 1.0 / args.refresh
+    visual_frames = stimulus_frames(args.stim_duration, args.refresh)
+    av_sync = config.get('av_sync_correction', 0.0)
+    print(f"Refresh rate: {args.refresh}Hz, frames per stimulus: {visual_frames}, AV sync correction: {av_sync}ms")
+
+    for block in config['blocks']:
+        exp_type = block['experiment'].lower()
+        timelines = compile_block(exp_type, build_trial_list(block), av_sync, frame_dur, visual_frames,
+                                  args.sample_rate)
+        summary = summarize_block(timelines, frame_dur)
+        print(f"Block {block['block_number']} ({block['experiment']}): {summary['trials']} trials, "
+              f"{summary['total_frames']} stimulus frames ({summary['stimulus_time_s']:.1f}s), "
+              f"longest trial {summary['longest_trial_frames']} frames, "
+              f"max SOA rounding error {summary['max_lag_error_ms']:.1f}ms")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""
+Block-scoped trial data writer with a crash-safe journal.
+
+The data file is opened once per block and rows are buffered in memory, so the
+trial loop never pays for an open/close. Every row is also appended to a
+fixed-size record journal next to the data file. If the runner dies before the
+block is closed, recover_journal() rebuilds the block from the journal.
+"""
+import csv
+import glob
+import io
+import json
+import os
+import struct
+import zlib
+
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_RECORD_SIZE = 1024
+JOURNAL_MAGIC = b'MSIJ'
+# magic, sequence number, payload length, crc32 of payload
+_RECORD_HEADER = struct.Struct('<4sIII')
+_PAYLOAD_SIZE = JOURNAL_RECORD_SIZE - _RECORD_HEADER.size
+
+
+def _pack_record(sequence, payload):
+    """Pack one journal record, padded to JOURNAL_RECORD_SIZE bytes."""
+    header = _RECORD_HEADER.pack(JOURNAL_MAGIC, sequence, len(payload), zlib.crc32(payload))
+    return (header + payload).ljust(JOURNAL_RECORD_SIZE, b'\0')
+
+
+def _read_records(journal_filename):
+    """Yield the payloads of all intact records, stopping at the first torn one."""
+    with open(journal_filename, 'rb') as journal:
+        expected = 0
+        while True:
+            record = journal.read(JOURNAL_RECORD_SIZE)
+            if len(record) < JOURNAL_RECORD_SIZE:
+                return
+            magic, sequence, length, crc = _RECORD_HEADER.unpack_from(record)
+            if magic != JOURNAL_MAGIC or sequence != expected or length > _PAYLOAD_SIZE:
+                return
+            payload = record[_RECORD_HEADER.size:_RECORD_HEADER.size + length]
+            if zlib.crc32(payload) != crc:
+                return
+            yield payload
+            expected += 1
+
+
+class TrialWriter:
+    """Keep the data file open for a block and journal every row.
+
+    write_row() only touches memory and the journal; flush() moves buffered
+    rows into the data file and should be called during the inter-trial
+    interval. close() flushes, fsyncs the data file and removes the journal,
+    so fsync only happens at block boundaries.
+    """
+
+    def __init__(self, data_filename, journal_filename=None):
+        self.data_filename = data_filename
+        self.journal_filename = journal_filename or data_filename + JOURNAL_SUFFIX
+        self._pending = []
+        self._line = io.StringIO()
+        self._line_writer = csv.writer(self._line)
+
+        self._file = open(data_filename, 'a', newline='')
+        start_offset = self._file.tell()
+
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+        self._journal = os.open(self.journal_filename, flags, 0o644)
+        self._sequence = 0
+        # The first record tells recovery where this block starts in the data file
+        header = {'data_filename': os.path.abspath(data_filename), 'offset': start_offset}
+        self._append_journal(json.dumps(header).encode('utf-8'))
+        os.fsync(self._journal)
+
+    def _append_journal(self, payload):
+        os.write(self._journal, _pack_record(self._sequence, payload))
+        self._sequence += 1
+
+    def write_row(self, row):
+        """Buffer one CSV row and append it to the journal."""
+        self._line.seek(0)
+        self._line.truncate()
+        self._line_writer.writerow(row)
+        line = self._line.getvalue()
+        self._pending.append(line)
+
+        payload = line.encode('utf-8')
+        if len(payload) > _PAYLOAD_SIZE:
+            print(f"WARNING: Row too long for the journal ({len(payload)} bytes), it will not be recoverable")
+            return
+        self._append_journal(payload)
+
+    def flush(self):
+        """Write buffered rows to the data file (no fsync)."""
+        if not self._pending:
+            return
+        self._file.write(''.join(self._pending))
+        self._file.flush()
+        self._pending.clear()
+
+    def close(self):
+        """Flush, fsync the data file and discard the journal."""
+        if self._file is None:
+            return
+        try:
+            self.flush()
+            os.fsync(self._file.fileno())
+        finally:
+            self._file.close()
+            self._file = None
+            os.close(self._journal)
+        os.remove(self.journal_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def recover_journal(journal_filename):
+    """Rebuild the block recorded in a journal left behind by a crash.
+
+    The data file is truncated back to where the block started and every
+    journaled row is written again, so recovery is safe to repeat. Returns the
+    number of rows recovered.
+    """
+    payloads = list(_read_records(journal_filename))
+    if not payloads:
+        os.remove(journal_filename)
+        return 0
+
+    header = json.loads(payloads[0].decode('utf-8'))
+    data_filename = header['data_filename']
+    rows = [payload.decode('utf-8') for payload in payloads[1:]]
+
+    with open(data_filename, 'a+', newline='') as data_file:
+        data_file.truncate(header['offset'])
+        data_file.seek(header['offset'])
+        data_file.write(''.join(rows))
+        data_file.flush()
+        os.fsync(data_file.fileno())
+
+    os.remove(journal_filename)
+    return len(rows)
+
+
+def recover_pending_journals(directory='.'):
+    """Recover every journal found in directory. Returns {data_filename: rows}."""
+    recovered = {}
+    for journal_filename in glob.glob(os.path.join(directory, '*' + JOURNAL_SUFFIX)):
+        data_filename = journal_filename[:-len(JOURNAL_SUFFIX)]
+        try:
+            recovered[data_filename] = recover_journal(journal_filename)
+        except Exception as e:
+            print(f"Error recovering journal {journal_filename}: {e}")
+    return recovered
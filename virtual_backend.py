@@ -0,0 +1,305 @@
+"""
+Headless stand-in for the parts of PsychoPy used by run_MSI_GUI_experiment.py.
+
+Time is simulated: Window.flip() jumps to the next vsync of a virtual display
+running at a configurable refresh rate (optionally dropping frames at random),
+core.wait() advances the clock instantly, Sound.play() only records when it
+was requested, and key presses (through event or the hardware Keyboard) come
+from a ScriptedResponder. This lets whole sessions run on machines with no
+display, GPU, sound device or participant.
+
+The runner picks this backend up when MSI_BACKEND=virtual is set; see
+run_headless.py for the command-line entry point.
+"""
+import math
+import random
+from types import SimpleNamespace
+
+
+class SimulatedSession:
+    """Shared simulated clock and counters for one headless run."""
+
+    def __init__(self, refresh_rate=60.0, drop_rate=0.0, seed=None, responder=None):
+        self.refresh_rate = refresh_rate
+        self.frame_dur = 1.0 / refresh_rate
+        self.drop_rate = drop_rate
+        self.rng = random.Random(seed)
+        self.responder = responder or ScriptedResponder(seed=seed)
+        self.now = 0.0
+        self.flips = 0
+        self.dropped_frames = 0
+        self.draws = 0
+        self.sound_log = []  # (request time, sound value, requested start time)
+
+    def next_vsync(self, after):
+        """Time of the first vsync strictly after the given time."""
+        return (math.floor(after / self.frame_dur + 1e-9) + 1) * self.frame_dur
+
+
+class ScriptedResponder:
+    """Source of simulated key presses.
+
+    Each time the runner starts waiting for one of the response keys, a press
+    is scheduled. Entries of script are consumed first, as (key, latency)
+    tuples where key=None means "pick a valid key"; after that presses use a
+    random valid key and a latency drawn uniformly from latency_range.
+    Escape is never pressed.
+    """
+
+    RESPONSE_KEYS = ('space', '1', '2')
+
+    def __init__(self, script=None, latency_range=(0.2, 0.6), seed=None):
+        self.script = list(script or [])
+        self.latency_range = latency_range
+        self.rng = random.Random(seed)
+        self._pending = {}  # keyList -> (key, press time)
+
+    def _schedule(self, valid_keys, now):
+        if self.script:
+            key, latency = self.script.pop(0)
+        else:
+            key, latency = None, self.rng.uniform(*self.latency_range)
+        if key is None:
+            key = self.rng.choice(valid_keys)
+        return key, now + latency
+
+    def press_time(self, keyList, now):
+        """Return the (key, time) press pending for keyList, scheduling one if needed."""
+        valid_keys = [key for key in (keyList or self.RESPONSE_KEYS) if key in self.RESPONSE_KEYS]
+        if not valid_keys:
+            return None
+        list_key = tuple(keyList or ())
+        pending = self._pending.get(list_key)
+        # A press nobody collected in time belongs to an earlier wait
+        if pending is None or pending[1] < now - 0.5:
+            pending = self._pending[list_key] = self._schedule(valid_keys, now)
+        return pending
+
+    def consume(self, keyList):
+        self._pending.pop(tuple(keyList or ()), None)
+
+
+session = SimulatedSession()
+
+
+def configure(refresh_rate=60.0, drop_rate=0.0, seed=None, responder=None):
+    """Start a new simulated session. Returns it."""
+    global session
+    session = SimulatedSession(refresh_rate, drop_rate, seed, responder)
+    return session
+
+
+# --- core ---------------------------------------------------------------
+
+class Clock:
+    def __init__(self):
+        self._start = session.now
+
+    def getTime(self):
+        return session.now - self._start
+
+    def reset(self, newT=0.0):
+        self._start = session.now - newT
+
+
+def _get_time():
+    return session.now
+
+
+def _wait(secs, hogCPUperiod=0.2):
+    session.now += max(0.0, secs)
+
+
+def _quit():
+    raise SystemExit(0)
+
+
+core = SimpleNamespace(Clock=Clock, getTime=_get_time, wait=_wait, quit=_quit)
+
+
+# --- visual -------------------------------------------------------------
+
+class Window:
+    def __init__(self, size=(800, 600), **kwargs):
+        self.size = size
+        self.units = kwargs.get('units', 'norm')
+        self.monitor = kwargs.get('monitor')
+        self.recordFrameIntervals = False
+        self.frameIntervals = []
+        self.lastFrameT = session.now
+        self._to_call = []
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._to_call.append((function, args, kwargs))
+
+    def flip(self, clearBuffer=True):
+        flip_time = session.next_vsync(session.now)
+        if session.drop_rate and session.rng.random() < session.drop_rate:
+            flip_time += session.frame_dur
+            session.dropped_frames += 1
+        session.now = flip_time
+        session.flips += 1
+        if self.recordFrameIntervals:
+            self.frameIntervals.append(flip_time - self.lastFrameT)
+        self.lastFrameT = flip_time
+
+        to_call, self._to_call = self._to_call, []
+        for function, args, kwargs in to_call:
+            function(*args, **kwargs)
+        return flip_time
+
+    def getFutureFlipTime(self, targetTime=0, clock=None):
+        return session.next_vsync(session.now + targetTime)
+
+    def getActualFrameRate(self, **kwargs):
+        return session.refresh_rate
+
+    def clearBuffer(self, color=True, depth=False, stencil=False):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Stim:
+    def __init__(self, win=None, **kwargs):
+        self.win = win
+        self.text = kwargs.pop('text', '')
+        self.__dict__.update(kwargs)
+
+    def draw(self, win=None):
+        session.draws += 1
+
+
+class Circle(_Stim):
+    pass
+
+
+class ShapeStim(_Stim):
+    pass
+
+
+class TextStim(_Stim):
+    pass
+
+
+class BufferImageStim(_Stim):
+    pass
+
+
+visual = SimpleNamespace(Window=Window, Circle=Circle, ShapeStim=ShapeStim,
+                         TextStim=TextStim, BufferImageStim=BufferImageStim)
+
+
+# --- monitors -----------------------------------------------------------
+
+class Monitor:
+    def __init__(self, name, **kwargs):
+        self.name = name
+
+    def setWidth(self, width):
+        self.width = width
+
+    def setDistance(self, distance):
+        self.distance = distance
+
+    def setSizePix(self, size):
+        self.size_pix = size
+
+
+monitors = SimpleNamespace(Monitor=Monitor)
+
+
+# --- sound --------------------------------------------------------------
+
+class Sound:
+    def __init__(self, value='C', secs=0.5, **kwargs):
+        self.value = value
+        self.secs = secs
+        self.volume = kwargs.get('volume', 1.0)
+
+    def play(self, when=None, **kwargs):
+        session.sound_log.append((session.now, self.value, when))
+
+    def stop(self, **kwargs):
+        pass
+
+    def setVolume(self, volume):
+        self.volume = volume
+
+
+def _stop_all_sounds():
+    pass
+
+
+sound = SimpleNamespace(Sound=Sound, init=lambda *args, **kwargs: None,
+                        audioLib='virtual', stopAllSounds=_stop_all_sounds)
+
+
+# --- event --------------------------------------------------------------
+
+def _stamp(press_time, timeStamped):
+    if isinstance(timeStamped, Clock):
+        return press_time - timeStamped._start
+    return press_time
+
+
+def _get_keys(keyList=None, timeStamped=False, **kwargs):
+    pending = session.responder.press_time(keyList, session.now)
+    if pending is None or pending[1] > session.now:
+        return []
+    session.responder.consume(keyList)
+    key, press_time = pending
+    if timeStamped:
+        return [(key, _stamp(press_time, timeStamped))]
+    return [key]
+
+
+def _wait_keys(maxWait=float('inf'), keyList=None, timeStamped=False, **kwargs):
+    pending = session.responder.press_time(keyList, session.now)
+    if pending is None or pending[1] - session.now > maxWait:
+        session.now += maxWait if maxWait != float('inf') else 0.0
+        return None
+    session.now = max(session.now, pending[1])
+    return _get_keys(keyList, timeStamped)
+
+
+event = SimpleNamespace(getKeys=_get_keys, waitKeys=_wait_keys,
+                        clearEvents=lambda *args, **kwargs: None)
+
+
+# --- keyboard (psychopy.hardware.keyboard) ------------------------------
+
+class KeyPress:
+    def __init__(self, name, tDown, rt):
+        self.name = name
+        self.tDown = tDown
+        self.rt = rt
+        self.duration = None
+
+
+class Keyboard:
+    """Timestamped key presses: tDown is the simulated press time, not the poll time."""
+
+    def __init__(self, **kwargs):
+        self.clock = Clock()
+
+    def getKeys(self, keyList=None, waitRelease=True, clear=True):
+        pending = session.responder.press_time(keyList, session.now)
+        if pending is None or pending[1] > session.now:
+            return []
+        if clear:
+            session.responder.consume(keyList)
+        key, press_time = pending
+        return [KeyPress(key, press_time, press_time - self.clock._start)]
+
+    def clearEvents(self, eventType=None):
+        session.responder._pending.clear()
+
+
+keyboard = SimpleNamespace(Keyboard=Keyboard, KeyPress=KeyPress)
+
+
+# --- prefs --------------------------------------------------------------
+
+prefs = SimpleNamespace(hardware={}, general={})